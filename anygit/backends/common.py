@@ -1,13 +1,47 @@
 import hashlib
+import logging
+import os
 import re
 import routes.util
 import urlparse
 
 from anygit.data import exceptions
+from anygit.data import hyperloglog
+
+logger = logging.getLogger(__name__)
+# The indexer keeps counts of the objects with each prefix of up to
+# this many hex digits, so short queries needn't count them
+max_counted_prefix = 4
+object_types = ('blob', 'tree', 'commit', 'tag')
+hex_digits = '0123456789abcdef'
+# Abbreviations are at least this long, as with git
+min_abbrev = 7
 
 def sha1(string):
     return hashlib.sha1(string).hexdigest()
 
+def count_prefixes(pairs):
+    """Count the (sha1, type) pairs by prefix, as a dict from each
+    prefix of up to max_counted_prefix digits to a dict from type to
+    count."""
+    counts = {}
+    for id, type in pairs:
+        for length in xrange(1, max_counted_prefix + 1):
+            by_type = counts.setdefault(id[:length], {})
+            by_type[type] = by_type.get(type, 0) + 1
+    return counts
+
+def sanitize_unicode(u):
+    if isinstance(u, str):
+        try:
+            return unicode(u, 'utf-8')
+        except UnicodeDecodeError:
+            sanitized = unicode(u, 'iso-8859-1')
+            logger.info('Invalid unicode detected: %r.  Assuming iso-8859-1 (%s)' % (u, sanitized))
+            return sanitized
+    else:
+        return u
+
 class CommonMixin(object):
     """Functionality common to all backends."""
     def __new__(cls, *args, **kwargs):
@@ -60,6 +94,28 @@ class CommonRepositoryMixin(CommonMixin):
         id = sha1(url)
         return super(CommonRepositoryMixin, cls).create(id=id, url=url)
 
+    @classmethod
+    def register_all(cls, urls, approved=False, batch=1000):
+        """Make sure there is a repository for each of urls, writing
+        the missing ones straight to the database batch at a time
+        with approved set.  Repositories we already have are left as
+        they are.  Returns how many were added."""
+        added = 0
+        seen = set()
+        rows = []
+        for url in urls:
+            url = cls.canonicalize(url)
+            if not url or url in seen:
+                continue
+            seen.add(url)
+            rows.append((sha1(url), url))
+            if len(rows) >= batch:
+                added += cls._register_batch(rows, approved)
+                rows = []
+        if rows:
+            added += cls._register_batch(rows, approved)
+        return added
+
     def __str__(self):
         return "Repository: %s" % self.id
     __repr__ = __str__
@@ -71,10 +127,21 @@ class CommonRepositoryMixin(CommonMixin):
         if not self.url:
             self.error("url", "Must provide a url")
 
+    def _url_parts(self):
+        # Worked out once per url, as host and path are used a lot
+        parts = getattr(self, '_url_parts_cache', None)
+        if parts is None or parts[0] != self.url:
+            stripped_url = re.sub('^[^:]*:', '', self.url)
+            if github_re.search(self.url):
+                type = 'github'
+            else:
+                type = None
+            parts = (self.url, urlparse.urlparse(stripped_url), type)
+            self._url_parts_cache = parts
+        return parts
+
     def type(self):
-        if github_re.search(self.url):
-            return 'github'
-        return None
+        return self._url_parts()[2]
 
     def linkable(self, obj):
         if self.type == 'github':
@@ -86,8 +153,7 @@ class CommonRepositoryMixin(CommonMixin):
 
     @property
     def _parsed_url(self):
-        stripped_url = re.sub('^[^:]*:', '', self.url)
-        return urlparse.urlparse(stripped_url)
+        return self._url_parts()[1]
 
     @property
     def host(self):
@@ -104,6 +170,52 @@ class CommonRepositoryMixin(CommonMixin):
         else:
             return url
 
+    def get_sketch(self):
+        """A HyperLogLog sketch of the objects in this repository"""
+        if self.sketch:
+            return hyperloglog.HyperLogLog.from_string(self.sketch)
+        else:
+            return hyperloglog.HyperLogLog()
+
+    def add_sketch(self, sketch):
+        """Merge in a sketch of newly indexed objects, and update the
+        count from the result."""
+        if not self.sketch and self.been_indexed:
+            # Indexed before we kept sketches, so one of just the new
+            # objects would undercount.  bin/aggregator reconcile --all
+            # builds a full one.
+            self.increment('count', sketch.cardinality())
+        else:
+            merged = self.get_sketch().merge(sketch)
+            self.set_sketch(merged)
+            self.set_count(merged.cardinality())
+
+    def rebuild_sketch(self):
+        """Recompute the exact count and the sketch from scratch"""
+        sketch = hyperloglog.HyperLogLog()
+        count = 0
+        for id in self.object_ids():
+            sketch.add(id)
+            count += 1
+        self.set_sketch(sketch)
+        self.set_count(count)
+
+    def estimate_overlap(self, other):
+        """Estimate how many objects this repository shares with other"""
+        return self.get_sketch().overlap(other.get_sketch())
+
+    def set_checkpoint(self, pack, checksum, phase, offset):
+        """Record how far indexing pack (whose trailing checksum is
+        checksum) has got: everything before offset in phase is in
+        the database."""
+        self.checkpoint_pack = pack
+        self.checkpoint_checksum = checksum
+        self.checkpoint_phase = phase
+        self.checkpoint_offset = offset
+
+    def clear_checkpoint(self):
+        self.set_checkpoint(None, None, None, None)
+
 
 class CommonRemoteHeadMixin(CommonMixin):
     pass
@@ -114,6 +226,79 @@ class CommonGitObjectMixin(CommonMixin):
         return "%s: %s" % (self.type, self.id)
     __repr__ = __str__
 
+    @classmethod
+    def prefix_counts(cls, prefix):
+        """How many objects of each type have ids starting with prefix,
+        as a dict from type to count.  Prefixes of up to
+        max_counted_prefix digits are looked up in the counts the
+        indexer keeps (see count_new); longer ones are narrow enough
+        to count."""
+        prefix = prefix.lower()
+        if len(prefix) > max_counted_prefix:
+            counts = cls._count_prefix(prefix)
+        elif prefix:
+            counts = cls._counted_prefixes([prefix])
+        else:
+            counts = cls._counted_prefixes(list(hex_digits))
+        return dict((type, counts.get(type, 0)) for type in object_types)
+
+    @classmethod
+    def count_prefix(cls, prefix):
+        """How many objects have ids starting with prefix"""
+        return sum(cls.prefix_counts(prefix).itervalues())
+
+    @classmethod
+    def is_unique_prefix(cls, prefix):
+        """Whether exactly one object's id starts with prefix"""
+        return len(cls.first_ids(prefix, 2)) == 1
+
+    def unique_prefix_length(self):
+        """The length of the shortest prefix of our id that no other
+        object's starts with.  Only the ids either side of ours in
+        order can share more of it than that, so those are all we
+        look at (see GitObject.neighbours)."""
+        shared = [len(os.path.commonprefix([self.id, other]))
+                  for other in self.neighbours(self.id) if other is not None]
+        return max(shared + [0]) + 1
+
+    def abbreviation(self):
+        """Our id, shortened as far as it can be while still unique,
+        but no shorter than min_abbrev"""
+        return self.id[:max(min_abbrev, self.unique_prefix_length())]
+
+    # How many parents, commits, repositories and distinct names an
+    # object has.  The indexer stores these with the object (see
+    # GitObject.summarize), so list pages needn't count them; objects
+    # indexed before that are counted the slow way.
+
+    def parent_count(self):
+        if self.n_parents is not None:
+            return self.n_parents
+        return self.parent_ids.count()
+
+    def commit_count(self):
+        if self.n_commits is not None:
+            return self.n_commits
+        return self.commit_ids.count()
+
+    def repository_count(self):
+        if self.n_repositories is not None:
+            return self.n_repositories
+        return self.repository_ids.count()
+
+    def name_count(self):
+        if self.n_names is not None:
+            return self.n_names
+        return len(set(self.names))
+
+    def summary_version(self):
+        """Identifies what the indexer last summarized about us, for
+        keying cached renderings of the object.  Edges are only ever
+        added, and an object that gains one is summarized again, so
+        this changes whenever the rendering would."""
+        return '%s:%s:%s:%s' % (self.n_parents, self.n_commits,
+                                self.n_repositories, self.n_names)
+
     def validate(self):
         super(CommonGitObjectMixin, self).validate()
         if not self.id:
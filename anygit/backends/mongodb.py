@@ -1,11 +1,19 @@
+import bisect
+import contextlib
 import datetime
 import logging
 import pymongo
 import random
 import re
 import subprocess
+import threading
+import time
 
 from pymongo import son_manipulator
+try:
+    from bson.binary import Binary
+except ImportError:
+    from pymongo.binary import Binary
 from pylons import config
 
 from anygit.backends import common
@@ -16,8 +24,14 @@ logger = logging.getLogger(__name__)
 max_transaction_window = 1000
 curr_transaction_window = 0
 connection = None
+# Connections to every node, keyed by (host, port, slave_okay)
+connections = {}
+# Secondaries that read-only queries may go to
+read_replicas = []
 save_classes = []
 collection_to_class = {}
+# Per thread, whether reads are kept on the primaries (see primary_reads)
+_reads = threading.local()
 
 ## Exported functions
 
@@ -31,65 +45,265 @@ def create_schema():
     Repository._object_store.ensure_index('approved')
     Repository._object_store.ensure_index('count')
 
-def init_model(connection):
-    """Call me before using any of the tables or classes in the model."""
-    raw_db = getattr(connection, config.get('mongodb.db', 'anygit'))
-    db = getattr(connection, config.get('mongodb.db', 'anygit'))
+def init_model(connection, shards=None, read_connection=None):
+    """Call me before using any of the tables or classes in the model.
+
+    shards is a list of (start, connection, read_connection) triples,
+    as described in parse_shard_map, over which the git objects and
+    their associations are spread.  By default they all live on
+    connection, along with everything else.  If given, the read
+    connections are secondaries for read-only queries."""
+    if not shards:
+        shards = [('0', connection, read_connection)]
+    dbname = config.get('mongodb.db', 'anygit')
+    raw_db = getattr(connection, dbname)
+    db = getattr(connection, dbname)
     # Transform
     db.add_son_manipulator(TransformObject())
-
+    read_db = None
+    if read_connection is not None:
+        read_db = getattr(read_connection, dbname)
+        read_db.add_son_manipulator(TransformObject())
+
+    shard_map = ShardMap([start for start, shard_connection, shard_read_connection in shards])
+    raw_shard_dbs = []
+    shard_dbs = []
+    read_shard_dbs = []
+    for start, shard_connection, shard_read_connection in shards:
+        raw_shard_dbs.append(getattr(shard_connection, dbname))
+        shard_db = getattr(shard_connection, dbname)
+        shard_db.add_son_manipulator(TransformObject())
+        shard_dbs.append(shard_db)
+        if shard_read_connection is not None:
+            shard_db = getattr(shard_read_connection, dbname)
+            shard_db.add_son_manipulator(TransformObject())
+        read_shard_dbs.append(shard_db)
+    has_shard_replicas = any(shard_read_connection is not None
+                             for start, shard_connection, shard_read_connection in shards)
+
+    # Forget the collections of any earlier setup
+    del save_classes[:]
+    collection_to_class.clear()
     for obj in globals().itervalues():
         if type(obj) == type and issubclass(obj, MongoDbModel) and hasattr(obj, '__tablename__'):
             save_classes.append(obj)
+            obj._replica_object_store = None
             tablename = getattr(obj, '__tablename__')
-            obj._object_store = getattr(db, tablename)
-            obj._raw_object_store = getattr(raw_db, tablename)
-            collection_to_class[obj._object_store] = obj
-
-def setup():
+            if obj.sharded:
+                obj._object_store = ShardedCollection(shard_map,
+                                                      [getattr(d, tablename) for d in shard_dbs])
+                obj._raw_object_store = ShardedCollection(shard_map,
+                                                          [getattr(d, tablename) for d in raw_shard_dbs])
+                for collection in obj._object_store.collections:
+                    collection_to_class[collection] = obj
+                if has_shard_replicas:
+                    obj._replica_object_store = ShardedCollection(shard_map,
+                                                                  [getattr(d, tablename) for d in read_shard_dbs])
+                    for collection in obj._replica_object_store.collections:
+                        collection_to_class[collection] = obj
+            else:
+                obj._object_store = getattr(db, tablename)
+                obj._raw_object_store = getattr(raw_db, tablename)
+                collection_to_class[obj._object_store] = obj
+                if read_db is not None:
+                    obj._replica_object_store = getattr(read_db, tablename)
+                    collection_to_class[obj._replica_object_store] = obj
+
+def setup(replicas=False):
     """
-    Sets up the database session
+    Sets up the database session.  If replicas is True, read-only
+    queries go to the secondaries in mongodb.read_urls (and in the
+    shard map), so long as they are no more than mongodb.max_staleness
+    seconds behind.  Writes always go to the primaries.
     """
     global connection
+    # get_replica adds the secondaries we connect to below
+    del read_replicas[:]
     port = config.get('mongodb.port', None)
     if port:
         port = int(port)
-    connection = pymongo.Connection(config['mongodb.url'],
-                                    port)
-    init_model(connection)
+    connection = get_connection(config['mongodb.url'], port)
+    read_urls = config.get('mongodb.read_urls', '').split()
+    read_connection = None
+    if replicas and read_urls:
+        read_connection = get_replica(random.choice(read_urls))
+    shards = []
+    if config.get('mongodb.shards'):
+        for start, host, port, shard_replicas in parse_shard_map(config['mongodb.shards']):
+            shard_read_connection = None
+            if replicas and shard_replicas:
+                shard_read_connection = get_replica(random.choice(shard_replicas))
+            shards.append((start, get_connection(host, port), shard_read_connection))
+    init_model(connection, shards, read_connection)
 
 def flush():
     for klass in save_classes:
         if klass._save_list:
             logger.debug('Saving %d %s instances...' % (len(klass._save_list), klass.__name__))
 
-        for instance in klass._save_list:
-            try:
-                updates = instance.get_updates()
-                if klass.mutable:
-                    klass._object_store.update({'_id' : instance.id},
-                                               updates,
-                                               upsert=True)
-                else:
-                    updates.setdefault('_id', instance.id)
-                    klass._object_store.insert(updates)
-            except:
-                logger.critical('Had some trouble saving %s' % instance)
-                raise
-            instance.mark_saved()
-            instance.new = False
-            instance._pending_save = False
-            instance._changed = False
-            instance._pending_updates.clear()
+        for store, batch in shard_batches(klass):
+            for instance in batch:
+                try:
+                    updates = instance.get_updates()
+                    if klass.mutable:
+                        store.update({'_id' : instance.id},
+                                     updates,
+                                     upsert=True)
+                    else:
+                        updates.setdefault('_id', instance.id)
+                        store.insert(updates)
+                except:
+                    logger.critical('Had some trouble saving %s' % instance)
+                    raise
+                instance.mark_saved()
+                instance.new = False
+                instance._pending_save = False
+                instance._changed = False
+                instance._pending_updates.clear()
         klass._save_list = klass._save_list[0:0]
         klass._cache.clear()
 
 def destroy_session():
-    if connection is not None:
-        connection.disconnect()
+    for node in connections.itervalues():
+        node.disconnect()
+
+## Shard administration
+
+def shard_status():
+    """Yield (collection name, start, host, port, count) for each shard
+    of each sharded collection."""
+    if config.get('mongodb.shards'):
+        shards = parse_shard_map(config['mongodb.shards'])
+    else:
+        port = config.get('mongodb.port', None)
+        shards = [('0', config['mongodb.url'], port and int(port) or None, [])]
+    for tablename in sharded_tablenames():
+        for start, host, port, shard_replicas in shards:
+            collection = getattr(_raw_db(host, port), tablename)
+            yield tablename, start, host, port, collection.count()
+
+def migrate_shards(old_shards=None, dry_run=False, batch_size=1000):
+    """Move every document that isn't on the node that the configured
+    shard map (mongodb.shards) routes it to.
+
+    To rebalance, change the boundaries or add nodes in the config
+    and run this.  If nodes were removed, pass the previous map as
+    old_shards so that their documents are found.  Documents are
+    unreachable until they have been moved, so stop the indexer
+    first.  Returns the number of documents moved."""
+    new = parse_shard_map(config['mongodb.shards'])
+    if old_shards:
+        old = parse_shard_map(old_shards)
+    else:
+        old = new
+    sources = sorted(set((host, port) for start, host, port, shard_replicas in old))
+    starts = [start for start, host, port, shard_replicas in new]
+    moved = 0
+    for tablename in sharded_tablenames():
+        for source in sources:
+            src = getattr(_raw_db(*source), tablename)
+            for i, (start, host, port, shard_replicas) in enumerate(new):
+                if (host, port) == source:
+                    continue
+                spec = {'_id' : {'$gte' : start}}
+                if i + 1 < len(starts):
+                    spec['_id']['$lt'] = starts[i + 1]
+                if dry_run:
+                    count = src.find(spec).count()
+                    if count:
+                        logger.info('Would move %d %s from %s:%s to %s:%s' %
+                                    (count, tablename, source[0], source[1], host, port))
+                    moved += count
+                    continue
+                dest = getattr(_raw_db(host, port), tablename)
+                ids = []
+                for doc in src.find(spec):
+                    dest.save(doc, safe=True)
+                    ids.append(doc['_id'])
+                    if len(ids) >= batch_size:
+                        src.remove({'_id' : {'$in' : ids}}, safe=True)
+                        moved += len(ids)
+                        ids = []
+                if ids:
+                    src.remove({'_id' : {'$in' : ids}}, safe=True)
+                    moved += len(ids)
+                logger.info('Moved %s from %s:%s to %s:%s (%d so far)' %
+                            (tablename, source[0], source[1], host, port, moved))
+    return moved
 
 ## Internal functions
 
+def get_connection(host, port=None, slave_okay=False):
+    key = (host, port, slave_okay)
+    if key not in connections:
+        connections[key] = pymongo.Connection(host, port, slave_okay=slave_okay)
+    return connections[key]
+
+def parse_address(address):
+    host, _, port = address.partition(':')
+    return host, port and int(port) or None
+
+def get_replica(address):
+    """Connect to the secondary at address (host[:port]) for reads"""
+    host, port = parse_address(address)
+    replica_connection = get_connection(host, port, slave_okay=True)
+    max_staleness = float(config.get('mongodb.max_staleness', 60))
+    read_replicas.append(Replica(replica_connection, max_staleness))
+    return replica_connection
+
+def replicas_fresh():
+    return all(replica.fresh() for replica in read_replicas)
+
+@contextlib.contextmanager
+def primary_reads():
+    """Keep this thread's reads on the primaries for the duration, for
+    reads of what is about to be written back or was only just
+    written, which a secondary may not have yet."""
+    depth = getattr(_reads, 'primary', 0)
+    _reads.primary = depth + 1
+    try:
+        yield
+    finally:
+        _reads.primary = depth
+
+def _raw_db(host, port=None):
+    return getattr(get_connection(host, port), config.get('mongodb.db', 'anygit'))
+
+def parse_shard_map(value):
+    """Parse a shard map like '0=db1:27017 8=db2:27017,db2b:27017'.
+    Each entry gives the lowest sha1 prefix a node holds, and the node
+    holds everything up to the next entry's prefix.  Any further
+    addresses are secondaries of that node.  Returns a sorted list of
+    (start, host, port, secondaries) tuples."""
+    shards = []
+    for entry in value.split():
+        try:
+            start, addresses = entry.split('=', 1)
+        except ValueError:
+            raise exceptions.Error('Malformed shard map entry %s' % entry)
+        addresses = addresses.split(',')
+        host, port = parse_address(addresses[0])
+        shards.append((start.lower(), host, port, addresses[1:]))
+    shards.sort()
+    if not shards or shards[0][0].strip('0'):
+        raise exceptions.Error('The shard map must start at 0')
+    return shards
+
+def sharded_tablenames():
+    return sorted(set(klass.__tablename__ for klass in save_classes if klass.sharded))
+
+def shard_batches(klass):
+    """Split klass's save list into (collection, instances) batches,
+    one per shard."""
+    store = klass._object_store
+    if not klass.sharded:
+        return [(store, klass._save_list)]
+    batches = {}
+    for instance in klass._save_list:
+        batches.setdefault(store.shard_map.route(instance.id), []).append(instance)
+    return [(store.collections[shard], batch)
+            for shard, batch in sorted(batches.iteritems())]
+
 def classify(string):
     """Convert a class name to the corresponding class"""
     mapping = {'repository' : Repository,
@@ -126,17 +340,6 @@ def canonicalize_to_object(id, cls=None):
         raise exceptions.Error('Illegal type %s (instance %r)' % (type(id), id))
     return id, obj
 
-def sanitize_unicode(u):
-    if isinstance(u, str):
-        try:
-            return unicode(u, 'utf-8')
-        except UnicodeDecodeError:
-            sanitized = unicode(u, 'iso-8859-1')
-            logger.info('Invalid unicode detected: %r.  Assuming iso-8859-1 (%s)' % (u, sanitized))
-            return sanitized
-    else:
-        return u
-
 def convert_iterable(target, dest):
     if not hasattr(target, '__iter__'):
         return target
@@ -235,9 +438,235 @@ class Map(object):
         return Map(self.result.limit(limit), self.fun, self._count)
 
 
+class ShardMap(object):
+    """Routes sha1s, and anything whose id starts with a sha1, to the
+    shard holding that part of the keyspace."""
+    def __init__(self, starts):
+        # starts[i] is the lowest prefix held by shard i
+        self.starts = starts
+
+    def route(self, id):
+        return max(bisect.bisect_right(self.starts, id) - 1, 0)
+
+    def route_prefix(self, prefix):
+        """The shards that might hold ids starting with prefix"""
+        low = self.route(prefix.ljust(40, '0'))
+        high = self.route(prefix.ljust(40, 'f'))
+        return range(low, high + 1)
+
+
+class ShardedCollection(object):
+    """Stands in for a pymongo collection whose documents are spread
+    over several shards by _id.  Queries on a single _id or an $in
+    list of them go only to the shards involved; anything else is
+    scattered to every shard."""
+    def __init__(self, shard_map, collections):
+        self.shard_map = shard_map
+        self.collections = collections
+
+    def shard_for(self, id):
+        return self.collections[self.shard_map.route(id)]
+
+    def _route(self, spec):
+        """Split spec into (collection, spec) pairs which together
+        cover it."""
+        id = spec and spec.get('_id')
+        if isinstance(id, basestring):
+            return [(self.shard_for(id), spec)]
+        elif isinstance(id, dict) and id.keys() == ['$in']:
+            groups = {}
+            for i in id['$in']:
+                groups.setdefault(self.shard_map.route(i), []).append(i)
+            routed = []
+            for shard, ids in sorted(groups.iteritems()):
+                shard_spec = dict(spec)
+                shard_spec['_id'] = {'$in' : ids}
+                routed.append((self.collections[shard], shard_spec))
+            return routed
+        else:
+            return [(collection, spec) for collection in self.collections]
+
+    def find(self, spec=None, fields=None):
+        return ShardedCursor([collection.find(shard_spec, fields=fields)
+                              for collection, shard_spec in self._route(spec)])
+
+    def find_prefix(self, prefix, fields=None):
+        """Find the documents whose _id starts with prefix"""
+        spec = {'_id' : re.compile('^%s' % re.escape(prefix))}
+        return ShardedCursor([self.collections[shard].find(spec, fields=fields)
+                              for shard in self.shard_map.route_prefix(prefix)])
+
+    def find_prefixes(self, prefixes, fields=None):
+        """Find the documents whose _id starts with any of prefixes
+        (which are hex), with one query per shard"""
+        groups = {}
+        for prefix in prefixes:
+            for shard in self.shard_map.route_prefix(prefix):
+                groups.setdefault(shard, []).append(prefix)
+        cursors = []
+        for shard, group in sorted(groups.iteritems()):
+            # Each range holds just the ids starting with its prefix
+            spec = {'$or' : [{'_id' : {'$gte' : prefix, '$lt' : prefix + 'g'}}
+                             for prefix in group]}
+            cursors.append(self.collections[shard].find(spec, fields=fields))
+        return ShardedCursor(cursors)
+
+    def neighbours(self, id):
+        """The _ids just before and after id in order, or None at
+        either end, looking beyond id's shard only as far as need
+        be."""
+        shard = self.shard_map.route(id)
+        before = after = None
+        for collection in reversed(self.collections[:shard + 1]):
+            for doc in collection.find({'_id' : {'$lt' : id}}, fields=['_id']).sort(
+                '_id', pymongo.DESCENDING).limit(1):
+                before = doc['_id']
+            if before is not None:
+                break
+        for collection in self.collections[shard:]:
+            for doc in collection.find({'_id' : {'$gt' : id}}, fields=['_id']).sort(
+                '_id', pymongo.ASCENDING).limit(1):
+                after = doc['_id']
+            if after is not None:
+                break
+        return before, after
+
+    def find_one(self, spec=None):
+        for doc in self.find(spec).limit(1):
+            return doc
+        return None
+
+    def update(self, spec, document, upsert=False):
+        for collection, shard_spec in self._route(spec):
+            collection.update(shard_spec, document, upsert=upsert)
+
+    def insert(self, document):
+        self.shard_for(document['_id']).insert(document)
+
+    def remove(self, spec=None):
+        for collection, shard_spec in self._route(spec):
+            collection.remove(shard_spec)
+
+    def ensure_index(self, key):
+        for collection in self.collections:
+            collection.ensure_index(key)
+
+    def index_information(self):
+        # Every shard has the same indexes
+        return self.collections[0].index_information()
+
+    def drop_index(self, name):
+        for collection in self.collections:
+            collection.drop_index(name)
+
+
+class ShardedCursor(object):
+    """Gathers the results of a query scattered over several shards,
+    with the subset of the pymongo cursor interface the models use.
+    As with a pymongo cursor, count() ignores skip and limit."""
+    def __init__(self, cursors, skip=0, limit=0):
+        self.cursors = cursors
+        self._skip = skip
+        self._limit = limit
+        self._iterator = None
+
+    def count(self):
+        return sum(cursor.count() for cursor in self.cursors)
+
+    def skip(self, skip):
+        return ShardedCursor(self.cursors, skip, self._limit)
+
+    def limit(self, limit):
+        return ShardedCursor(self.cursors, self._skip, limit)
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        """Sort by _id.  The shards hold ranges of _id in order, so
+        that is just sorting each of them."""
+        assert key == '_id'
+        cursors = [cursor.sort(key, direction) for cursor in self.cursors]
+        if direction == pymongo.DESCENDING:
+            cursors.reverse()
+        return ShardedCursor(cursors, self._skip, self._limit)
+
+    def _gather(self):
+        skip = self._skip
+        remaining = self._limit or None
+        for cursor in self.cursors:
+            if skip:
+                # Pass over whole shards without fetching from them
+                count = cursor.count()
+                if count <= skip:
+                    skip -= count
+                    continue
+                cursor = cursor.skip(skip)
+                skip = 0
+            if remaining is not None:
+                cursor = cursor.limit(remaining)
+            for doc in cursor:
+                yield doc
+                if remaining is not None:
+                    remaining -= 1
+                    if not remaining:
+                        return
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iterator is None:
+            self._iterator = self._gather()
+        return self._iterator.next()
+
+
+class Replica(object):
+    """A secondary that can serve reads so long as it isn't lagging
+    too far behind its primary.  The lag is checked at most every
+    check_interval seconds."""
+    check_interval = 10
+
+    def __init__(self, connection, max_staleness):
+        self.connection = connection
+        self.max_staleness = max_staleness
+        self._checked = 0
+        self._fresh = False
+
+    def lag(self):
+        """How many seconds this secondary is behind its primary"""
+        status = self.connection.admin.command('replSetGetStatus')
+        primary = own = None
+        for member in status['members']:
+            if member.get('self'):
+                own = member['optimeDate']
+            if member.get('stateStr') == 'PRIMARY':
+                primary = member['optimeDate']
+        if primary is None or own is None:
+            raise Error('No primary in replica set status %s' % status)
+        delta = primary - own
+        return delta.days * 86400 + delta.seconds
+
+    def fresh(self):
+        now = time.time()
+        if now - self._checked > self.check_interval:
+            self._checked = now
+            try:
+                lag = self.lag()
+            except Exception, e:
+                logger.warning('Could not check replica lag, reading from the primary: %s' % e)
+                self._fresh = False
+            else:
+                self._fresh = lag <= self.max_staleness
+                if not self._fresh:
+                    logger.warning('Replica is %d seconds behind, reading from the primary' % lag)
+        return self._fresh
+
+
 class MongoDbModel(object):
     # Should provide these in subclasses
     mutable = True
+    # Spread over the shards in mongodb.shards
+    sharded = False
+    # Set by init_model if there are secondaries to read from
+    _replica_object_store = None
     _cache = {}
     _save_list = None
     batched = True
@@ -289,15 +718,42 @@ class MongoDbModel(object):
     def _add_to_set(self, set_name, value):
         return self._add_all_to_set(set_name, set([value]))
 
+    def increment(self, attr, amount=1):
+        """Add amount to attr.  This is written with $inc, so
+        concurrent increments from several indexers all count; the
+        new value is only seen once reloaded."""
+        assert self.mutable
+        if not amount:
+            return
+        setting = self._pending_updates.get('$set', {})
+        if attr in setting:
+            # Can't both $set and $inc a field
+            setting[attr] += amount
+        else:
+            incrementing = self._pending_updates.setdefault('$inc', {})
+            incrementing[attr] = incrementing.get(attr, 0) + amount
+        self._changed = True
+        self.save()
+
     @property
     def type(self):
         return type(self).__name__.lower()
 
+    @classmethod
+    def _read_store(cls):
+        """The collection for read-only queries that can stand to be
+        a little stale: a secondary, when there is a fresh one."""
+        if (cls._replica_object_store is not None and not getattr(_reads, 'primary', 0)
+            and replicas_fresh()):
+            return cls._replica_object_store
+        else:
+            return cls._object_store
+
     @classmethod
     def find(cls, kwargs):
         if cls.has_type:
             kwargs.setdefault('type', cls.__name__.lower())
-        return cls._object_store.find(kwargs)
+        return cls._read_store().find(kwargs)
 
     @classmethod
     def get(cls, id):
@@ -406,7 +862,7 @@ class MongoDbModel(object):
     def find_matching(cls, ids, **kwargs):
         """Given a list of ids, find the matching objects"""
         kwargs.update({'_id' : { '$in' : list(ids) }})
-        return cls._object_store.find(kwargs)
+        return cls._read_store().find(kwargs)
 
     def get_updates(self):
         # Hack to add *something* for new insertions
@@ -441,6 +897,8 @@ class MongoDbModel(object):
 
 class GitObjectAssociation(MongoDbModel, common.CommonMixin):
     mutable = False
+    # The id starts with key1, so these live alongside key1's object
+    sharded = True
     has_type = False
     key1_name = None
     key2_name = None
@@ -466,8 +924,7 @@ class GitObjectAssociation(MongoDbModel, common.CommonMixin):
 
     @classmethod
     def get_all(cls, sha1):
-        safe_sha1 = '^%s' % re.escape(sha1)
-        return cls._object_store.find({'_id' : re.compile(safe_sha1)})
+        return cls._read_store().find_prefix(sha1)
 
     def __str__(self):
         return '%s: %s=%s, %s=%s' % (self.type,
@@ -561,22 +1018,31 @@ class GitObject(MongoDbModel, common.CommonGitObjectMixin):
     # Attributes: repository_ids, tag_ids, dirty
     __tablename__ = 'git_objects'
     has_type = True
+    sharded = True
     _save_list = []
     _cache = {}
     _repository_ids = make_persistent_set()
     dirty = make_persistent_attribute('dirty')
     # Has been completely indexed in at least one repo
     complete = make_persistent_attribute('complete')
+    # Counts for list pages; see summarize
+    n_parents = make_persistent_attribute('n_parents')
+    n_commits = make_persistent_attribute('n_commits')
+    n_repositories = make_persistent_attribute('n_repositories')
+    n_names = make_persistent_attribute('n_names')
 
     @classmethod
     def lookup_by_sha1(cls, sha1, partial=False, offset=0, limit=10):
         # TODO: might want to disable lookup for dirty objects, or something
         if partial:
-            safe_sha1 = '^%s' % re.escape(sha1)
-            results = cls._object_store.find({'_id' : re.compile(safe_sha1)})
+            results = cls._read_store().find_prefix(sha1)
         else:
-            results = cls._object_store.find({'_id' : sha1})
-        count = results.count()
+            results = cls._read_store().find({'_id' : sha1})
+        if partial and len(sha1) <= common.max_counted_prefix:
+            # Far too many to count
+            count = cls.count_prefix(sha1)
+        else:
+            count = results.count()
         return results.skip(offset).limit(limit), count
 
     @classmethod
@@ -586,12 +1052,170 @@ class GitObject(MongoDbModel, common.CommonGitObjectMixin):
         else:
             return cls._object_store.find({'type' : cls.__name__.lower()})
 
+    @classmethod
+    def known_ids(cls, ids, repository=None):
+        """The subset of ids that are already in the database (and,
+        if repository is given, already in that repository)."""
+        spec = {'_id' : {'$in' : list(ids)}}
+        if repository is not None:
+            spec['_repository_ids'] = canonicalize_to_id(repository)
+        return set(doc['_id'] for doc in cls._raw_object_store.find(spec, fields=['_id']))
+
     def mark_dirty(self, value):
         # Just finished indexing, apparently.
         if not value:
             self.complete = True
         self.dirty = value
 
+    @classmethod
+    def summarize(cls, ids):
+        """Count the parents, commits, repositories and distinct names
+        of each of ids, as a dict from id to set_summary arguments.
+        The edges of all of them are read at once, with one query per
+        shard of each kind of edge."""
+        docs = list(cls._raw_object_store.find({'_id' : {'$in' : list(ids)}},
+                                               fields=['type', '_repository_ids', 'parent_ids']))
+        # The edges leaving an object live next to it, keyed by its id
+        names = {}
+        commits = {}
+        for parents, type in ((BlobTree, 'blob'), (TreeParentTree, 'tree')):
+            prefixes = [doc['_id'] for doc in docs if doc.get('type') == type]
+            if not prefixes:
+                continue
+            for edge in parents._raw_object_store.find_prefixes(prefixes, fields=['name']):
+                names.setdefault(edge['_id'][:40], []).append(edge.get('name'))
+            if type == 'tree':
+                for edge in TreeCommit._raw_object_store.find_prefixes(prefixes, fields=['_id']):
+                    id = edge['_id'][:40]
+                    commits[id] = commits.get(id, 0) + 1
+        summaries = {}
+        for doc in docs:
+            id = doc['_id']
+            summary = {'parents' : 0, 'commits' : 0, 'names' : 0,
+                       'repositories' : len(doc.get('_repository_ids') or [])}
+            type = doc.get('type')
+            if type == 'commit':
+                summary['parents'] = len(doc.get('parent_ids') or [])
+            elif type in ('blob', 'tree'):
+                summary['parents'] = len(names.get(id, ()))
+                summary['names'] = len(set(names.get(id, ())))
+                summary['commits'] = commits.get(id, 0)
+            summaries[id] = summary
+        return summaries
+
+    def set_summary(self, parents, commits, repositories, names):
+        self.n_parents = parents
+        self.n_commits = commits
+        self.n_repositories = repositories
+        self.n_names = names
+
+    @classmethod
+    def first_ids(cls, prefix, limit):
+        """The first limit ids starting with prefix, in order"""
+        docs = cls._read_store().find_prefix(prefix.lower(), fields=['_id'])
+        return [doc['_id'] for doc in docs.sort('_id').limit(limit)]
+
+    @classmethod
+    def neighbours(cls, id):
+        """The ids just before and after id in order, or None at either
+        end.  Each is one step along the _id index."""
+        return GitObject._raw_object_store.neighbours(id)
+
+    @classmethod
+    def count_new(cls, pairs):
+        """Add the (id, type) pairs of objects new to the database to
+        the prefix counts, with one $inc for each first digit"""
+        increments = {}
+        for prefix, by_type in common.count_prefixes(pairs).iteritems():
+            inc = increments.setdefault(prefix[0], {})
+            for type, count in by_type.iteritems():
+                inc['%s.%s_count' % (prefix, type)] = count
+        for digit, inc in increments.iteritems():
+            PrefixCount._raw_object_store.update({'_id' : digit}, {'$inc' : inc}, upsert=True)
+
+    @classmethod
+    def migrate_prefix_counts(cls):
+        """Convert prefix counts kept in the old format, a document per
+        prefix with blob_count, tree_count, etc., to the current one
+        (see PrefixCount).  Run it with the indexers stopped.  It can
+        be run again if interrupted, as the old documents only go once
+        their counts are copied.  Returns how many prefixes it moved."""
+        store = PrefixCount._raw_object_store
+        fields = ['%s_count' % type for type in common.object_types]
+        sets = {}
+        old = []
+        for doc in store.find():
+            counts = dict((field, doc[field]) for field in fields if field in doc)
+            if not counts:
+                continue
+            prefix = doc['_id']
+            setting = sets.setdefault(prefix[0], {})
+            for field, count in counts.iteritems():
+                setting['%s.%s' % (prefix, field)] = count
+            old.append(prefix)
+        for digit, setting in sets.iteritems():
+            store.update({'_id' : digit}, {'$set' : setting}, upsert=True, safe=True)
+        for prefix in old:
+            if len(prefix) > 1:
+                store.remove({'_id' : prefix}, safe=True)
+            else:
+                # Now the document for its digit
+                store.update({'_id' : prefix}, {'$unset' : dict((field, 1) for field in fields)},
+                             safe=True)
+        return len(old)
+
+    @classmethod
+    def _counted_prefixes(cls, prefixes):
+        counts = {}
+        digits = list(set(prefix[0] for prefix in prefixes))
+        docs = PrefixCount._raw_object_store.find({'_id' : {'$in' : digits}}, fields=list(prefixes))
+        for doc in docs:
+            for prefix in prefixes:
+                by_type = doc.get(prefix) or {}
+                for type in common.object_types:
+                    counts[type] = counts.get(type, 0) + by_type.get('%s_count' % type, 0)
+        return counts
+
+    @classmethod
+    def _count_prefix(cls, prefix):
+        counts = {}
+        for doc in cls._read_store().find_prefix(prefix, fields=['type']):
+            counts[doc['type']] = counts.get(doc['type'], 0) + 1
+        return counts
+
+    @classmethod
+    def recount_prefixes(cls):
+        """Rebuild the prefix counts from scratch"""
+        counts = common.count_prefixes((doc['_id'], doc['type']) for doc in
+                                       cls._raw_object_store.find({}, fields=['type']))
+        docs = {}
+        for prefix, by_type in counts.iteritems():
+            doc = docs.setdefault(prefix[0], {'_id' : prefix[0]})
+            doc[prefix] = dict(('%s_count' % type, count) for type, count in by_type.iteritems())
+        PrefixCount._raw_object_store.remove()
+        for doc in docs.itervalues():
+            PrefixCount._raw_object_store.insert(doc)
+
+    @classmethod
+    def last_indexed(cls, ids):
+        """When the repositories holding any of ids were last indexed,
+        and how many (object, repository) pairs there are among them,
+        as (latest last_index, count).  Either changes when the
+        objects are indexed again."""
+        repository_ids = []
+        for doc in cls._raw_object_store.find({'_id' : {'$in' : list(ids)}},
+                                              fields=['_repository_ids']):
+            repository_ids.extend(doc.get('_repository_ids') or [])
+        if not repository_ids:
+            return None, 0
+        docs = Repository._raw_object_store.find({'_id' : {'$in' : list(set(repository_ids))}},
+                                                 fields=['last_index'])
+        # The repositories may have been removed since
+        times = [doc['last_index'] for doc in docs if doc.get('last_index')]
+        if not times:
+            return None, len(repository_ids)
+        return max(times), len(repository_ids)
+
     @property
     def repository_ids(self):
         return Map(self._repository_ids, lambda x: x, count=len(self._repository_ids))    
@@ -620,7 +1244,7 @@ class Blob(GitObject, common.CommonBlobMixin):
     object)"""
 
     def add_parent(self, parent_id, name, mode):
-        name = sanitize_unicode(name)
+        name = common.sanitize_unicode(name)
         parent_id = canonicalize_to_id(parent_id)
         b = BlobTree(key1=self.id, key2=parent_id)
         b.name = name
@@ -670,7 +1294,7 @@ class Tree(GitObject, common.CommonTreeMixin):
     def add_parent(self, parent_id, name, mode):
         """Give this tree a parent.  Also updates the parent to know
         about this tree."""
-        name = sanitize_unicode(name)
+        name = common.sanitize_unicode(name)
         parent_id = canonicalize_to_id(parent_id)
         b = TreeParentTree(key1=self.id, key2=parent_id)
         b.name = name
@@ -759,7 +1383,7 @@ class Commit(GitObject, common.CommonCommitMixin):
 
     def add_as_submodule_of(self, tree_id, name, mode):
         tree_id = canonicalize_to_id(tree_id)
-        name = sanitize_unicode(name)
+        name = common.sanitize_unicode(name)
         b = CommitTree(key1=self.id, key2=tree_id)
         b.name = name
         b.mode = mode
@@ -788,33 +1412,126 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
     _save_list = []
     __tablename__ = 'repositories'
 
-    # Attributes: url, last_index, indexing, commit_ids
+    # Attributes: url, last_index, last_validated, lease_owner, lease_expires, commit_ids
     url = make_persistent_attribute('url')
     last_index = make_persistent_attribute('last_index', default=datetime.datetime(1970,1,1))
-    indexing = make_persistent_attribute('indexing', default=False)
+    # When we last found it unchanged (or reachable), without indexing it
+    last_validated = make_persistent_attribute('last_validated')
+    # Who is indexing it, and until when.  These are only written by
+    # claim_lease and friends, straight to the database.
+    lease_owner = make_persistent_attribute('lease_owner')
+    lease_expires = make_persistent_attribute('lease_expires')
     remote_heads = make_persistent_attribute('remote_heads')
     new_remote_heads = make_persistent_attribute('new_remote_heads')
     been_indexed = make_persistent_attribute('been_indexed', default=False)
     approved = make_persistent_attribute('approved', default=False)
     count = make_persistent_attribute('count', default=0)
+    # A HyperLogLog sketch of the objects, for estimating count
+    sketch = make_persistent_attribute('sketch')
+    # Change detection state; see anygit.client.scheduler
+    requested = make_persistent_attribute('requested', default=False)
+    poll_interval = make_persistent_attribute('poll_interval')
+    next_poll = make_persistent_attribute('next_poll')
+    change_rate = make_persistent_attribute('change_rate')
+    # How far we got through the pack being indexed; see set_checkpoint
+    checkpoint_pack = make_persistent_attribute('checkpoint_pack')
+    checkpoint_checksum = make_persistent_attribute('checkpoint_checksum')
+    checkpoint_phase = make_persistent_attribute('checkpoint_phase')
+    checkpoint_offset = make_persistent_attribute('checkpoint_offset')
+
+    # Set on every new repository, as create would
+    _defaults = ('last_index', 'been_indexed', 'count', 'requested', 'remote_heads')
+
+    @classmethod
+    def _existing_ids(cls, ids):
+        return set(doc['_id'] for doc in cls._raw_object_store.find({'_id' : {'$in' : ids}},
+                                                                    fields=['_id']))
 
-    def __init__(self, *args, **kwargs):
-        super(Repository, self).__init__(*args, **kwargs)
-        # Hack to default this, thus persisting it.
-        self.indexing
+    @classmethod
+    def _new_document(cls, id, url, approved):
+        """The fields a new repository for url is saved with"""
+        repo = cls(id=id, url=url)
+        for attr in cls._defaults:
+            # Reading an attribute sets its default
+            getattr(repo, attr)
+        repo.approved = approved
+        return dict(repo.get_updates()['$set'])
+
+    @classmethod
+    def _register_batch(cls, rows, approved):
+        existing = cls._existing_ids([id for id, url in rows])
+        added = 0
+        for id, url in rows:
+            if id in existing:
+                continue
+            # Anyone registering the same one meanwhile gets there
+            # first, and theirs is left be
+            result = cls._raw_object_store.update(
+                {'_id' : id}, {'$setOnInsert' : cls._new_document(id, url, approved)},
+                upsert=True, safe=True)
+            if result and not result.get('updatedExisting'):
+                added += 1
+        return added
 
     @classmethod
     def get_indexed_before(cls, date):
         """Get all repos indexed before the given date and not currently
         being indexed."""
         # Hack: should be lazier about this.
+        spec = cls._lease_free()
+        spec['approved'] = True
         if date is not None:
-            return cls._object_store.find({'last_index' : {'$lt' : date},
-                                           'indexing' : False,
-                                           'approved' : True})
-        else:
-            return cls._object_store.find({'approved' : True,
-                                           'indexing' : False})
+            spec['last_index'] = {'$lt' : date}
+        return cls._object_store.find(spec)
+
+    @classmethod
+    def _lease_free(cls, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        # Also matches a missing or null expiry
+        return {'lease_expires' : {'$not' : {'$gte' : now}}}
+
+    def _update_lease(self, spec, owner, expires):
+        spec['_id'] = self.id
+        result = self._raw_object_store.update(spec,
+                                               {'$set' : {'lease_owner' : owner,
+                                                          'lease_expires' : expires}},
+                                               safe=True)
+        return bool(result and result.get('updatedExisting'))
+
+    def claim_lease(self, owner, duration):
+        """Atomically take the lease on indexing this repository for
+        duration seconds, unless someone else holds it.  Returns
+        whether we got it."""
+        now = datetime.datetime.now()
+        return self._update_lease(self._lease_free(now), owner,
+                                  now + datetime.timedelta(seconds=duration))
+
+    def renew_lease(self, owner, duration):
+        """Extend owner's lease by duration seconds from now.  Returns
+        False if owner no longer holds it."""
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=duration)
+        return self._update_lease({'lease_owner' : owner}, owner, expires)
+
+    def release_lease(self, owner=None):
+        """Give up owner's lease; with no owner, whoever holds it."""
+        spec = {}
+        if owner is not None:
+            spec['lease_owner'] = owner
+        return self._update_lease(spec, None, None)
+
+    @classmethod
+    def reap_leases(cls, all=False):
+        """Reclaim the leases of indexers that stopped renewing them
+        (or, if all, every lease).  Returns how many were reclaimed."""
+        spec = {'lease_owner' : {'$ne' : None}}
+        if not all:
+            spec['lease_expires'] = {'$lt' : datetime.datetime.now()}
+        result = cls._raw_object_store.update(spec,
+                                              {'$set' : {'lease_owner' : None,
+                                                         'lease_expires' : None}},
+                                              multi=True, safe=True)
+        return result and result.get('n', 0) or 0
 
     @classmethod
     def get_by_highest_count(cls, n=None, descending=True):
@@ -822,7 +1539,7 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
             order = pymongo.DESCENDING
         else:
             order = pymongo.ASCENDING
-        base = cls._object_store.find().sort('count', order)
+        base = cls._read_store().find().sort('count', order)
         if n:
             full = base.limit(n)
         else:
@@ -835,6 +1552,13 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
     def count_objects(self):
         return GitObject._object_store.find({'_repository_ids' : self.id}).count()
 
+    def object_ids(self):
+        return (doc['_id'] for doc in GitObject._raw_object_store.find({'_repository_ids' : self.id},
+                                                                       fields=['_id']))
+
+    def set_sketch(self, sketch):
+        self.sketch = Binary(sketch.to_string())
+
     def set_new_remote_heads(self, new_remote_heads):
         self.new_remote_heads = list(new_remote_heads)
 
@@ -845,10 +1569,24 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
         return 'Repository: %s' % self.url
 
 
+class PrefixCount(MongoDbModel):
+    """How many objects of each type there are with each short
+    prefix.  There is a document for each first digit (the _id),
+    holding a subdocument for each prefix starting with it, with
+    blob_count, tree_count, etc.  Kept by GitObject.count_new, so
+    that an indexed batch is counted in at most 16 updates.
+
+    Databases whose counts were kept before this layout (a document
+    per prefix) need converting, with bin/aggregator migrate-prefixes
+    (see GitObject.migrate_prefix_counts), or recounting, with
+    bin/aggregator reconcile."""
+    __tablename__ = 'prefix_counts'
+    _save_list = []
+
+
 class Aggregate(MongoDbModel, common.CommonMixin):
     """Singleton class that contains aggregate data about the indexer"""
     __tablename__ = 'aggregate'
-    instance = None
     _save_list = []
 
     indexed_repository_count = make_persistent_attribute('indexed_repository_count', default=0)
@@ -856,6 +1594,9 @@ class Aggregate(MongoDbModel, common.CommonMixin):
     tree_count = make_persistent_attribute('tree_count', default=0)
     commit_count = make_persistent_attribute('commit_count', default=0)
     tag_count = make_persistent_attribute('tag_count', default=0)
+    # From the last index_all schedule
+    queue_depth = make_persistent_attribute('queue_depth', default=0)
+    change_rate = make_persistent_attribute('change_rate', default=0.0)
 
     class index_executor(object):
         def __init__(self, klass, field):
@@ -879,21 +1620,21 @@ class Aggregate(MongoDbModel, common.CommonMixin):
 
     @classmethod
     def get(cls):
-        if not cls.instance:
-            try:
-                cls.instance = super(Aggregate, cls).get(id='main')
-            except exceptions.DoesNotExist:
-                cls.instance = cls.create(id='main')
-                flush()
-        return cls.instance
+        # Not cached on the class, since the indexers keep the counts
+        # moving.
+        try:
+            return super(Aggregate, cls).get(id='main')
+        except exceptions.DoesNotExist:
+            instance = cls.create(id='main')
+            flush()
+            return instance
 
     def refresh_all_counts(self, all=None):
         if all:
-            with Aggregate.index_executor(GitObject, 'repository_ids'):
+            with Aggregate.index_executor(GitObject, '_repository_ids'):
                 for repo in Repository.all():
-                    count = repo.count_objects()
-                    repo.set_count(count)
-                    logger.info('Setting count for %s to %d' % (repo, count))
+                    repo.rebuild_sketch()
+                    logger.info('Setting count for %s to %d' % (repo, repo.count))
                     repo.save()
 
         with Aggregate.index_executor(Repository, 'been_indexed'):
@@ -909,5 +1650,6 @@ class Aggregate(MongoDbModel, common.CommonMixin):
             self.tag_count = Tag.find({}).count()
             logger.info('Also, there are %d blobs, %d trees, %d commits, and %d tags' %
                         (self.blob_count, self.tree_count, self.commit_count, self.tag_count))
+        GitObject.recount_prefixes()
         self.save()
         flush()
@@ -1,9 +1,13 @@
+import binascii
+import contextlib
 import datetime
 import logging
+import os
 from pylons import config
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext import declarative
+import tempfile
 
 from anygit.backends import common
 from anygit.data import exceptions
@@ -17,104 +21,309 @@ Metadata = Base.metadata
 
 max_transaction_window = 10000
 curr_transaction_window = 0
+bulk_loader = None
+# Git objects saved since the last flush
+save_list = []
+
+## Exported functions
 
 def create_schema():
     Metadata.create_all(bind=Engine)
 
-def init_model(engine):
-    """Call me before using any of the tables or classes in the model."""
-    global Session, Engine
+def init_model(engine, bulk_load='executemany'):
+    """Call me before using any of the tables or classes in the model.
+
+    Git objects and their associations are always written through the
+    bulk loader, which is how the indexer batches its writes with
+    either backend; bulk_load only picks the method it writes them
+    with (see BulkLoader).  Repositories and the aggregate go through
+    the ORM session."""
+    global Session, Engine, bulk_loader
 
     Engine = engine
 
     sm = orm.sessionmaker(autoflush=True, autocommit=False, bind=engine)
     Session = orm.scoped_session(sm)
+    bulk_loader = BulkLoader(engine, method=bulk_load)
 
-def setup():
+def setup(replicas=False):
     """
-    Sets up the database session
+    Sets up the database session.  There is only the one database, so
+    replicas is ignored.
     """
     engine = sa.engine_from_config(config, 'sqlalchemy.', pool_recycle=60)
-    init_model(engine)
+    # Either 'executemany' or 'load_data'.  The latter needs
+    # local_infile=1 on the MySQL connection (e.g. via the
+    # sqlalchemy.url query string).
+    init_model(engine, bulk_load=config.get('mysql.bulk_load', 'executemany'))
+
+@contextlib.contextmanager
+def primary_reads():
+    """There is only the one database, so this is a no-op; see the
+    mongodb backend's."""
+    yield
 
 def flush():
     logger.debug('Committing...')
     Session.commit()
+    bulk_loader.flush()
+    for instance in save_list:
+        instance.mark_saved()
+    del save_list[:]
+    for klass in (GitObject, Blob, Tree, Commit, Tag):
+        klass._cache.clear()
 
 def destroy_session():
-    database.Session.remove()
+    if Session is not None:
+        Session.remove()
+
+## Internal functions
 
-def canonicalize(obj_or_sha1):
+def canonicalize_to_id(obj_or_sha1):
     if isinstance(obj_or_sha1, basestring):
-        obj_or_sha1 = GitObject.get_or_create(id=obj_or_sha1)
-    return obj_or_sha1
+        return obj_or_sha1
+    return obj_or_sha1.id
 
-# Join table for commit -> repositories mapping
-commits_repositories = sa.Table(
-    'commits_repositories',
-    Base.metadata,
-    sa.Column('commit_id',
-              sa.ForeignKey('commits.id'),
-              primary_key=True),
-    sa.Column('repository_id',
-              sa.ForeignKey('repositories.id'),
-              primary_key=True))
-
-# Join table for blob -> commits mapping
-blobs_commits = sa.Table(
-    'blobs_commits',
-    Base.metadata,
-    sa.Column('blob_id',
-              sa.ForeignKey('blobs.id'),
-              primary_key=True),
-    sa.Column('commit_id',
-              sa.ForeignKey('commits.id'),
-              primary_key=True))
-
-# Join table for tree -> commits mapping
-trees_commits = sa.Table(
-    'trees_commits',
-    Base.metadata,
-    sa.Column('tree_id',
-              sa.ForeignKey('trees.id'),
-              primary_key=True),
-    sa.Column('commit_id',
-              sa.ForeignKey('commits.id'),
-              primary_key=True))
-
-# Join table for tree -> subtrees mapping
-trees_trees = sa.Table(
-    'trees_trees',
-    Base.metadata,
-    sa.Column('parent_id',
-              sa.ForeignKey('trees.id'),
-              primary_key=True),
-    sa.Column('subtree_id',
-              sa.ForeignKey('trees.id'),
-              primary_key=True))
-
-# Join table for tree -> blobs mapping
-trees_blobs = sa.Table(
-    'trees_blobs',
-    Base.metadata,
-    sa.Column('tree_id',
-              sa.ForeignKey('trees.id'),
-              primary_key=True),
-    sa.Column('blob_id',
-              sa.ForeignKey('blobs.id'),
-              primary_key=True))
+def insert_ignore(table, bind):
+    """An INSERT for table that silently skips rows whose primary key
+    is already present."""
+    if bind.dialect.name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    elif bind.dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    else:
+        return table.insert()
 
+def sha1_column(*args, **kwargs):
+    """A column holding a sha1.  Takes an optional name, like
+    sa.Column."""
+    return sa.Column(*(args + (Sha1(),)), **kwargs)
 
-# Join table for commit -> parents mapping
-commits_parents = sa.Table(
-    'commits_parents',
-    Base.metadata,
-    sa.Column('child_id',
-              sa.ForeignKey('commits.id'),
-              primary_key=True),
-    sa.Column('parent_id',
-              sa.ForeignKey('commits.id'),
-              primary_key=True))
+def sha1_range(prefix):
+    """The full sha1s starting with prefix, as a (low, high) pair of
+    bounds.  low is inclusive, high exclusive, and high is None if
+    the range runs to the end of the keyspace."""
+    low = prefix.ljust(40, '0')
+    stem = prefix.rstrip('f')
+    if not stem:
+        return low, None
+    high = stem[:-1] + '%x' % (int(stem[-1], 16) + 1)
+    return low, high.ljust(40, '0')
+
+def prefix_filter(column, prefix):
+    """A filter on column matching the sha1s starting with prefix.
+    Since the column is binary, this is a range scan rather than a
+    LIKE."""
+    if len(prefix) == 40:
+        return column == prefix
+    low, high = sha1_range(prefix)
+    if high is None:
+        return column >= low
+    return sa.and_(column >= low, column < high)
+
+def _load_data_field(value):
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return value and '1' or '0'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"%s"' % value.replace('"', '""')
+
+def _note_save():
+    global curr_transaction_window
+    if curr_transaction_window >= max_transaction_window:
+        flush()
+        curr_transaction_window = 0
+    else:
+        curr_transaction_window += 1
+
+## Classes
+
+
+class ApprovalState(sa.types.TypeDecorator):
+    """Repository.approved is True, False, or a string like 'spidered'
+    for repositories nobody has checked yet."""
+    impl = sa.types.String(length=16)
+
+    def process_bind_param(self, value, dialect):
+        if value is True:
+            return 'true'
+        elif value is False:
+            return 'false'
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value == 'true':
+            return True
+        elif value == 'false':
+            return False
+        return value
+
+
+class Sha1(sa.types.TypeDecorator):
+    """A sha1, stored as its 20 raw bytes but exposed as hex.  Besides
+    halving the size of every key and index, this keeps the keys in
+    the same order as their hex forms, so a prefix is a key range."""
+    impl = sa.types.BINARY
+
+    def __init__(self):
+        super(Sha1, self).__init__(length=20)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return binascii.unhexlify(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return binascii.hexlify(value)
+
+
+class Sha1List(sa.types.TypeDecorator):
+    """A list of sha1s, stored comma-separated."""
+    impl = sa.types.Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return ','.join(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        elif not value:
+            return []
+        return value.split(',')
+
+
+class Map(object):
+    """Lazily applies fun to the results of a query, exposing the
+    cursor-like interface (count, limit, next) that the mongodb
+    backend hands to the templates.  As with a mongo cursor, count()
+    ignores any limit."""
+    def __init__(self, result, fun=None, count=None, count_query=None):
+        if fun is None:
+            fun = lambda x: x
+        self.result = result
+        self.fun = fun
+        self._count = count
+        self._count_query = count_query or result
+        self._iterator = (fun(i) for i in result)
+
+    def __iter__(self):
+        return self._iterator
+
+    def count(self):
+        if self._count is None:
+            self._count = self._count_query.count()
+        return self._count
+
+    def next(self):
+        return self._iterator.next()
+
+    def limit(self, limit):
+        return Map(self.result.limit(limit), self.fun, self._count, self._count_query)
+
+
+class BulkLoader(object):
+    """Accumulates rows per table and writes them out with a single
+    executemany per table (or LOAD DATA LOCAL INFILE from a staged CSV
+    file on MySQL).  Rows whose primary key already exists are
+    skipped, so loading the same pack twice is harmless."""
+    def __init__(self, engine, method='executemany'):
+        if method not in ('executemany', 'load_data'):
+            raise ValueError('Unknown bulk load method %s' % method)
+        if method == 'load_data' and engine.dialect.name != 'mysql':
+            logger.warning('LOAD DATA is only supported by MySQL; using executemany')
+            method = 'executemany'
+        self.engine = engine
+        self.method = method
+        self._rows = {}
+        self._updates = {}
+
+    def add(self, table, replace=True, **row):
+        """Stage a row for table.  If replace is False, an already
+        staged row with the same primary key wins."""
+        rows = self._rows.setdefault(table, {})
+        key = tuple(row[column.name] for column in table.primary_key.columns)
+        if replace:
+            rows[key] = row
+        else:
+            rows.setdefault(key, row)
+
+    def update(self, table, id, **values):
+        """Stage an update of the given columns of the row with the
+        given id, applied after all inserts."""
+        self._updates.setdefault(table, {}).setdefault(id, {}).update(values)
+
+    def flush(self):
+        if not self._rows and not self._updates:
+            return
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            for table in Metadata.sorted_tables:
+                rows = self._rows.get(table)
+                if not rows:
+                    continue
+                logger.debug('Bulk loading %d rows into %s' % (len(rows), table.name))
+                if self.method == 'load_data':
+                    self._load_data(conn, table, rows.values())
+                else:
+                    conn.execute(insert_ignore(table, conn), rows.values())
+            for table, updates in self._updates.iteritems():
+                self._update(conn, table, updates)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        self._rows.clear()
+        self._updates.clear()
+
+    def _update(self, conn, table, updates):
+        # One executemany per distinct set of updated columns
+        groups = {}
+        for id, values in updates.iteritems():
+            row = dict(('_%s' % k, v) for k, v in values.iteritems())
+            row['_id'] = id
+            groups.setdefault(tuple(sorted(values)), []).append(row)
+        for columns, rows in groups.iteritems():
+            stmt = table.update().where(table.c.id == sa.bindparam('_id'))
+            stmt = stmt.values(dict((c, sa.bindparam('_%s' % c)) for c in columns))
+            conn.execute(stmt, rows)
+
+    def _load_data(self, conn, table, rows):
+        columns = [column.name for column in table.columns]
+        # The file holds sha1s in hex; unhex them on the way in
+        targets = []
+        unhex = []
+        for column in table.columns:
+            if isinstance(column.type, Sha1):
+                targets.append('@%s' % column.name)
+                unhex.append('%s = UNHEX(@%s)' % (column.name, column.name))
+            else:
+                targets.append(column.name)
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            f = os.fdopen(fd, 'w')
+            for row in rows:
+                f.write(','.join(_load_data_field(row.get(c)) for c in columns))
+                f.write('\n')
+            f.close()
+            conn.execute("LOAD DATA LOCAL INFILE '%s' IGNORE INTO TABLE %s "
+                         "CHARACTER SET utf8 "
+                         "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+                         "LINES TERMINATED BY '\\n' (%s)%s"
+                         % (path, table.name, ', '.join(targets),
+                            unhex and ' SET ' + ', '.join(unhex) or ''))
+        finally:
+            os.unlink(path)
 
 
 class SAMixin(object):
@@ -125,66 +334,493 @@ class SAMixin(object):
         if instance:
             return instance
         else:
-            raise exceptions.DoesNotExist('%s: %s' % (cls, id))
+            raise exceptions.DoesNotExist('%s: %s' % (cls.__name__, id))
 
     @classmethod
     def get_by_attributes(cls, **kwargs):
-        results = Session.query(cls)
-        for key, value in kwargs.iteritems():
-            results = results.filter(getattr(cls, key) == value)
-        count = results.count()
-        if count == 1:
-            return list(results)[0]
-        elif count == 0:
-            raise exceptions.DoesNotExist('%s: %s' % (cls, kwargs))
+        results = cls.find(kwargs).limit(2).all()
+        if len(results) == 1:
+            return results[0]
+        elif not results:
+            raise exceptions.DoesNotExist('%s: %s' % (cls.__name__, kwargs))
         else:
-            raise exceptions.NotUnique('%s: %s' % (cls, kwargs))
+            raise exceptions.NotUnique('%s: %s' % (cls.__name__, kwargs))
+
+    @classmethod
+    def find(cls, kwargs):
+        return Session.query(cls).filter_by(**kwargs)
+
+    @classmethod
+    def find_matching(cls, ids, **kwargs):
+        """Given a list of ids, find the matching objects"""
+        return Map(cls.find(kwargs).filter(cls.id.in_(list(ids))))
 
     @classmethod
     def all(cls):
-        return Session.query(cls).all()
+        return Session.query(cls)
+
+    @classmethod
+    def exists(cls, **kwargs):
+        return cls.find(kwargs).count() > 0
 
     def refresh(self):
         return Session.refresh(self)
 
+    def validate(self):
+        """A stub method.  Should be overriden in subclasses."""
+        pass
+
     def save(self):
-        global curr_transaction_window
         self.validate()
         if not self._errors:
             Session.add(self)
-            if curr_transaction_window >= max_transaction_window:
-                flush()
-                curr_transaction_window = 0
-            else:
-                curr_transaction_window += 1
+            _note_save()
             return True
         else:
             return False
 
+    def increment(self, attr, amount=1):
+        """Add amount to attr.  This is written as attr = attr +
+        amount, so concurrent increments from several indexers all
+        count; attr is reloaded after the next flush."""
+        if not amount:
+            return
+        current = self.__dict__.get(attr)
+        if isinstance(current, sa.sql.ClauseElement):
+            # Already incremented since the last flush
+            value = current + amount
+        else:
+            value = getattr(type(self), attr) + amount
+        setattr(self, attr, value)
+        self.save()
+
+
+# Which repositories each git object has been seen in.  The reverse
+# index serves Repository.count_objects.
+git_object_repositories = sa.Table(
+    'git_object_repositories',
+    Base.metadata,
+    sha1_column('git_object_id', primary_key=True),
+    sha1_column('repository_id', primary_key=True),
+    sa.Index('ix_git_object_repositories_reverse', 'repository_id', 'git_object_id'))
+
+# How many objects of each type there are with each short prefix; see
+# GitObject.count_new
+prefix_counts = sa.Table(
+    'prefix_counts',
+    Base.metadata,
+    sa.Column('prefix', sa.types.String(length=common.max_counted_prefix), primary_key=True),
+    *(sa.Column('%s_count' % type, sa.types.Integer(), nullable=False, default=0)
+      for type in common.object_types))
+
+
+class GitObjectAssociation(SAMixin, common.CommonMixin):
+    """An edge between two git objects.  The primary key (key1, key2)
+    serves the forward lookups the query page does (e.g. the trees a
+    blob is in); a (key2, key1) index serves the reverse ones.
+
+    Like the git objects themselves, these are written by the bulk
+    loader rather than the ORM."""
+    key1_name = None
+    key2_name = None
+
+    def __init__(self, key1=None, key2=None):
+        if key1:
+            setattr(self, self.key1_name, key1)
+        if key2:
+            setattr(self, self.key2_name, key2)
+
+    @property
+    def id(self):
+        return getattr(self, self.key1_name) + getattr(self, self.key2_name)
+
+    @classmethod
+    def get_all(cls, sha1):
+        key1 = getattr(cls, cls.key1_name)
+        return Session.query(cls).filter(prefix_filter(key1, sha1))
+
+    @classmethod
+    def targets(cls, sha1, *columns):
+        """Query the given columns of the edges leaving sha1."""
+        columns = [getattr(cls, c) for c in columns]
+        return Session.query(*columns).filter(getattr(cls, cls.key1_name) == sha1)
+
+    def save(self):
+        row = dict((c.name, getattr(self, c.name)) for c in self.__table__.columns)
+        bulk_loader.add(self.__table__, **row)
+        _note_save()
+        return True
+
+    def __str__(self):
+        return '%s: %s=%s, %s=%s' % (type(self).__name__.lower(),
+                                     self.key1_name, getattr(self, self.key1_name),
+                                     self.key2_name, getattr(self, self.key2_name))
+    __repr__ = __str__
+
+
+class BlobTree(GitObjectAssociation, Base):
+    __tablename__ = 'blob_trees'
+    key1_name = 'blob_id'
+    key2_name = 'tree_id'
+    blob_id = sha1_column(primary_key=True)
+    tree_id = sha1_column(primary_key=True)
+    name = sa.Column(sa.types.Unicode(length=255))
+    mode = sa.Column(sa.types.Integer())
+
+
+class BlobTag(GitObjectAssociation, Base):
+    __tablename__ = 'blob_tags'
+    key1_name = 'blob_id'
+    key2_name = 'tag_id'
+    blob_id = sha1_column(primary_key=True)
+    tag_id = sha1_column(primary_key=True)
+
+
+class TreeParentTree(GitObjectAssociation, Base):
+    __tablename__ = 'tree_parent_trees'
+    key1_name = 'tree_id'
+    key2_name = 'parent_tree_id'
+    tree_id = sha1_column(primary_key=True)
+    parent_tree_id = sha1_column(primary_key=True)
+    name = sa.Column(sa.types.Unicode(length=255))
+    mode = sa.Column(sa.types.Integer())
+
+
+class TreeCommit(GitObjectAssociation, Base):
+    __tablename__ = 'tree_commits'
+    key1_name = 'tree_id'
+    key2_name = 'commit_id'
+    tree_id = sha1_column(primary_key=True)
+    commit_id = sha1_column(primary_key=True)
+
+
+class TreeTag(GitObjectAssociation, Base):
+    __tablename__ = 'tree_tags'
+    key1_name = 'tree_id'
+    key2_name = 'tag_id'
+    tree_id = sha1_column(primary_key=True)
+    tag_id = sha1_column(primary_key=True)
+
+
+class CommitParentCommit(GitObjectAssociation, Base):
+    __tablename__ = 'commit_parent_commits'
+    key1_name = 'commit_id'
+    key2_name = 'parent_commit_id'
+    commit_id = sha1_column(primary_key=True)
+    parent_commit_id = sha1_column(primary_key=True)
+
+
+class CommitTree(GitObjectAssociation, Base):
+    __tablename__ = 'commit_trees'
+    key1_name = 'commit_id'
+    key2_name = 'tree_id'
+    commit_id = sha1_column(primary_key=True)
+    tree_id = sha1_column(primary_key=True)
+    name = sa.Column(sa.types.Unicode(length=255))
+    mode = sa.Column(sa.types.Integer())
+
+
+class CommitTag(GitObjectAssociation, Base):
+    __tablename__ = 'commit_tags'
+    key1_name = 'commit_id'
+    key2_name = 'tag_id'
+    commit_id = sha1_column(primary_key=True)
+    tag_id = sha1_column(primary_key=True)
+
+
+class TagParentTag(GitObjectAssociation, Base):
+    __tablename__ = 'tag_parent_tags'
+    key1_name = 'tag_id'
+    key2_name = 'parent_tag_id'
+    tag_id = sha1_column(primary_key=True)
+    parent_tag_id = sha1_column(primary_key=True)
+
+
+for klass in (BlobTree, BlobTag, TreeParentTree, TreeCommit, TreeTag,
+              CommitParentCommit, CommitTree, CommitTag, TagParentTag):
+    table = klass.__table__
+    sa.Index('ix_%s_reverse' % table.name, table.c[klass.key2_name], table.c[klass.key1_name])
+del klass, table
+
 
 class GitObject(Base, SAMixin, common.CommonGitObjectMixin):
     """
     The base class for git objects (such as blobs, commits, etc..).
-    Subclasses inherit via join table inheritance.
+    All types share the git_objects table (single table inheritance),
+    so a lookup by sha1 or sha1 prefix is a range scan over the
+    primary key.
+
+    Git objects are written through the bulk loader: like the mongodb
+    backend, get_from_cache_or_new doesn't check the database, and
+    saving an object upserts just the attributes that were changed.
     """
     __tablename__ = 'git_objects'
-    id = sa.Column(sa.types.String(length=40), primary_key=True)
-    type = sa.Column(sa.types.String(length=50))
-    complete = sa.Column(sa.types.Boolean(default=False), index=True, default=False)
+    id = sha1_column(primary_key=True)
+    type = sa.Column(sa.types.String(length=10), index=True)
+    dirty = sa.Column(sa.types.Boolean())
+    # Has been completely indexed in at least one repo
+    complete = sa.Column(sa.types.Boolean())
+    # Counts for list pages; see summarize
+    n_parents = sa.Column(sa.types.Integer())
+    n_commits = sa.Column(sa.types.Integer())
+    n_repositories = sa.Column(sa.types.Integer())
+    n_names = sa.Column(sa.types.Integer())
 
     __mapper_args__ = {'polymorphic_on': type}
+    _cache = {}
+    tag_association = None
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('type', self.__mapper_args__['polymorphic_identity'])
+        super(GitObject, self).__init__(**kwargs)
+
+    @property
+    def _pending_updates(self):
+        return self.__dict__.setdefault('_pending', {})
+
+    def _set(self, attr, value):
+        setattr(self, attr, value)
+        self._pending_updates[attr] = value
 
     @classmethod
     def lookup_by_sha1(cls, sha1, partial=False, offset=0, limit=10):
+        # TODO: might want to disable lookup for dirty objects, or something
         if partial:
-            q = Session.query(cls).filter(cls.id.startswith(sha1)).filter(cls.complete == True)
-            return (q[offset:limit], q.count())
+            q = Session.query(cls).filter(prefix_filter(cls.id, sha1))
+        else:
+            q = Session.query(cls).filter(cls.id == sha1)
+        if partial and len(sha1) <= common.max_counted_prefix:
+            # Far too many to count
+            count = cls.count_prefix(sha1)
         else:
-            q = Session.query(cls).filter(cls.id == sha1).filter(cls.complete == True)
-            return (q[offset:limit], q.count())
+            count = q.count()
+        return Map(q.order_by(cls.id).offset(offset).limit(limit), count=count), count
 
-    def mark_complete(self):
-        self.complete = True
+    @classmethod
+    def get(cls, id):
+        """Get an item with the given primary key"""
+        cached = cls.get_from_cache(id=id)
+        if cached:
+            return cached
+        else:
+            return cls.get_by_attributes(id=id)
+
+    @classmethod
+    def get_from_cache_or_new(cls, id):
+        cached = cls.get_from_cache(id=id)
+        if cached:
+            return cached
+        else:
+            return cls(id=id)
+
+    @classmethod
+    def get_from_cache(cls, id):
+        return cls._cache.get(id)
+
+    @classmethod
+    def known_ids(cls, ids, repository=None):
+        """The subset of ids that are already in the database (and,
+        if repository is given, already in that repository)."""
+        ids = list(ids)
+        known = set()
+        # Stay under SQLite's limit on bound parameters
+        for i in xrange(0, len(ids), 500):
+            batch = ids[i:i+500]
+            if repository is None:
+                q = Session.query(GitObject.id).filter(GitObject.id.in_(batch))
+            else:
+                t = git_object_repositories
+                q = Session.query(t.c.git_object_id).filter(
+                    t.c.repository_id == canonicalize_to_id(repository)).filter(
+                    t.c.git_object_id.in_(batch))
+            known.update(row[0] for row in q)
+        return known
+
+    def save(self):
+        self.validate()
+        if self._errors:
+            return False
+        updates = self._pending_updates
+        row = {'id' : self.id,
+               'type' : self.type,
+               'dirty' : None,
+               'complete' : None,
+               'object_id' : None,
+               'n_parents' : None,
+               'n_commits' : None,
+               'n_repositories' : None,
+               'n_names' : None}
+        row.update(updates)
+        bulk_loader.add(GitObject.__table__, **row)
+        if updates:
+            # The row may already exist, in which case the insert is
+            # skipped.
+            bulk_loader.update(GitObject.__table__, self.id, **updates)
+        if not self.__dict__.get('_pending_save'):
+            self._cache[self.id] = self
+            save_list.append(self)
+            self._pending_save = True
+        _note_save()
+        return True
+
+    def mark_saved(self):
+        self._pending_updates.clear()
+        self._pending_save = False
+
+    def mark_dirty(self, value):
+        # Just finished indexing, apparently.
+        if not value:
+            self._set('complete', True)
+        self._set('dirty', value)
+
+    @classmethod
+    def summarize(cls, ids):
+        """Count the parents, commits, repositories and distinct names
+        of each of ids, as a dict from id to set_summary arguments."""
+        summaries = dict((id, {'parents' : 0, 'commits' : 0, 'repositories' : 0, 'names' : 0})
+                         for id in ids)
+        ids = list(summaries)
+        counted = [(BlobTree, ('parents', 'names')),
+                   (TreeParentTree, ('parents', 'names')),
+                   (TreeCommit, ('commits',)),
+                   (CommitParentCommit, ('parents',))]
+        # Stay under SQLite's limit on bound parameters
+        for i in xrange(0, len(ids), 500):
+            batch = ids[i:i+500]
+            t = git_object_repositories
+            q = Session.query(t.c.git_object_id, sa.func.count()).filter(
+                t.c.git_object_id.in_(batch)).group_by(t.c.git_object_id)
+            for id, count in q:
+                summaries[id]['repositories'] = count
+            for klass, names in counted:
+                key = getattr(klass, klass.key1_name)
+                columns = [key, sa.func.count()]
+                if 'names' in names:
+                    columns.append(sa.func.count(sa.distinct(klass.name)))
+                q = Session.query(*columns).filter(key.in_(batch)).group_by(key)
+                for row in q:
+                    summaries[row[0]].update(zip(names, row[1:]))
+        return summaries
+
+    def set_summary(self, parents, commits, repositories, names):
+        self._set('n_parents', parents)
+        self._set('n_commits', commits)
+        self._set('n_repositories', repositories)
+        self._set('n_names', names)
+
+    @classmethod
+    def first_ids(cls, prefix, limit):
+        """The first limit ids starting with prefix, in order"""
+        q = Session.query(cls.id).filter(prefix_filter(cls.id, prefix.lower()))
+        return [row[0] for row in q.order_by(cls.id).limit(limit)]
+
+    @classmethod
+    def neighbours(cls, id):
+        """The ids just before and after id in order, or None at either
+        end.  Each is one step along the primary key."""
+        q = Session.query(GitObject.id)
+        before = q.filter(GitObject.id < id).order_by(GitObject.id.desc()).first()
+        after = q.filter(GitObject.id > id).order_by(GitObject.id).first()
+        return before and before[0], after and after[0]
+
+    @classmethod
+    def count_new(cls, pairs):
+        """Add the (id, type) pairs of objects new to the database to
+        the prefix counts"""
+        counts = common.count_prefixes(pairs)
+        if not counts:
+            return
+        t = prefix_counts
+        conn = Session.connection()
+        conn.execute(insert_ignore(t, conn),
+                     [dict([('%s_count' % type, 0) for type in common.object_types], prefix=prefix)
+                      for prefix in counts])
+        update = t.update().where(t.c.prefix == sa.bindparam('p')).values(
+            dict(('%s_count' % type, t.c['%s_count' % type] + sa.bindparam(type))
+                 for type in common.object_types))
+        conn.execute(update, [dict([(type, by_type.get(type, 0)) for type in common.object_types],
+                                   p=prefix)
+                              for prefix, by_type in counts.iteritems()])
+
+    @classmethod
+    def _counted_prefixes(cls, prefixes):
+        t = prefix_counts
+        columns = [sa.func.sum(t.c['%s_count' % type]) for type in common.object_types]
+        row = Session.execute(sa.select(columns).where(t.c.prefix.in_(prefixes))).first()
+        return dict(zip(common.object_types, [count or 0 for count in row]))
+
+    @classmethod
+    def _count_prefix(cls, prefix):
+        q = Session.query(cls.type, sa.func.count()).filter(prefix_filter(cls.id, prefix))
+        return dict(q.group_by(cls.type))
+
+    @classmethod
+    def recount_prefixes(cls):
+        """Rebuild the prefix counts from scratch"""
+        head = sa.func.lower(sa.func.substr(sa.func.hex(cls.id), 1, common.max_counted_prefix))
+        q = Session.query(head, cls.type, sa.func.count()).group_by(head, cls.type)
+        counts = {}
+        for prefix, type, count in q:
+            for length in xrange(1, len(prefix) + 1):
+                by_type = counts.setdefault(prefix[:length], {})
+                by_type[type] = by_type.get(type, 0) + count
+        Session.execute(prefix_counts.delete())
+        if counts:
+            Session.execute(prefix_counts.insert(),
+                            [dict([('%s_count' % type, by_type.get(type, 0))
+                                   for type in common.object_types], prefix=prefix)
+                             for prefix, by_type in counts.iteritems()])
+
+    @classmethod
+    def last_indexed(cls, ids):
+        """When the repositories holding any of ids were last indexed,
+        and how many (object, repository) pairs there are among them,
+        as (latest last_index, count).  Either changes when the
+        objects are indexed again."""
+        if not ids:
+            return None, 0
+        t = git_object_repositories
+        q = Session.query(sa.func.max(Repository.last_index), sa.func.count())
+        q = q.filter(Repository.id == t.c.repository_id).filter(t.c.git_object_id.in_(list(ids)))
+        return q.one()
+
+    @property
+    def repository_ids(self):
+        q = Session.query(git_object_repositories.c.repository_id)
+        q = q.filter(git_object_repositories.c.git_object_id == self.id)
+        return Map(q, lambda row: row[0])
+
+    @property
+    def repositories(self):
+        q = Session.query(Repository).join(
+            git_object_repositories,
+            Repository.id == git_object_repositories.c.repository_id)
+        return Map(q.filter(git_object_repositories.c.git_object_id == self.id))
+
+    def limited_repositories(self, limit):
+        return self.repositories.limit(limit)
+
+    def add_repository(self, repository_id, recursive=False):
+        repository_id = canonicalize_to_id(repository_id)
+        bulk_loader.add(git_object_repositories,
+                        git_object_id=self.id,
+                        repository_id=repository_id)
+
+    def add_tag(self, tag_id):
+        tag_id = canonicalize_to_id(tag_id)
+        t = self.tag_association(key1=self.id, key2=tag_id)
+        t.save()
+
+    @property
+    def tag_ids(self):
+        a = self.tag_association
+        return Map(a.targets(self.id, a.key2_name), lambda row: row[0])
+
+    @property
+    def tags(self):
+        a = self.tag_association
+        ids = a.targets(self.id, a.key2_name).subquery()
+        return Map(Session.query(Tag).filter(Tag.id.in_(ids)))
 
 
 class Blob(GitObject, common.CommonBlobMixin):
@@ -192,17 +828,46 @@ class Blob(GitObject, common.CommonBlobMixin):
     Represents a git Blob.  Has an id (the sha1 that identifies this
     object)
     """
-    __tablename__ = 'blobs'
     __mapper_args__ = {'polymorphic_identity': 'blob'}
-    id = sa.Column(sa.ForeignKey('git_objects.id'),
-                   primary_key=True)
+    _cache = {}
+    tag_association = BlobTag
 
-    def add_parent(self, parent):
-        self.parents.add(parent)
+    def add_parent(self, parent_id, name, mode):
+        name = common.sanitize_unicode(name)
+        parent_id = canonicalize_to_id(parent_id)
+        b = BlobTree(key1=self.id, key2=parent_id)
+        b.name = name
+        b.mode = mode
+        b.save()
 
     @property
-    def repositories(self):
-        return Session.query(Repository).join('commits', 'blobs').filter(Blob.id==self.id)
+    def parent_ids_with_names(self):
+        return Map(BlobTree.targets(self.id, 'tree_id', 'name'), tuple)
+
+    @property
+    def parent_ids(self):
+        return Map(BlobTree.targets(self.id, 'tree_id'), lambda row: row[0])
+
+    def limited_parent_ids(self, limit):
+        return self.parent_ids.limit(limit)
+
+    @property
+    def names(self):
+        s = set(name for (id, name) in self.parent_ids_with_names)
+        return Map(s, count=len(s))
+
+    def limited_names(self, limit):
+        s = set(name for (id, name) in self.parent_ids_with_names.limit(limit))
+        return Map(s, count=len(s))
+
+    @property
+    def parents(self):
+        ids = BlobTree.targets(self.id, 'tree_id').subquery()
+        return Map(Session.query(Tree).filter(Tree.id.in_(ids)))
+
+    @property
+    def parents_with_names(self):
+        return Map(self.parent_ids_with_names, lambda (id, name): (Tree.get(id), name))
 
 
 class Tree(GitObject, common.CommonTreeMixin):
@@ -210,55 +875,83 @@ class Tree(GitObject, common.CommonTreeMixin):
     Represents a git Tree.  Has an id (the sha1 that identifies this
     object)
     """
-    __tablename__ = 'trees'
     __mapper_args__ = {'polymorphic_identity': 'tree'}
-    id = sa.Column(sa.ForeignKey('git_objects.id'),
-                   primary_key=True)
-    subtrees = orm.relation('Tree',
-                            backref=orm.backref('parents',
-                                                collection_class=set),
-                            primaryjoin=(id == trees_trees.c.parent_id),
-                            secondaryjoin=(id == trees_trees.c.subtree_id),
-                            secondary=trees_trees,
-                            collection_class=set)
-    blobs = orm.relation(Blob,
-                         backref=orm.backref('parents',
-                                             collection_class=set,
-                                             foreign_keys=[trees_blobs.c.tree_id,
-                                                           trees_blobs.c.blob_id]),
-                         primaryjoin=(id == trees_blobs.c.tree_id),
-                         secondaryjoin=(Blob.id == trees_blobs.c.blob_id),
-                         secondary=trees_blobs,
-                         foreign_keys=[trees_blobs.c.tree_id, trees_blobs.c.blob_id],
-                         collection_class=set)
+    _cache = {}
+    tag_association = TreeTag
 
-    def add_parent(self, parent):
-        self.parents.add(parent)
+    def add_parent(self, parent_id, name, mode):
+        """Give this tree a parent.  Also updates the parent to know
+        about this tree."""
+        name = common.sanitize_unicode(name)
+        parent_id = canonicalize_to_id(parent_id)
+        b = TreeParentTree(key1=self.id, key2=parent_id)
+        b.name = name
+        b.mode = mode
+        b.save()
 
     @property
-    def repositories(self):
-        return Session.query(Repository).join('commits', 'trees').filter(Tree.id==self.id)
+    def parent_ids_with_names(self):
+        return Map(TreeParentTree.targets(self.id, 'parent_tree_id', 'name'), tuple)
+
+    def add_commit(self, commit_id):
+        commit_id = canonicalize_to_id(commit_id)
+        t = TreeCommit(key1=self.id, key2=commit_id)
+        t.save()
+
+    @property
+    def commit_ids(self):
+        return Map(TreeCommit.targets(self.id, 'commit_id'), lambda row: row[0])
+
+    def limited_commit_ids(self, limit):
+        return self.commit_ids.limit(limit)
+
+    @property
+    def commits(self):
+        ids = TreeCommit.targets(self.id, 'commit_id').subquery()
+        return Map(Session.query(Commit).filter(Commit.id.in_(ids)))
+
+    @property
+    def parent_ids(self):
+        return Map(TreeParentTree.targets(self.id, 'parent_tree_id'), lambda row: row[0])
+
+    def limited_parent_ids(self, limit):
+        return self.parent_ids.limit(limit)
+
+    @property
+    def names(self):
+        return Map(TreeParentTree.targets(self.id, 'name'), lambda row: row[0])
+
+    def limited_names(self, limit):
+        s = set(name for (id, name) in self.parent_ids_with_names.limit(limit))
+        return Map(s, count=len(s))
+
+    @property
+    def parents(self):
+        ids = TreeParentTree.targets(self.id, 'parent_tree_id').subquery()
+        return Map(Session.query(Tree).filter(Tree.id.in_(ids)))
+
+    @property
+    def parents_with_names(self):
+        return Map(self.parent_ids_with_names, lambda (id, name): (Tree.get(id), name))
 
 
 class Tag(GitObject, common.CommonTagMixin):
     """
-    Represents a git Tree.  Has an id (the sha1 that identifies this
+    Represents a git Tag.  Has an id (the sha1 that identifies this
     object)
     """
-    __tablename__ = 'tags'
     __mapper_args__ = {'polymorphic_identity': 'tag'}
-    id = sa.Column(sa.ForeignKey('git_objects.id'),
-                   primary_key=True)
+    _cache = {}
+    tag_association = TagParentTag
+    object_id = sha1_column()
 
-    # Should upgrade this someday to point to arbitrary objects.
-    commit_id = sa.Column(sa.ForeignKey('commits.id'))
+    def set_object_id(self, object_id):
+        object_id = canonicalize_to_id(object_id)
+        self._set('object_id', object_id)
 
-    def set_object(self, o):
-        o = canonicalize(o)
-        if o.type == 'commit':
-            self.commit = o
-        else:
-            logger.error('Could not set object %s as the target of %s' % (o, self))
+    @property
+    def object(self):
+        return GitObject.get(id=self.object_id)
 
 
 class Commit(GitObject, common.CommonCommitMixin):
@@ -266,119 +959,246 @@ class Commit(GitObject, common.CommonCommitMixin):
     Represents a git Commit.  Has an id (the sha1 that identifies
     this object).  Also contains blobs, trees, and tags.
     """
-    __tablename__ = 'commits'
     __mapper_args__ = {'polymorphic_identity': 'commit'}
-    id = sa.Column(sa.ForeignKey('git_objects.id'),
-                   primary_key=True)
-
-    blobs = orm.relation(Blob,
-                         backref=orm.backref('commits',
-                                             collection_class=set),
-                         collection_class=set,
-                         secondary=blobs_commits)
-
-    trees = orm.relation(Tree,
-                         backref=orm.backref('commits',
-                                             collection_class=set),
-                         collection_class=set,
-                         secondary=trees_commits)
-
-    tags = orm.relation(Tag,
-                        backref='commit',
-                        collection_class=set,
-                        primaryjoin=(id == Tag.commit_id))
-
-    parents = orm.relation('Commit',
-                           backref=orm.backref('children',
-                                               collection_class=set),
-                           collection_class=set,
-                           primaryjoin=(id == commits_parents.c.child_id),
-                           secondaryjoin=(id == commits_parents.c.parent_id),
-                           secondary=commits_parents)
-
-    def add_repository(self, remote, recursive=False):
-        if isinstance(remote, basestring):
-            remote = Repository.get(remote)
-        if remote not in self.repositories:
-            self.repositories.add(remote)
-            if recursive:
-                logger.debug('Recursively adding %s to %s' % (remote, self))
-                for parent in self.parents:
-                    parent.add_repository(remote, recursive=True)
-
-    def add_tree(self, tree, recursive=True):
-        if isinstance(tree, basestring):
-            tree = Tree.get_or_create(id=tree)
-        # Assumes the invariant that if we have added a tree before,
-        # we have added all of its children as well
-        if tree not in self.trees:
-            self.trees.add(tree)
-            if recursive:
-                for subtree in tree.subtrees:
-                    self.add_tree(subtree, recursive=True)
-                for blob in tree.blobs:
-                    self.add_blob(blob)
-
-    def add_blob(self, blob):
-        if isinstance(blob, basestring):
-            blob = Blob.get_or_create(id=blob)
-        self.blobs.add(blob)
+    _cache = {}
+    tag_association = CommitTag
 
     def add_parent(self, parent):
         self.add_parents([parent])
 
-    def add_parents(self, parents):
-        parents = set(canonicalize(p) for p in parents)
-        self.parents = self.parents.union(parents)
+    def add_parents(self, parent_ids):
+        for parent_id in set(canonicalize_to_id(p) for p in parent_ids):
+            c = CommitParentCommit(key1=self.id, key2=parent_id)
+            c.save()
 
     @property
     def parent_ids(self):
-        return [parent.id for parent in self.parents]
+        return Map(CommitParentCommit.targets(self.id, 'parent_commit_id'), lambda row: row[0])
 
-    @classmethod
-    def find_matching(cls, sha1s):
-        """Given a list of sha1s, find the matching commit objects"""
-        return Session.query(cls).filter(cls.id.in_(sha1s))
+    @property
+    def parents(self):
+        ids = CommitParentCommit.targets(self.id, 'parent_commit_id').subquery()
+        return Map(Session.query(Commit).filter(Commit.id.in_(ids)))
+
+    def add_as_submodule_of(self, tree_id, name, mode):
+        tree_id = canonicalize_to_id(tree_id)
+        name = common.sanitize_unicode(name)
+        b = CommitTree(key1=self.id, key2=tree_id)
+        b.name = name
+        b.mode = mode
+        b.save()
 
+    @property
+    def submodule_of_with_names(self):
+        return Map(CommitTree.targets(self.id, 'tree_id', 'name'), tuple)
+
+    @property
+    def submodule_of(self):
+        return Map(CommitTree.targets(self.id, 'tree_id'), lambda row: row[0])
 
-class RemoteHead(Base, SAMixin, common.CommonRemoteHeadMixin):
-    __tablename__ = 'remote_heads'
-    repo_id = sa.Column(sa.ForeignKey('repositories.id'),
-                        primary_key=True)
-    ref_id = sa.Column(sa.types.String(length=255), primary_key=True)
-    commit_id =  sa.Column(sa.ForeignKey('commits.id'))
-    commit = orm.relation(Commit,
-                          collection_class=set)
 
 class Repository(Base, SAMixin, common.CommonRepositoryMixin):
-    """
-    A git repository, corresponding to a remote in the-one-repo.git.
-    Contains many commits.
-    """
+    """A git repository.  Contains many commits."""
     __tablename__ = 'repositories'
-    id = sa.Column(sa.types.String(length=40), primary_key=True)
+    id = sha1_column(primary_key=True)
     url = sa.Column(sa.types.String(length=255), unique=True)
     last_index = sa.Column(sa.types.DateTime())
-    indexing = sa.Column(sa.types.Boolean(), default=False)
+    # When we last found it unchanged (or reachable), without indexing it
+    last_validated = sa.Column(sa.types.DateTime())
+    # Who is indexing it, and until when; see claim_lease
+    lease_owner = sa.Column(sa.types.String(length=255))
+    lease_expires = sa.Column(sa.types.DateTime())
+    remote_heads = sa.Column(Sha1List())
+    new_remote_heads = sa.Column(Sha1List())
+    been_indexed = sa.Column(sa.types.Boolean())
+    approved = sa.Column(ApprovalState(), index=True)
+    count = sa.Column(sa.types.Integer(), index=True)
+    # A HyperLogLog sketch of the objects, for estimating count
+    sketch = sa.Column(sa.types.LargeBinary())
+    # Change detection state; see anygit.client.scheduler
+    requested = sa.Column(sa.types.Boolean())
+    poll_interval = sa.Column(sa.types.Integer())
+    next_poll = sa.Column(sa.types.DateTime())
+    change_rate = sa.Column(sa.types.Float())
+    # How far we got through the pack being indexed; see set_checkpoint
+    checkpoint_pack = sa.Column(sa.types.String(length=255))
+    checkpoint_checksum = sa.Column(sa.types.String(length=40))
+    checkpoint_phase = sa.Column(sa.types.String(length=16))
+    checkpoint_offset = sa.Column(sa.types.Integer())
+
+    _defaults = {'last_index' : datetime.datetime(1970,1,1),
+                 'been_indexed' : False,
+                 'approved' : False,
+                 'count' : 0,
+                 'requested' : False}
 
-    commits = orm.relation(Commit,
-                           backref=orm.backref('repositories',
-                                               collection_class=set),
-                           collection_class=set,
-                           secondary=commits_repositories)
+    def __init__(self, **kwargs):
+        for key, value in self._defaults.iteritems():
+            kwargs.setdefault(key, value)
+        super(Repository, self).__init__(**kwargs)
 
-    remote_heads = orm.relation(RemoteHead,
-                                backref='repository',
-                                collection_class=set)
+    @classmethod
+    def _existing_ids(cls, ids):
+        t = cls.__table__
+        return set(row[0] for row in Engine.execute(sa.select([t.c.id]).where(t.c.id.in_(ids))))
+
+    @classmethod
+    def _register_batch(cls, rows, approved):
+        existing = cls._existing_ids([id for id, url in rows])
+        new = [dict(cls._defaults, id=id, url=url, approved=approved)
+               for id, url in rows if id not in existing]
+        if not new:
+            return 0
+        # Ignoring any that someone registered meanwhile, so only
+        # the rows written count
+        return Engine.execute(insert_ignore(cls.__table__, Engine), new).rowcount
 
     @classmethod
     def get_indexed_before(cls, date):
         """Get all repos indexed before the given date and not currently
         being indexed."""
+        q = Session.query(cls).filter(cls.approved == True).filter(cls._lease_free())
         if date is not None:
-            return Session.query(cls).filter(cls.last_index >= date).filter(cls.indexing == False).all()
+            q = q.filter(cls.last_index < date)
+        return q
+
+    @classmethod
+    def _lease_free(cls, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        return sa.or_(cls.lease_expires == None, cls.lease_expires < now)
+
+    def _update_lease(self, condition, owner, expires):
+        # Straight to the database rather than through the session, so
+        # that other indexers see it at once
+        t = Repository.__table__
+        stmt = t.update().where(t.c.id == self.id).where(condition)
+        result = Engine.execute(stmt.values(lease_owner=owner, lease_expires=expires))
+        return result.rowcount == 1
+
+    def claim_lease(self, owner, duration):
+        """Atomically take the lease on indexing this repository for
+        duration seconds, unless someone else holds it.  Returns
+        whether we got it."""
+        now = datetime.datetime.now()
+        return self._update_lease(self._lease_free(now), owner,
+                                  now + datetime.timedelta(seconds=duration))
+
+    def renew_lease(self, owner, duration):
+        """Extend owner's lease by duration seconds from now.  Returns
+        False if owner no longer holds it."""
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=duration)
+        return self._update_lease(Repository.lease_owner == owner, owner, expires)
+
+    def release_lease(self, owner=None):
+        """Give up owner's lease; with no owner, whoever holds it."""
+        if owner is None:
+            condition = sa.true()
+        else:
+            condition = Repository.lease_owner == owner
+        return self._update_lease(condition, None, None)
+
+    @classmethod
+    def reap_leases(cls, all=False):
+        """Reclaim the leases of indexers that stopped renewing them
+        (or, if all, every lease).  Returns how many were reclaimed."""
+        t = cls.__table__
+        stmt = t.update().where(t.c.lease_owner != None)
+        if not all:
+            stmt = stmt.where(t.c.lease_expires < datetime.datetime.now())
+        return Engine.execute(stmt.values(lease_owner=None, lease_expires=None)).rowcount
+
+    @classmethod
+    def get_by_highest_count(cls, n=None, descending=True):
+        if descending:
+            order = cls.count.desc()
         else:
-            return Session.query(cls).filter(cls.indexing == False).all()
+            order = cls.count.asc()
+        q = Session.query(cls).order_by(order)
+        if n:
+            q = q.limit(n)
+        return q
+
+    def set_count(self, value):
+        self.count = value
+
+    def count_objects(self):
+        q = Session.query(sa.func.count(git_object_repositories.c.git_object_id))
+        return q.filter(git_object_repositories.c.repository_id == self.id).scalar()
+
+    def object_ids(self):
+        t = git_object_repositories
+        q = Session.query(t.c.git_object_id).filter(t.c.repository_id == self.id)
+        return (row[0] for row in q.yield_per(10000))
+
+    def set_sketch(self, sketch):
+        self.sketch = sketch.to_string()
+
+    def set_new_remote_heads(self, new_remote_heads):
+        self.new_remote_heads = list(new_remote_heads)
+
+    def set_remote_heads(self, remote_heads):
+        self.remote_heads = list(remote_heads)
 
     def __str__(self):
         return 'Repository: %s' % self.url
+
+# Serves get_indexed_before
+sa.Index('ix_repositories_schedule',
+         Repository.__table__.c.approved,
+         Repository.__table__.c.lease_expires,
+         Repository.__table__.c.last_index)
+
+
+class Aggregate(Base, SAMixin, common.CommonMixin):
+    """Singleton class that contains aggregate data about the indexer"""
+    __tablename__ = 'aggregate'
+    id = sa.Column(sa.types.String(length=16), primary_key=True)
+    indexed_repository_count = sa.Column(sa.types.Integer())
+    blob_count = sa.Column(sa.types.Integer())
+    tree_count = sa.Column(sa.types.Integer())
+    commit_count = sa.Column(sa.types.Integer())
+    tag_count = sa.Column(sa.types.Integer())
+    # From the last index_all schedule
+    queue_depth = sa.Column(sa.types.Integer())
+    change_rate = sa.Column(sa.types.Float())
+
+    def __init__(self, **kwargs):
+        for attr in ('indexed_repository_count', 'blob_count', 'tree_count',
+                     'commit_count', 'tag_count', 'queue_depth'):
+            kwargs.setdefault(attr, 0)
+        kwargs.setdefault('change_rate', 0.0)
+        super(Aggregate, self).__init__(**kwargs)
+
+    @classmethod
+    def get(cls):
+        # Not cached on the class, since sessions don't outlive a
+        # web request.
+        try:
+            return super(Aggregate, cls).get(id='main')
+        except exceptions.DoesNotExist:
+            instance = cls.create(id='main')
+            flush()
+            return instance
+
+    def refresh_all_counts(self, all=None):
+        if all:
+            for repo in Repository.all():
+                repo.rebuild_sketch()
+                logger.info('Setting count for %s to %d' % (repo, repo.count))
+                repo.save()
+
+        count = self.indexed_repository_count = Repository.find({'been_indexed' : True}).count()
+        logger.info('Looks like there are %d indexed repositories' % count)
+        self.save()
+        flush()
+
+        self.blob_count = Blob.all().count()
+        self.tree_count = Tree.all().count()
+        self.commit_count = Commit.all().count()
+        self.tag_count = Tag.all().count()
+        logger.info('Also, there are %d blobs, %d trees, %d commits, and %d tags' %
+                    (self.blob_count, self.tree_count, self.commit_count, self.tag_count))
+        GitObject.recount_prefixes()
+        self.save()
+        flush()
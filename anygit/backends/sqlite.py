@@ -0,0 +1,82 @@
+"""
+An embedded backend, keeping the whole index in a local SQLite file.
+
+This is the SQLAlchemy schema from the mysql backend, with its
+binary sha1 keys and bulk loader; only the setup differs.  The
+database runs in WAL mode, so the web app can keep reading while the
+indexer writes, and a consistent copy of the file can be shipped as
+a snapshot of the index.
+"""
+import logging
+import os
+import shutil
+from pylons import config
+import sqlalchemy as sa
+
+from anygit.backends import mysql
+from anygit.backends.mysql import (create_schema, flush, destroy_session,
+                                   primary_reads, GitObject, Blob, Tree, Tag, Commit,
+                                   Repository, BlobTree, BlobTag,
+                                   TreeParentTree, TreeCommit, TreeTag,
+                                   CommitParentCommit, CommitTree,
+                                   CommitTag, TagParentTag, Aggregate)
+
+logger = logging.getLogger(__name__)
+
+path = None
+
+## Exported functions
+
+def setup(replicas=False):
+    """
+    Sets up the database session.  There is only the one database, so
+    replicas is ignored.
+    """
+    global path
+    path = config.get('sqlite.path', 'anygit.db')
+    synchronous = config.get('sqlite.synchronous', 'NORMAL')
+    cache_size = int(config.get('sqlite.cache_size', 100000))
+
+    def set_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = %s' % synchronous)
+        # In pages; negative would mean KiB
+        cursor.execute('PRAGMA cache_size = %d' % cache_size)
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.close()
+
+    if path == ':memory:':
+        # For the tests.  Everyone has to share the one connection, or
+        # they would each get a database of their own.
+        engine = sa.create_engine('sqlite://', poolclass=sa.pool.StaticPool,
+                                  connect_args={'check_same_thread' : False})
+    else:
+        path = os.path.abspath(path)
+        engine = sa.create_engine('sqlite:///%s' % path)
+    sa.event.listen(engine, 'connect', set_pragmas)
+    # Each flush is one transaction, and a transaction costs an fsync,
+    # so batch more writes per flush than against a server.
+    mysql.max_transaction_window = int(config.get('sqlite.transaction_window', 50000))
+    mysql.init_model(engine)
+
+## Snapshots
+
+def snapshot(dest):
+    """Copy a consistent snapshot of the database to dest."""
+    flush()
+    conn = mysql.Engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        # Move everything committed so far from the WAL into the main
+        # file, then hold the write lock while copying.  Checkpoints
+        # only run on commit, so the main file can't change under us.
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            logger.info('Copying %s to %s' % (path, dest))
+            shutil.copyfile(path, dest)
+        finally:
+            conn.rollback()
+    finally:
+        conn.close()
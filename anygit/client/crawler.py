@@ -0,0 +1,230 @@
+"""
+A concurrent HTTP crawl engine for the spiders.
+
+Requests run on one pycurl.CurlMulti, up to concurrency at once.
+Handles are kept and reused for each proxy, so connections to a
+host stay alive between requests.  Requests to a host through a
+proxy are rate limited with a token bucket for that (host, proxy)
+pair.  When a site says we are going too fast, that pair backs off
+exponentially and the request is retried.
+
+What to do with a response is up to the request's parser, a function
+taking the crawler, the request and the body.  It can add more
+requests, and raises RateLimited if the body says to slow down.  For
+big pages, a request can instead have a stream: a function of the
+crawler and the request returning something with feed and close
+methods, which is fed the body a chunk at a time as it arrives and
+closed once it is all there.
+Once a request is finished with, parsed or given up on, the crawler's
+on_done is called with it.
+"""
+import heapq
+import logging
+import pycurl
+import StringIO
+import time
+import urlparse
+
+from anygit.client import ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    pass
+
+
+class Request(object):
+    def __init__(self, url, parser=None, data=None, stream=None):
+        self.url = url
+        self.parser = parser
+        self.stream = stream
+        # Anything the parser wants to know about the request
+        self.data = data
+        self.host = urlparse.urlparse(url).netloc
+        self.attempts = 0
+        self.proxy = None
+        # Whether it has been given a slot by the rate limiter
+        self.reserved = False
+        self.body = None
+
+    def __repr__(self):
+        return '<Request %s>' % self.url
+
+
+class Crawler(object):
+    """Runs requests through proxies (a list of SOCKS5 proxy addresses,
+    None meaning a direct connection), at most rate requests a second
+    to each host through each."""
+    def __init__(self, proxies=(None,), concurrency=16, rate=1.0, burst=1,
+                 backoff=10, max_attempts=5, timeout=60, on_done=None):
+        self.proxies = list(proxies)
+        self.concurrency = concurrency
+        self.limiter = ratelimit.RateLimiter(rate, burst)
+        self.initial_backoff = backoff
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.on_done = on_done
+        self.multi = pycurl.CurlMulti()
+        self._free = dict((proxy, []) for proxy in self.proxies)
+        self._active = {}
+        # Requests waiting for their turn, as (start, seq, request)
+        self._waiting = []
+        self._seq = 0
+        # Per (host, proxy): when it may be used again, and how long
+        # to back off next time it's rate limited
+        self._blocked_until = {}
+        self._backoff = {}
+        self._next_proxy = 0
+        self.completed = 0
+        self.failed = 0
+
+    def add(self, request, delay=0):
+        """Queue request, to start no sooner than delay seconds from now"""
+        heapq.heappush(self._waiting, (time.time() + delay, self._seq, request))
+        self._seq += 1
+
+    def get(self, url):
+        """Fetch just url, and return the body"""
+        results = []
+        self.add(Request(url, lambda crawler, request, body: results.append(body)))
+        self.run()
+        if not results:
+            raise IOError('Could not fetch %s' % url)
+        return results[0]
+
+    def pending(self):
+        return len(self._waiting) + len(self._active)
+
+    def run(self, feed=None):
+        """Run until there are no requests left.  If feed is given, it
+        is called whenever the queue runs low, to add more; it returns
+        False once it has nothing more to add."""
+        feeding = feed is not None
+        while True:
+            if feeding and self.pending() < 2 * self.concurrency:
+                feeding = feed(self)
+            self._start_ready()
+            if not self._active:
+                if not self._waiting:
+                    return
+                time.sleep(max(0, min(1, self._waiting[0][0] - time.time())))
+                continue
+            self.multi.select(0.1)
+            while True:
+                ret, running = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, succeeded, failed = self.multi.info_read()
+                for handle in succeeded:
+                    self._finish(handle, None)
+                for handle, errno, message in failed:
+                    self._finish(handle, message)
+                if not queued:
+                    break
+
+    def _choose_proxy(self, host, now):
+        """The next proxy, in turn, that isn't backing off from host.
+        Returns (found, proxy)."""
+        for i in xrange(len(self.proxies)):
+            proxy = self.proxies[(self._next_proxy + i) % len(self.proxies)]
+            if self._blocked_until.get((host, proxy), 0) <= now:
+                self._next_proxy = (self._next_proxy + i + 1) % len(self.proxies)
+                return True, proxy
+        return False, None
+
+    def _start_ready(self):
+        now = time.time()
+        while self._waiting and len(self._active) < self.concurrency:
+            start, seq, request = self._waiting[0]
+            if start > now:
+                return
+            heapq.heappop(self._waiting)
+            if request.reserved:
+                # Its turn with the rate limiter has come
+                request.reserved = False
+                self._start(request, request.proxy)
+                continue
+            found, proxy = self._choose_proxy(request.host, now)
+            if not found:
+                # Every proxy is backing off from this host
+                wait = min(self._blocked_until[(request.host, p)] for p in self.proxies) - now
+                self.add(request, delay=wait)
+                continue
+            wait = self.limiter.reserve((request.host, proxy))
+            if wait:
+                request.proxy = proxy
+                request.reserved = True
+                self.add(request, delay=wait)
+                continue
+            self._start(request, proxy)
+
+    def _handle(self, proxy):
+        if self._free[proxy]:
+            return self._free[proxy].pop()
+        c = pycurl.Curl()
+        if proxy:
+            c.setopt(pycurl.PROXY, proxy)
+            c.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 5)
+        c.setopt(pycurl.TIMEOUT, self.timeout)
+        return c
+
+    def _start(self, request, proxy):
+        request.proxy = proxy
+        request.attempts += 1
+        c = self._handle(proxy)
+        c.setopt(pycurl.URL, request.url)
+        if request.stream:
+            # Starting afresh if this is a retry
+            request.body = request.stream(self, request)
+            c.setopt(pycurl.WRITEFUNCTION, request.body.feed)
+        else:
+            request.body = StringIO.StringIO()
+            c.setopt(pycurl.WRITEFUNCTION, request.body.write)
+        self._active[c] = request
+        self.multi.add_handle(c)
+
+    def _finish(self, handle, error):
+        request = self._active.pop(handle)
+        self.multi.remove_handle(handle)
+        self._free[request.proxy].append(handle)
+        key = (request.host, request.proxy)
+        body = request.body
+        request.body = None
+        try:
+            if error is not None:
+                raise IOError(error)
+            if handle.getinfo(pycurl.RESPONSE_CODE) == 429:
+                raise RateLimited('HTTP 429')
+            if request.stream:
+                body.close()
+            else:
+                request.parser(self, request, body.getvalue())
+        except RateLimited, e:
+            delay = self._backoff.get(key, self.initial_backoff)
+            logger.error('Rate limited by %s on proxy %s!  (%s)  Backing off for %d seconds.' %
+                         (request.host, request.proxy, e, delay))
+            self._blocked_until[key] = time.time() + delay
+            self._backoff[key] = delay * 2
+            # Doesn't count as an attempt
+            request.attempts -= 1
+            self.add(request)
+        except Exception, e:
+            if request.attempts < self.max_attempts:
+                logger.warning('Problem with %s (attempt %d): %s' % (request.url, request.attempts, e))
+                self.add(request, delay=2 ** request.attempts)
+            else:
+                logger.error('Giving up on %s: %s' % (request.url, e))
+                self.failed += 1
+                self._done(request)
+        else:
+            self._backoff.pop(key, None)
+            self.completed += 1
+            self._done(request)
+
+    def _done(self, request):
+        if self.on_done:
+            self.on_done(request)
@@ -0,0 +1,201 @@
+"""
+Asynchronous git:// ref discovery.
+
+All we often want from a remote is its ref advertisement: that tells
+us whether the repository exists, and whether it has anything we
+haven't indexed.  This speaks just enough of the upload-pack protocol
+to read the advertisement and hang up, for many remotes at once on
+one asyncore loop.
+"""
+import asyncore
+import heapq
+import logging
+import re
+import socket
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+default_port = 9418
+length_re = re.compile('^[0-9a-fA-F]{4}$')
+sha1_re = re.compile('^[0-9a-f]{40}$')
+
+
+class Error(Exception):
+    pass
+
+
+class Timeout(Error):
+    pass
+
+
+def pkt_line(data):
+    return '%04x%s' % (len(data) + 4, data)
+
+def parse_address(host):
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        try:
+            return host, int(port)
+        except ValueError:
+            raise Error('Bad port %s' % port)
+    return host, default_port
+
+
+class RefDiscovery(asyncore.dispatcher):
+    """One connection, reading the refs advertised for path.  When
+    done, appends (key, refs, error) to done; refs maps ref names to
+    sha1s, and is None if there was an error."""
+    def __init__(self, key, host, path, socket_map, done, timeout):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.key = key
+        self.done = done
+        self.deadline = time.time() + timeout
+        self.refs = {}
+        self.finished = False
+        self._in = ''
+        hostname, port = parse_address(host)
+        self._out = pkt_line('git-upload-pack %s\0host=%s\0' % (path, hostname))
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((hostname, port))
+        except socket.error, e:
+            self.finish(e)
+
+    def finish(self, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        if error is None:
+            self.done.append((self.key, self.refs, None))
+        else:
+            self.done.append((self.key, None, error))
+        self.close()
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._in += data
+            # Whatever the remote sends, it only fails this connection
+            try:
+                self._parse()
+            except Exception, e:
+                self.finish(Error('Bad response: %s' % e))
+
+    def handle_close(self):
+        self.finish(Error('Connection closed before the end of the refs'))
+
+    def handle_error(self):
+        self.finish(sys.exc_info()[1])
+
+    def _parse(self):
+        while not self.finished and len(self._in) >= 4:
+            if not length_re.match(self._in[:4]):
+                return self.finish(Error('Bad pkt-line %r' % self._in[:4]))
+            size = int(self._in[:4], 16)
+            if size == 0:
+                # A flush: that's all the refs.  Send one back to say
+                # we want nothing, and hang up.
+                try:
+                    self.send('0000')
+                except socket.error:
+                    pass
+                return self.finish()
+            elif size < 4:
+                return self.finish(Error('Bad pkt-line length %d' % size))
+            elif len(self._in) < size:
+                return
+            line = self._in[4:size]
+            self._in = self._in[size:]
+            self._handle_line(line)
+
+    def _handle_line(self, line):
+        if line.startswith('ERR '):
+            return self.finish(Error(line[4:].strip()))
+        line = line.rstrip('\n').split('\0', 1)[0]
+        try:
+            sha1, name = line.split(' ', 1)
+        except ValueError:
+            return self.finish(Error('Bad ref line %r' % line))
+        if not sha1_re.match(sha1):
+            return self.finish(Error('Bad sha1 in ref line %r' % line))
+        # An empty repository advertises only its capabilities
+        if name != 'capabilities^{}':
+            self.refs[name] = sha1
+
+
+def discover_all(targets, concurrency=64, timeout=10, limiter=None):
+    """Discover the refs of each (key, host, path) in targets, with
+    at most concurrency connections open at once.  If limiter (a
+    ratelimit.RateLimiter) is given, connections to each host are
+    rate limited by it.  Yields (key, refs, error) triples as they
+    finish, in no particular order; refs is None if there was an
+    error.  Connections that take longer than timeout seconds are
+    closed."""
+    targets = iter(targets)
+    socket_map = {}
+    done = []
+    # Targets waiting on the rate limiter, as (start, seq, key, host, path)
+    waiting = []
+    seq = 0
+    exhausted = False
+    while True:
+        now = time.time()
+        while not exhausted and len(socket_map) + len(waiting) < concurrency:
+            try:
+                key, host, path = targets.next()
+            except StopIteration:
+                exhausted = True
+                break
+            wait = limiter and limiter.reserve(host) or 0
+            heapq.heappush(waiting, (now + wait, seq, key, host, path))
+            seq += 1
+        while waiting and waiting[0][0] <= now:
+            start, _, key, host, path = heapq.heappop(waiting)
+            try:
+                RefDiscovery(key, host, path, socket_map, done, timeout)
+            except (socket.error, Error), e:
+                done.append((key, None, e))
+
+        if socket_map:
+            asyncore.loop(timeout=0.1, map=socket_map, count=1)
+            now = time.time()
+            for conn in socket_map.values():
+                if now > conn.deadline:
+                    conn.finish(Timeout('Timed out after %ds' % timeout))
+        elif waiting:
+            time.sleep(max(0, min(0.1, waiting[0][0] - now)))
+
+        while done:
+            yield done.pop()
+        if exhausted and not socket_map and not waiting:
+            return
+
+def discover(host, path, timeout=10):
+    """The refs advertised for path on host.  Raises Error (or
+    socket.error) if we can't get them."""
+    for key, refs, error in discover_all([(None, host, path)], timeout=timeout):
+        if error is not None:
+            raise error
+        return refs
+
+def advertised_heads(refs):
+    """The sha1s that refs point at, leaving out peeled tags"""
+    return set(sha1 for name, sha1 in refs.iteritems() if not name.endswith('^{}'))
+
+def has_changed(repo, refs):
+    """Whether refs advertise anything beyond the remote heads we
+    have already indexed for repo."""
+    if not repo.remote_heads:
+        return True
+    return bool(advertised_heads(refs) - set(repo.remote_heads))
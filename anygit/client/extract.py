@@ -0,0 +1,62 @@
+"""
+Pulling repositories out of pages as they download.
+
+A directory page can list tens of thousands of repositories.  Rather
+than holding all of it and matching afterwards, a StreamExtractor is
+fed the page a chunk at a time and matches as it goes, holding back
+only the tail of the page a match could still be growing into.  So
+it needs memory for a chunk and a couple of matches, however big the
+page is.  What it finds is handed on a batch at a time.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamExtractor(object):
+    """Finds the matches of regex in a stream of chunks, and calls sink
+    with lists of what convert (a function of the match, returning None
+    to skip it) makes of them, batch at a time.  Matches are assumed
+    to be no longer than max_match."""
+    def __init__(self, regex, convert, sink, batch=1000, max_match=4096):
+        self.regex = regex
+        self.convert = convert
+        self.sink = sink
+        self.batch = batch
+        self.max_match = max_match
+        self._buffer = ''
+        self._found = []
+        self.count = 0
+
+    def feed(self, chunk):
+        buffer = self._buffer + chunk
+        # Matches ending this close to the end might still grow
+        safe = len(buffer) - self.max_match
+        cut = max(safe, 0)
+        for match in self.regex.finditer(buffer):
+            if match.end() > safe:
+                # Keep it to look at again with more of the page
+                cut = match.start()
+                break
+            self._found_match(match)
+            cut = max(cut, match.end())
+        self._buffer = buffer[cut:]
+        if len(self._found) >= self.batch:
+            self._flush()
+
+    def close(self):
+        for match in self.regex.finditer(self._buffer):
+            self._found_match(match)
+        self._buffer = ''
+        self._flush()
+
+    def _found_match(self, match):
+        value = self.convert(match)
+        if value is not None:
+            self._found.append(value)
+            self.count += 1
+
+    def _flush(self):
+        if self._found:
+            self.sink(self._found)
+            self._found = []
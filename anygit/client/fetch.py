@@ -1,14 +1,20 @@
+import binascii
 import datetime
 from dulwich import client, object_store, pack
 import logging
 import os
+import stat
 import sys
 import tempfile
-import threading
 import traceback
 
 from anygit import models
+from anygit.client import discovery
+from anygit.client import lease
+from anygit.client import packstore
+from anygit.client import scheduler
 from anygit.data import exceptions
+from anygit.data import hyperloglog
 
 try:
     import multiprocessing
@@ -18,6 +24,19 @@ except ImportError:
 DIR = os.path.dirname(__file__)
 logger = logging.getLogger(__name__)
 timeout = 10
+# How many objects to check for at once when counting new objects
+count_batch = 1000
+# How many objects to index between checkpoints
+checkpoint_interval = 10000
+# Roughly how many bytes of pack to fetch per round, by default
+fetch_budget = 256 * 1024 * 1024
+# How far past its budget a round may go before it's abandoned
+max_overshoot = 2
+# What we take a want to cost until a round has told us otherwise
+initial_bytes_per_want = 16 * 1024 * 1024
+# What the packs we fetch are called
+pack_prefix = 'anygit-'
+pack_suffix = '.pack'
 
 
 class Error(Exception):
@@ -28,43 +47,89 @@ class DieFile(Error):
     pass
 
 
-class Checker(threading.Thread):
-    valid = None
-    def __init__(self, repo):
-        super(Checker, self).__init__()
-        self.repo = repo
+class PackTooLarge(Error):
+    pass
 
-    def run(self):
-        if not self.repo.url:
-            return
 
-        try:
-            fetch(self.repo, state={}, discover_only=True)
-        except Exception, e:
-            self.valid = False
-        else:
-            self.valid = True
+class LeaseLost(Error):
+    pass
+
 
 def check_validity(repo):
-    c = Checker(repo)
-    c.start()
-    c.join(timeout)
-    # TODO: could still be open...
-    if c.isAlive() or not c.valid:
+    if not repo.url:
+        return False
+    try:
+        discovery.discover(repo.host, repo.path, timeout=timeout)
+    except Exception, e:
+        logger.debug('Could not talk to %s: %s' % (repo, e))
         return False
     else:
         return True
 
+def _order_wants(refs_dict, wants):
+    """Order wants so that the ones likely to carry the most history
+    come first: HEAD, then branches, then tags in name order (which
+    is roughly the order they were made).  Later rounds can then offer
+    what earlier ones fetched as haves, and get only what's new."""
+    def rank(item):
+        name, sha1 = item
+        if name == 'HEAD':
+            return (0, name)
+        elif name.startswith('refs/heads/'):
+            return (1, name)
+        elif name.startswith('refs/tags/'):
+            return (2, name)
+        else:
+            return (3, name)
+    ordered = []
+    for name, sha1 in sorted(refs_dict.iteritems(), key=rank):
+        if sha1 in wants:
+            ordered.append(sha1)
+            wants.discard(sha1)
+    return ordered + list(wants)
+
+def _round_size(state, budget):
+    """How many wants we expect to fit in a round of budget bytes"""
+    per_want = state.get('bytes_per_want', initial_bytes_per_want)
+    return max(1, int(budget / per_want))
+
+def _close_client(c):
+    """Hang up on the git daemon.  Not every version of dulwich's
+    clients can be closed; those that can't close their connection
+    once a fetch is done."""
+    close = getattr(c, 'close', None)
+    if close is not None:
+        close()
+
+def _observe_round(state, size, wants):
+    """Fold the size of a round's pack into the estimate of bytes per want"""
+    if not wants:
+        return
+    observed = float(size) / wants
+    previous = state.get('bytes_per_want')
+    if previous is None:
+        state['bytes_per_want'] = observed
+    else:
+        state['bytes_per_want'] = (previous + observed) / 2
+
 def fetch(repo, state, recover_mode=False, discover_only=False,
-          get_count=False, packfile=None, batch=None):
+          get_count=False, packfile=None, batch=None, budget=None):
     """Fetch data from a remote.  If recover_mode, will fetch all data
     as if we had indexed none of it.  Otherwise will do the right thing
-    with the pack protocol.  If discover_only, will fetch no data."""
+    with the pack protocol.  If discover_only, will fetch no data.
+
+    If batch, asks for at most batch remote heads per round.  If
+    budget, asks for as many as previous rounds (or before them,
+    initial_bytes_per_want) suggest will fit in about budget bytes,
+    and abandons (then retries with half as many)
+    a round that runs to max_overshoot times that.  Either way, sets
+    state['has_extra'] if there are heads left for another round."""
     if packfile:
         return packfile
 
     logger.info('Fetching from %s' % repo)
     def determine_wants(refs_dict):
+        state['wants'] = []
         # We don't want anything, just seeing if you exist.
         if discover_only:
             return []
@@ -81,25 +146,23 @@ def fetch(repo, state, recover_mode=False, discover_only=False,
         else:
             matching_commits = set()
         remote_heads = set(v for k, v in refs_dict.iteritems() if '^{}' not in k)
-        remote_heads -= state.setdefault('retrieved', set())
         # Don't clobber the existing remote heads just yet, in case we crash
         repo.set_new_remote_heads(remote_heads)
         repo.save()
-        missing_commits = remote_heads - matching_commits
-        # The commits we already have
-        present_commits = remote_heads.intersection(matching_commits)
+        missing_commits = remote_heads - matching_commits - state.setdefault('retrieved', set())
         logger.debug('Requesting %d remote heads for %s.' % (len(missing_commits), repo))
-        wants = list(missing_commits)
-        if batch:
-            logger.info("I'd really like %d commits, but only requesting %d due to batch size" %
-                        (len(wants), batch))
-            if len(wants) > batch:
-                state['has_extra'] = True
-            else:
-                state['has_extra'] = False
-            wants = wants[0:batch]
-        l = state.setdefault('retrieved', set())
-        l.update(wants)
+        wants = _order_wants(refs_dict, missing_commits)
+        limits = [limit for limit in (batch,
+                                      budget and _round_size(state, budget),
+                                      state.get('max_wants'))
+                  if limit]
+        state['has_extra'] = False
+        if limits and len(wants) > min(limits):
+            logger.info("I'd really like %d commits, but only requesting %d this round" %
+                        (len(wants), min(limits)))
+            state['has_extra'] = True
+            wants = wants[:min(limits)]
+        state['wants'] = wants
         return wants
 
     def get_parents(sha1):
@@ -110,26 +173,49 @@ def fetch(repo, state, recover_mode=False, discover_only=False,
         else:
             return [p.id for p in c.parents if p.type == 'commit' and repo.id in p.repository_ids]
 
-    destfd, destfile_name = tempfile.mkstemp()
-    destfile = os.fdopen(destfd, 'w')
-    logger.debug('Writing to %s' % destfile_name)
-    def pack_data(data):
-        destfile.write(data)
-
     def progress(progress):
         pass
 
-    graph_walker = object_store.ObjectStoreGraphWalker(repo.remote_heads or [],
-                                                       get_parents)
     assert repo.host
     assert repo.path
-    c = client.TCPGitClient(repo.host)
-    c.fetch_pack(path=repo.path,
-                 determine_wants=determine_wants,
-                 graph_walker=graph_walker,
-                 pack_data=pack_data,
-                 progress=progress)
+    while True:
+        destfd, destfile_name = tempfile.mkstemp(prefix=pack_prefix, suffix=pack_suffix)
+        destfile = os.fdopen(destfd, 'w')
+        logger.debug('Writing to %s' % destfile_name)
+        written = [0]
+        def pack_data(data):
+            written[0] += len(data)
+            if budget and written[0] > budget * max_overshoot and len(state['wants']) > 1:
+                raise PackTooLarge('Pack for %d wants passed %d bytes' %
+                                   (len(state['wants']), written[0]))
+            destfile.write(data)
+
+        # Offer what earlier rounds fetched, too
+        haves = set(repo.remote_heads or []).union(state.get('retrieved', ()))
+        graph_walker = object_store.ObjectStoreGraphWalker(list(haves), get_parents)
+        c = client.TCPGitClient(repo.host)
+        try:
+            try:
+                c.fetch_pack(path=repo.path,
+                             determine_wants=determine_wants,
+                             graph_walker=graph_walker,
+                             pack_data=pack_data,
+                             progress=progress)
+            finally:
+                _close_client(c)
+        except PackTooLarge, e:
+            destfile.close()
+            os.unlink(destfile_name)
+            # What we saw so far is a lower bound on the real size
+            _observe_round(state, written[0], len(state['wants']))
+            state['max_wants'] = len(state['wants']) // 2
+            logger.info('%s; trying again with %d' % (e, state['max_wants']))
+            continue
+        break
     destfile.close()
+    _observe_round(state, written[0], len(state['wants']))
+    state.pop('max_wants', None)
+    state['retrieved'].update(state['wants'])
     return destfile_name
 
 def _objectify(id, type):
@@ -149,6 +235,16 @@ def _get_objects_iterator(data, is_path):
     uncompressed_pack = pack.Pack.from_objects(pack_data, None)
     return uncompressed_pack
 
+def _entry_type(mode):
+    """The type of the object a tree entry with mode points at"""
+    if stat.S_ISDIR(mode):
+        return 'tree'
+    elif mode & 0170000 == 0160000:
+        # A submodule
+        return 'commit'
+    else:
+        return 'blob'
+
 def _process_object(repo, obj, progress, type_mapper):
     # obj is Dulwich object
     # indexed_object will be the MongoDBModel we create
@@ -157,8 +253,9 @@ def _process_object(repo, obj, progress, type_mapper):
     if obj._type == 'tree':
         indexed_object = models.Tree.get_from_cache_or_new(id=obj.id)
         for name, mode, sha1 in obj.iteritems():
-            # Default the type of the child object to a commit (a submodule)
-            child_type = type_mapper.setdefault(sha1, 'commit')
+            # A child from an earlier pack gains a parent, so is
+            # cleaned (and summarized) along with this pack's objects
+            child_type = type_mapper.setdefault(sha1, _entry_type(mode))
             if child_type == 'tree':
                 child = models.Tree.get_from_cache_or_new(id=sha1)
                 child.add_parent(indexed_object, name=name, mode=mode)
@@ -174,6 +271,7 @@ def _process_object(repo, obj, progress, type_mapper):
         indexed_object = models.Commit.get_from_cache_or_new(id=obj.id)
         indexed_object.add_parents(obj.parents)
 
+        type_mapper.setdefault(obj.tree, 'tree')
         child = models.Tree.get_from_cache_or_new(id=obj.tree)
         child.add_commit(indexed_object)
         child.save()
@@ -193,31 +291,195 @@ def _process_object(repo, obj, progress, type_mapper):
         raise ValueError('Unrecognized git object type %s' % obj._type)
     indexed_object.save()
 
-def _process_data(repo, uncompressed_pack, progress):
-    logger.info('Dirtying objects for %s' % repo)
-    type_mapper = {}
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _dirty_objects(repo, uncompressed_pack, type_mapper, skip=0):
+    """Store every object in the pack as dirty and in repo, counting
+    the new ones as we go.  The first skip objects were done before a
+    checkpoint, so are only added to type_mapper."""
+    new = []
+    sketch = hyperloglog.HyperLogLog()
+    pairs = ((obj.id, obj._type) for obj in uncompressed_pack.iterobjects())
+    offset = last_checkpoint = 0
+    for batch in _batches(pairs, count_batch):
+        todo = batch[max(0, skip - offset):]
+        offset += len(batch)
+        for id, type in batch:
+            type_mapper[id] = type
+        if not todo:
+            continue
+        known = models.GitObject.known_ids(id for id, type in todo)
+        for id, type in todo:
+            sketch.add(id)
+            if id not in known:
+                new.append((id, type))
+            dirty = _objectify(id=id, type=type)
+            dirty.mark_dirty(True)
+            dirty.add_repository(repo)
+            dirty.save()
+        if offset - last_checkpoint >= checkpoint_interval:
+            # The objects are about to be in the database, so they count
+            _update_counts(repo, new, sketch)
+            _checkpoint(repo, 'dirty', offset)
+            new = []
+            sketch = hyperloglog.HyperLogLog()
+            last_checkpoint = offset
+    _update_counts(repo, new, sketch)
+
+def _update_counts(repo, new, sketch):
+    """Add the (id, type) pairs of new objects from _dirty_objects to
+    the aggregate and prefix counts, and the sketch to the
+    repository's.  Racing indexers may count an object twice;
+    bin/aggregator reconcile fixes up any drift."""
+    new_counts = {}
+    for id, type in new:
+        new_counts[type] = new_counts.get(type, 0) + 1
+    aggregate = models.Aggregate.get()
+    for type, count in new_counts.iteritems():
+        aggregate.increment('%s_count' % type, count)
+    models.GitObject.count_new(new)
+    repo.add_sketch(sketch)
+    repo.save()
+    logger.info('Found about %d distinct objects for %s, %d of them new' %
+                (sketch.cardinality(), repo, len(new)))
+
+def _full_type_map(uncompressed_pack):
+    """The type_mapper that dirtying and processing the pack would
+    have built, for resuming after them."""
+    type_mapper = dict((obj.id, obj._type) for obj in uncompressed_pack.iterobjects())
     for obj in uncompressed_pack.iterobjects():
-        type_mapper[obj.id] = obj._type
-        dirty = _objectify(id=obj.id, type=obj._type)
-        dirty.mark_dirty(True)
-        dirty.add_repository(repo)
-        dirty.save()
-    logger.info('Constructed object type map of size %s (%d bytes) for %s' %
-                (len(type_mapper), type_mapper.__sizeof__(), repo))
+        if obj._type == 'tree':
+            for name, mode, sha1 in obj.iteritems():
+                type_mapper.setdefault(sha1, _entry_type(mode))
+        elif obj._type == 'commit':
+            type_mapper.setdefault(obj.tree, 'tree')
+    return type_mapper
+
+def _checkpoint(repo, phase, offset):
+    """Flush everything so far, then record that it's done"""
     models.flush()
+    if repo.checkpoint_pack is None:
+        return
+    repo.set_checkpoint(repo.checkpoint_pack, repo.checkpoint_checksum, phase, offset)
+    repo.save()
+    models.flush()
+    logger.debug('Checkpointed %s at object %d of the %s phase' % (repo, offset, phase))
 
-    logger.info('Now processing objects for %s' % repo)
-    for obj in uncompressed_pack.iterobjects():
-        _process_object(repo=repo,
-                        obj=obj,
-                        progress=progress,
-                        type_mapper=type_mapper)
+def _process_data(repo, uncompressed_pack, progress):
+    # Where to pick up from, if we have been here before
+    phase = repo.checkpoint_phase or 'dirty'
+    skip = repo.checkpoint_offset or 0
+    if phase == 'dirty':
+        logger.info('Dirtying objects for %s' % repo)
+        type_mapper = {}
+        _dirty_objects(repo, uncompressed_pack, type_mapper, skip=skip)
+        logger.info('Constructed object type map of size %s (%d bytes) for %s' %
+                    (len(type_mapper), type_mapper.__sizeof__(), repo))
+        _checkpoint(repo, 'process', 0)
+        phase, skip = 'process', 0
+    else:
+        logger.info('Resuming the %s phase for %s at object %d' % (phase, repo, skip))
+        type_mapper = _full_type_map(uncompressed_pack)
+
+    if phase == 'process':
+        logger.info('Now processing objects for %s' % repo)
+        for offset, obj in enumerate(uncompressed_pack.iterobjects()):
+            if offset < skip:
+                continue
+            _process_object(repo=repo,
+                            obj=obj,
+                            progress=progress,
+                            type_mapper=type_mapper)
+            if not (offset + 1) % checkpoint_interval:
+                _checkpoint(repo, 'process', offset + 1)
+        _checkpoint(repo, 'clean', 0)
+        phase, skip = 'clean', 0
 
     logger.info('Cleaning objects for %s' % repo)
-    for id, type in type_mapper.iteritems():
-        dirty = _objectify(id=id, type=type)
-        dirty.mark_dirty(False)
-        dirty.save()
+    # Sorted, so that the order survives a restart
+    ids = sorted(type_mapper)[skip:]
+    offset = skip
+    for batch in _batches(ids, count_batch):
+        # Every edge this pack adds is in the database by now, so the
+        # counts are up to date
+        summaries = models.GitObject.summarize(batch)
+        for id in batch:
+            dirty = _objectify(id=id, type=type_mapper[id])
+            dirty.mark_dirty(False)
+            if id in summaries:
+                dirty.set_summary(**summaries[id])
+            dirty.save()
+            offset += 1
+            if not offset % checkpoint_interval:
+                _checkpoint(repo, 'clean', offset)
+
+def _resume_point(repo):
+    """The pack file repo's checkpoint is in, if it is still there
+    and intact.  Otherwise forgets the checkpoint."""
+    path = repo.checkpoint_pack
+    if not path:
+        return None
+    try:
+        intact = packstore.pack_checksum(path) == repo.checkpoint_checksum
+    except (IOError, OSError), e:
+        logger.info('Could not read checkpointed pack %s: %s' % (path, e))
+        intact = False
+    if intact:
+        return path
+    logger.info('Discarding checkpoint for %s' % repo)
+    repo.clear_checkpoint()
+    repo.save()
+    models.flush()
+    return None
+
+def _fetched(path):
+    """Whether path is a pack we fetched, rather than one we were given"""
+    name = os.path.basename(path)
+    return name.startswith(pack_prefix) and name.endswith(pack_suffix)
+
+def _remove_pack(path):
+    """Remove path if it is a pack we fetched"""
+    if not _fetched(path):
+        return
+    try:
+        os.unlink(path)
+    except OSError, e:
+        logger.error('Could not remove tmpfile %s.: %s' % (path, e))
+
+def _retire_pack(repo, path, store, complete):
+    """We're done indexing path, so keep it in store if there is one
+    (complete saying whether it was fetched with no haves), or else
+    remove it."""
+    if store and _fetched(path):
+        try:
+            store.add(repo, path, complete=complete)
+            return
+        except (IOError, OSError), e:
+            logger.error('Could not store %s: %s' % (path, e))
+    _remove_pack(path)
+
+def _replay(repo, store):
+    """Index the packs stored for repo, picking up from a checkpoint
+    in one of them if there is one."""
+    packs = store.packs(repo)
+    if repo.checkpoint_pack in packs:
+        packs = packs[packs.index(repo.checkpoint_pack):]
+    logger.info('Replaying %d stored packs for %s' % (len(packs), repo))
+    for path in packs:
+        index_data(path, repo, is_path=True)
+
+def _check_lease(repo_lease):
+    """Give up if someone else may be indexing the repository now"""
+    if repo_lease.lost:
+        raise LeaseLost('Lost the lease on %s' % repo_lease.repo)
 
 def index_data(data, repo, is_path=False):
     if is_path:
@@ -229,6 +491,11 @@ def index_data(data, repo, is_path=False):
         logger.info('No data to index')
         return
     objects_iterator = _get_objects_iterator(data, is_path)
+    if is_path and repo.checkpoint_pack != data:
+        # Start checkpointing, so a restart can pick up where we leave off
+        repo.set_checkpoint(data, packstore.pack_checksum(data), 'dirty', 0)
+        repo.save()
+        models.flush()
     counter = {'count' : 0}
     def progress(object):
         counter['count'] += 1
@@ -239,61 +506,131 @@ def index_data(data, repo, is_path=False):
                                                                                  object._type,
                                                                                  object.id))
     _process_data(repo, objects_iterator, progress)
+    repo.clear_checkpoint()
+    repo.save()
+    models.flush()
 
-def fetch_and_index(repo, recover_mode=False, packfile=None, batch=None):
+def fetch_and_index(repo, recover_mode=False, packfile=None, batch=None, resume=True,
+                    budget=None, local=True, refs=None):
+    """Fetch new objects from repo and index them, in rounds of about
+    budget bytes (fetch_budget by default; 0 for no limit).  If resume
+    and repo has a checkpoint from an earlier attempt that died, pick
+    up from it using the pack that attempt fetched, rather than
+    starting over.  If recover_mode and local, and the pack store
+    has repo's packs, replays those and only fetches what's newer.
+    refs are repo's refs if they have just been discovered (as by
+    the scheduler), so needn't be again."""
     check_for_die_file()
     if isinstance(repo, basestring):
         repo = models.Repository.get(repo)
     repo.refresh()
-    # There's a race condition here where two indexing processes might
-    # try to index the same repo.  However, since it's idempotent,
-    # this is not harmful beyond wasting resources.  However, we check
-    # here to try to minimize the damage.
-    if repo.indexing:
+    # Don't let other people try to index in parallel.  Should we die
+    # without releasing it, the lease runs out and someone else can
+    # pick the repo up.
+    repo_lease = lease.Lease(repo)
+    if not repo_lease.acquire():
         logger.error('Repo is already being indexed')
         return
     logger.info('Beginning to index: %s' % repo)
     now = datetime.datetime.now()
     data_path = None
+    if budget is None:
+        budget = fetch_budget
+    store = packstore.from_config()
+    complete = False
+    more = False
 
     try:
-        # Don't let other people try to index in parallel
-        repo.indexing = True
-        repo.save()
-        models.flush()
-        state = {}
-        while True:
-            data_path = fetch(repo, recover_mode=recover_mode,
-                              packfile=packfile, batch=batch, state=state)
+        if resume:
+            data_path = _resume_point(repo)
+        elif repo.checkpoint_pack:
+            logger.info('Discarding checkpoint for %s' % repo)
+            _remove_pack(repo.checkpoint_pack)
+            repo.clear_checkpoint()
+        if data_path and store and store.contains(data_path):
+            # We died replaying; _replay picks up from the checkpoint
+            data_path = None
+            recover_mode = True
+        if recover_mode and local and store and store.packs(repo):
+            if data_path:
+                # A fetch that died before it was stored.  The fetch
+                # after the replay asks for everything it had again.
+                _remove_pack(data_path)
+                data_path = None
+            _replay(repo, store)
+            _check_lease(repo_lease)
+            # Everything in the store is indexed, so the remote only
+            # needs to send what's newer
+            recover_mode = False
+        elif data_path:
+            logger.info('Resuming %s from its checkpoint in %s' % (repo, data_path))
             index_data(data_path, repo, is_path=True)
-            if not state.get('has_extra'):
-                break
-            else:
-                logger.info('Still more remote heads, running again...')
-        repo.count = repo.count_objects()
+            _check_lease(repo_lease)
+            # A fetch in rounds may have had more to come.  What it
+            # already fetched is indexed now, so needn't be recovered.
+            more = (batch or budget) and not packfile
+            recover_mode = False
+        elif not (recover_mode or packfile) and repo.remote_heads:
+            if refs is None:
+                refs = discovery.discover(repo.host, repo.path, timeout=timeout)
+            if not discovery.has_changed(repo, refs):
+                logger.info('No new remote heads for %s; skipping' % repo)
+                # Not indexed, so last_index stays put
+                repo.last_validated = now
+                repo.requested = False
+                repo.save()
+                return
+        if not data_path or more:
+            state = {}
+            # A fetch with no haves has everything, so starts the
+            # repo's packs in the store afresh
+            complete = recover_mode or not repo.remote_heads
+            while True:
+                if data_path:
+                    _retire_pack(repo, data_path, store, complete)
+                    complete = False
+                data_path = fetch(repo, recover_mode=recover_mode,
+                                  packfile=packfile, batch=batch, budget=budget,
+                                  state=state)
+                index_data(data_path, repo, is_path=True)
+                _check_lease(repo_lease)
+                if not state.get('has_extra'):
+                    break
+                else:
+                    logger.info('Still more remote heads, running again...')
+        if data_path:
+            _retire_pack(repo, data_path, store, complete)
+            data_path = None
+        _check_lease(repo_lease)
+        if not repo.been_indexed:
+            models.Aggregate.get().increment('indexed_repository_count')
         repo.last_index = now
         repo.been_indexed = True
+        repo.requested = False
         # Finally, clobber the old remote heads.
         repo.set_remote_heads(repo.new_remote_heads)
         repo.set_new_remote_heads([])
         repo.save()
+    except LeaseLost, e:
+        logger.error('%s; leaving it to whoever has it' % e)
     except Exception, e:
         logger.error('Had a problem: %s' % traceback.format_exc())
     finally:
-        if not packfile and data_path:
-            try:
-                os.unlink(data_path)
-            except IOError, e:
-                logger.error('Could not remove tmpfile %s.: %s' % (data_path, e))
-        repo.indexing = False
+        # Keep the pack around if there's a checkpoint to resume from
+        if data_path and data_path != repo.checkpoint_pack:
+            _remove_pack(data_path)
         repo.save()
         models.flush()
+        repo_lease.release()
     logger.info('Done with %s' % repo)
 
-def fetch_and_index_threaded(repo):
+def fetch_and_index_threaded(job):
+    """fetch_and_index in a pool worker.  job is a repository id and
+    its refs (or None)."""
+    repo, refs = job
     models.setup()
     try:
-        return fetch_and_index(repo)
+        return fetch_and_index(repo, refs=refs)
     except DieFile:
         # TODO: do something to terminate the controller process too
         sys.exit(1)
@@ -302,14 +639,24 @@ def fetch_and_index_threaded(repo):
         raise
 
 def index_all(last_index=None, threads=1):
-    repos = list(models.Repository.get_indexed_before(last_index))
+    """Index the approved repositories that have changed, as found
+    by polling their refs (see scheduler), most deserving first.
+    Any number of these can run at once, on any number of machines;
+    each repository is only indexed by whoever holds its lease."""
+    reaped = models.Repository.reap_leases()
+    if reaped:
+        logger.info('Reclaimed %d expired leases' % reaped)
+    candidates = models.Repository.get_indexed_before(last_index)
+    polls = scheduler.Scheduler(timeout=timeout)
+    repos = polls.schedule(candidates)
     logger.info('About to index %d repos' % len(repos))
+    # The scheduler has just discovered their refs
     if threads > 1:
-        repo_ids = [r.id for r in repos]
+        jobs = [(r.id, polls.refs.get(r.id)) for r in repos]
         pool = multiprocessing.Pool(threads)
-        pool.map(fetch_and_index_threaded, repo_ids)
+        pool.map(fetch_and_index_threaded, jobs)
     else:
-        [fetch_and_index(repo) for repo in repos]
+        [fetch_and_index(repo, refs=polls.refs.get(repo.id)) for repo in repos]
 
 def check_for_die_file():
     if os.path.exists(os.path.join(DIR, 'die')):
@@ -317,6 +664,9 @@ def check_for_die_file():
         raise DieFile('Die file encountered')
 
 def refresh_all_counts(all=None):
+    """Recount everything from scratch.  The counts are kept up to
+    date as we index, so this is only needed to reconcile them with
+    the database now and then."""
     aggregator = models.Aggregate.get()
     aggregator.refresh_all_counts(all=all)
     aggregator.save()
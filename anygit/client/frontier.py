@@ -0,0 +1,276 @@
+"""
+The GitHub spider's frontier: the users it has found, and how far it
+has got with each.
+
+Changes are appended to a log, so recording one costs a short write
+however big the frontier grows.  Once the log outgrows the snapshot,
+it is compacted into a new snapshot and started afresh, which keeps
+the total I/O linear.  Opening a frontier reads the snapshot and
+replays the log since.  Whether to compact is checked after every
+change, and on opening, since the log may have grown under spiders
+that have since exited.  Both are plain text, one record per line:
+
+    add <user>
+    take <user> <worker>
+    done <user>
+    requeue <user>
+
+Any number of spiders can share a frontier.  Each change is made
+holding a lock on it, after catching up on whatever the others have
+appended, so no two spiders take the same user.  Each spider is
+named for its host and process unless given a name, and names must
+be unique.  A user taken by a spider that died is put back when a
+spider on the same host opens the frontier, or when a named spider
+starts again under its name (or someone calls requeue for it).
+"""
+import codecs
+import errno
+import fcntl
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+# Never compact a log with fewer records than this
+min_compact = 10000
+
+
+def default_worker():
+    """Names this spider process"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def _dead(worker):
+    """Whether worker is a spider named by default_worker on this
+    host that is no longer running"""
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError, e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class Frontier(object):
+    def __init__(self, path, worker=None):
+        self.path = path
+        self.worker = worker or default_worker()
+        self._snapshot_path = path + '.snapshot'
+        self._log_path = path + '.log'
+        self._lock_file = open(path + '.lock', 'a')
+        self._log = None
+        self._lock()
+        try:
+            self._reload()
+            for owner in set(self.taken.itervalues()):
+                if owner == self.worker or _dead(owner):
+                    self._requeue(owner)
+            self._maybe_compact()
+        finally:
+            self._unlock()
+
+    def _lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def empty(self):
+        return not (self.pending or self.taken or self.done)
+
+    def add(self, users, done=False):
+        """Record that users exist; if done, that they need no
+        spidering.  Returns how many we hadn't seen."""
+        self._lock()
+        try:
+            self._catch_up()
+            added = 0
+            for user in users:
+                if user in self.pending or user in self.taken or user in self.done:
+                    continue
+                self._append('add', user)
+                if done:
+                    self._append('done', user)
+                added += 1
+            self._maybe_compact()
+            return added
+        finally:
+            self._unlock()
+
+    def take(self):
+        """Claim a pending user for this worker, or None if there are
+        none."""
+        self._lock()
+        try:
+            self._catch_up()
+            if not self.pending:
+                return None
+            user = iter(self.pending).next()
+            self._append('take', user, self.worker)
+            self._maybe_compact()
+            return user
+        finally:
+            self._unlock()
+
+    def finish(self, user):
+        self._lock()
+        try:
+            self._catch_up()
+            self._append('done', user)
+            self._maybe_compact()
+        finally:
+            self._unlock()
+
+    def requeue(self, worker):
+        """Put back the users worker took but didn't finish"""
+        self._lock()
+        try:
+            self._catch_up()
+            requeued = self._requeue(worker)
+            self._maybe_compact()
+            return requeued
+        finally:
+            self._unlock()
+
+    def _requeue(self, worker):
+        users = [user for user, owner in self.taken.iteritems() if owner == worker]
+        for user in users:
+            self._append('requeue', user)
+        if users:
+            logger.info('Requeued %d users left by %s' % (len(users), worker))
+        return len(users)
+
+    def close(self):
+        self._log.close()
+        self._lock_file.close()
+
+    ## State
+
+    def _apply(self, op, user, owner=None):
+        if op == 'add':
+            if user not in self.taken and user not in self.done:
+                self.pending.add(user)
+        elif op == 'take':
+            self.pending.discard(user)
+            self.taken[user] = owner
+        elif op == 'done':
+            self.pending.discard(user)
+            self.taken.pop(user, None)
+            self.done.add(user)
+        elif op == 'requeue':
+            if self.taken.pop(user, None) is not None:
+                self.pending.add(user)
+        else:
+            logger.error('Unknown frontier record %s %s' % (op, user))
+
+    def _replay(self, lines):
+        for line in lines:
+            self._apply(*line.rstrip('\n').split('\t'))
+
+    ## Files
+
+    def _reload(self):
+        """Rebuild the state from the snapshot and log"""
+        self.pending = set()
+        self.taken = {}
+        self.done = set()
+        self.generation = 0
+        if os.path.exists(self._snapshot_path):
+            f = codecs.open(self._snapshot_path, 'r', 'utf-8')
+            try:
+                self.generation = _read_generation(f)
+                self._replay(f)
+            finally:
+                f.close()
+        self._snapshot_size = len(self.pending) + len(self.taken) + len(self.done)
+        if self._log is not None:
+            self._log.close()
+        self._log = None
+        if os.path.exists(self._log_path):
+            f = open(self._log_path, 'a+')
+            f.seek(0)
+            if _read_generation(f) == self.generation:
+                self._log = f
+            else:
+                # Left over from before the snapshot was written, and
+                # already in it
+                f.close()
+        if self._log is None:
+            self._log = _start_log(self._log_path, self.generation)
+        self._inode = os.fstat(self._log.fileno()).st_ino
+        self._offset = self._log.tell()
+        self._records = 0
+        self._catch_up()
+
+    def _catch_up(self):
+        """Apply whatever has been appended since we last looked"""
+        if os.stat(self._log_path).st_ino != self._inode:
+            # Someone compacted it
+            self._reload()
+            return
+        self._log.seek(self._offset)
+        data = self._log.read()
+        end = data.rfind('\n') + 1
+        if end < len(data):
+            # A spider died partway through a write
+            self._log.truncate(self._offset + end)
+        lines = data[:end].decode('utf-8').splitlines()
+        self._replay(lines)
+        self._records += len(lines)
+        self._offset += end
+
+    def _append(self, *fields):
+        line = ('\t'.join(fields) + '\n').encode('utf-8')
+        self._log.seek(0, os.SEEK_END)
+        self._log.write(line)
+        self._log.flush()
+        self._offset += len(line)
+        self._records += 1
+        self._apply(*fields)
+
+    def _maybe_compact(self):
+        if self._records >= max(min_compact, self._snapshot_size):
+            self.compact()
+
+    def compact(self):
+        """Write the state out as a new snapshot and start a new log.
+        Must hold the lock."""
+        generation = self.generation + 1
+        tmp = self._snapshot_path + '~'
+        f = codecs.open(tmp, 'w', 'utf-8')
+        try:
+            f.write('generation %d\n' % generation)
+            for user in self.pending:
+                f.write('add\t%s\n' % user)
+            for user, owner in self.taken.iteritems():
+                f.write('add\t%s\ntake\t%s\t%s\n' % (user, user, owner))
+            for user in self.done:
+                f.write('done\t%s\n' % user)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        # If we die between these, the old log's generation shows it
+        # is already in the new snapshot
+        os.rename(tmp, self._snapshot_path)
+        self._log.close()
+        self._log = None
+        os.unlink(self._log_path)
+        self._reload()
+        logger.info('Compacted the frontier: %d pending, %d taken, %d done' %
+                    (len(self.pending), len(self.taken), len(self.done)))
+
+
+def _read_generation(f):
+    return int(f.readline().split()[1])
+
+def _start_log(path, generation):
+    tmp = path + '~'
+    f = open(tmp, 'w')
+    f.write('generation %d\n' % generation)
+    f.close()
+    os.rename(tmp, path)
+    f = open(path, 'a+')
+    f.seek(0, os.SEEK_END)
+    return f
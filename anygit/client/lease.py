@@ -0,0 +1,72 @@
+"""
+Leases on indexing repositories.
+
+An indexer claims a repository's lease before indexing it, and renews
+it from a heartbeat thread for as long as it is working.  Claiming is
+atomic, so indexers on any number of machines can share the same
+repositories; if an indexer dies, its lease runs out and the next
+index_all (see Repository.reap_leases) hands the repository to
+someone else.
+"""
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+# How long a lease lasts without being renewed, in seconds
+duration = 10 * 60
+# How many times each lease is renewed before it would run out
+heartbeats = 3
+
+
+def default_owner():
+    """Identifies this indexing process"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+    """The lease on indexing repo, held by owner."""
+    def __init__(self, repo, owner=None, duration=duration):
+        self.repo = repo
+        self.owner = owner or default_owner()
+        self.duration = duration
+        self.held = False
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        """Try to claim the lease, and start renewing it if we get it.
+        Returns whether we did."""
+        self.held = self.repo.claim_lease(self.owner, self.duration)
+        if self.held:
+            self._heartbeat = threading.Thread(target=self._renew_forever)
+            self._heartbeat.setDaemon(True)
+            self._heartbeat.start()
+        return self.held
+
+    def _renew_forever(self):
+        while True:
+            self._stop.wait(float(self.duration) / heartbeats)
+            if self._stop.isSet():
+                return
+            try:
+                renewed = self.repo.renew_lease(self.owner, self.duration)
+            except Exception, e:
+                # Try again next time; the lease may outlast the trouble
+                logger.error('Could not renew lease on %s: %s' % (self.repo, e))
+                continue
+            if not renewed:
+                logger.error('Lost lease on %s; someone else may be indexing it' % self.repo)
+                self.lost = True
+                return
+
+    def release(self):
+        if not self.held:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        if not self.lost:
+            self.repo.release_lease(self.owner)
+        self.held = False
@@ -0,0 +1,192 @@
+"""
+A local store of the packs we have fetched, keyed by repository.
+
+With anygit.pack_store set to a directory, packs are kept there once
+indexed rather than thrown away, so recovering a repository can replay
+them at disk speed instead of fetching everything again.  Each
+repository gets a directory of packs, named so they sort in the order
+they were fetched:
+
+    <pack_store>/<repository id>/<time>-<checksum>.pack
+
+A repository's packs are only replayed if they start with a complete
+fetch (one with no haves); later fetches add packs of just what was
+new.  Once a repository has more than max_packs of them, they are
+consolidated into one.  When the store grows past
+anygit.pack_store_size megabytes, the least recently used
+repositories are dropped from it.
+"""
+import binascii
+from dulwich import pack
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import time
+import zlib
+
+from pylons import config
+
+logger = logging.getLogger(__name__)
+# Consolidate a repository's packs once there are more than this many
+max_packs = 8
+# Marks a repository whose packs start with a complete fetch
+complete_marker = 'complete'
+type_nums = {'commit' : 1, 'tree' : 2, 'blob' : 3, 'tag' : 4}
+
+
+def from_config():
+    """The PackStore configured in anygit.pack_store, or None"""
+    root = config.get('anygit.pack_store')
+    if not root:
+        return None
+    max_size = int(float(config.get('anygit.pack_store_size', 10240)) * 1024 * 1024)
+    return PackStore(root, max_size)
+
+
+class PackStore(object):
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def _dir(self, repo):
+        return os.path.join(self.root, repo.id)
+
+    def contains(self, path):
+        """Whether path is a pack in the store"""
+        root = os.path.join(os.path.abspath(self.root), '')
+        return os.path.abspath(path).startswith(root)
+
+    def packs(self, repo):
+        """The paths of repo's packs, oldest first.  Empty unless they
+        start with a complete fetch."""
+        dir = self._dir(repo)
+        if not os.path.exists(os.path.join(dir, complete_marker)):
+            return []
+        self._touch(repo)
+        return sorted(os.path.join(dir, name) for name in os.listdir(dir)
+                      if name.endswith('.pack'))
+
+    def add(self, repo, path, complete=False):
+        """Move the pack at path into the store for repo.  If complete,
+        it holds everything fetched from repo, so supersedes any packs
+        stored for it before."""
+        dir = self._dir(repo)
+        if not complete and not os.path.exists(os.path.join(dir, complete_marker)):
+            # Nothing to build on, so not worth keeping
+            os.unlink(path)
+            return
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        name = '%d-%s.pack' % (time.time() * 1000, pack_checksum(path))
+        shutil.move(path, os.path.join(dir, name))
+        if complete:
+            # Only once the new pack is in place, so that a pack that
+            # can't be stored doesn't cost us the ones we had
+            for old in os.listdir(dir):
+                if old not in (name, complete_marker):
+                    os.unlink(os.path.join(dir, old))
+            open(os.path.join(dir, complete_marker), 'w').close()
+        self._touch(repo)
+        logger.info('Stored %s for %s' % (name, repo))
+        if len(self.packs(repo)) > max_packs:
+            self.consolidate(repo)
+        self.evict(keep=repo)
+
+    def discard(self, repo):
+        dir = self._dir(repo)
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+
+    def _touch(self, repo):
+        os.utime(self._dir(repo), None)
+
+    def consolidate(self, repo):
+        """Rewrite repo's packs as one, dropping duplicate objects"""
+        packs = self.packs(repo)
+        dir = self._dir(repo)
+        tmp = os.path.join(dir, 'consolidating.tmp')
+        count = write_pack(tmp, _objects_in(packs))
+        name = '%d-%s.pack' % (time.time() * 1000, pack_checksum(tmp))
+        os.rename(tmp, os.path.join(dir, name))
+        for path in packs:
+            os.unlink(path)
+        logger.info('Consolidated %d packs for %s into %s (%d objects)' %
+                    (len(packs), repo, name, count))
+
+    def evict(self, keep=None):
+        """Drop the least recently used repositories until the store
+        fits in max_size, though never keep's."""
+        usage = []
+        total = 0
+        for id in os.listdir(self.root):
+            dir = os.path.join(self.root, id)
+            size = sum(os.path.getsize(os.path.join(dir, name)) for name in os.listdir(dir))
+            usage.append((os.path.getmtime(dir), id, size))
+            total += size
+        usage.sort()
+        for last_used, id, size in usage:
+            if total <= self.max_size:
+                break
+            if keep is not None and id == keep.id:
+                continue
+            logger.info('Evicting the packs for %s from the pack store' % id)
+            shutil.rmtree(os.path.join(self.root, id))
+            total -= size
+
+
+def _objects_in(paths):
+    """(sha1, type, raw data) for each object in the packs at paths"""
+    for path in paths:
+        pack_data = pack.PackData.from_path(path)
+        for obj in pack.Pack.from_objects(pack_data, None).iterobjects():
+            yield obj.id, obj._type, obj.as_raw_string()
+
+def pack_checksum(path):
+    """The SHA1 a pack file ends with, in hex"""
+    f = open(path, 'rb')
+    try:
+        f.seek(-20, os.SEEK_END)
+        return binascii.hexlify(f.read(20))
+    finally:
+        f.close()
+
+def _entry_header(type, size):
+    # Type and the low four bits of the size, then seven bits at a time
+    byte = (type_nums[type] << 4) | (size & 0x0f)
+    size >>= 4
+    header = []
+    while size:
+        header.append(chr(byte | 0x80))
+        byte = size & 0x7f
+        size >>= 7
+    header.append(chr(byte))
+    return ''.join(header)
+
+def write_pack(path, objects):
+    """Write a version 2 pack of the (sha1, type, raw data) objects,
+    undeltified and skipping repeats.  Returns how many objects it
+    holds."""
+    seen = set()
+    f = open(path, 'w+b')
+    try:
+        # The count is filled in once we know it
+        f.write('PACK' + struct.pack('>LL', 2, 0))
+        for id, type, data in objects:
+            if id in seen:
+                continue
+            seen.add(id)
+            f.write(_entry_header(type, len(data)))
+            f.write(zlib.compress(data))
+        f.seek(8)
+        f.write(struct.pack('>L', len(seen)))
+        f.seek(0)
+        checksum = hashlib.sha1()
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            checksum.update(chunk)
+        f.seek(0, os.SEEK_END)
+        f.write(checksum.digest())
+    finally:
+        f.close()
+    return len(seen)
@@ -0,0 +1,35 @@
+import threading
+import time
+
+class RateLimiter(object):
+    """Token buckets, one per key (such as a host).  Each bucket holds
+    up to burst tokens and refills at rate tokens per second.
+    Thread-safe."""
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key):
+        """Take a token for key, returning how many seconds to wait
+        before it may be used."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            # Going negative queues callers up behind each other
+            tokens -= 1
+            self._buckets[key] = (tokens, now)
+        finally:
+            self._lock.release()
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+    def acquire(self, key):
+        """Block until we may make a request to key"""
+        wait = self.reserve(key)
+        if wait:
+            time.sleep(wait)
@@ -0,0 +1,162 @@
+"""
+Decides which repositories index_all should fetch, and in what order.
+
+Most repositories haven't changed since we last indexed them, and a
+full fetch negotiation is an expensive way to find that out.  Instead
+we read each due repository's ref advertisement (see discovery), and
+only queue the ones advertising heads we haven't seen.
+
+Each repository is polled at its own interval, which shrinks when a
+poll finds changes and grows when it doesn't, so busy repositories
+are checked often and dormant ones rarely.  The changed repositories
+are indexed most deserving first: those a user asked for, then by
+how long they have gone without an index, weighted by how many
+objects they have.
+"""
+import datetime
+import logging
+import math
+
+from anygit import models
+from anygit.client import discovery
+from anygit.client import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Bounds on how often a repository is polled, in seconds
+min_interval = 60 * 60
+default_interval = 24 * 60 * 60
+max_interval = 14 * 24 * 60 * 60
+# How an interval changes after a poll that did or didn't find changes
+speedup = 0.5
+slowdown = 1.5
+# Weight of the latest poll in a repository's change rate
+rate_weight = 0.2
+
+
+def due(repo, now):
+    """Whether it's time to poll repo again"""
+    if repo.requested or not repo.been_indexed:
+        return True
+    return repo.next_poll is None or repo.next_poll <= now
+
+def priority(repo, now):
+    """How much repo deserves indexing; higher is sooner.  Requested
+    repositories come first, then the rest by the hours since they
+    were last indexed, scaled up by the number of digits in their
+    object count."""
+    last_index = repo.last_index or datetime.datetime(1970, 1, 1)
+    staleness = now - last_index
+    hours = staleness.days * 24 + staleness.seconds / 3600.0
+    return bool(repo.requested), hours * (1 + math.log10(1 + (repo.count or 0)))
+
+def observe(repo, changed, now):
+    """Record the outcome of a poll of repo, and schedule the next"""
+    interval = repo.poll_interval or default_interval
+    if changed:
+        interval *= speedup
+    else:
+        interval *= slowdown
+    interval = int(min(max_interval, max(min_interval, interval)))
+    rate = repo.change_rate
+    if rate is None:
+        rate = float(changed)
+    else:
+        rate = (1 - rate_weight) * rate + rate_weight * changed
+    repo.poll_interval = interval
+    repo.change_rate = rate
+    repo.next_poll = now + datetime.timedelta(seconds=interval)
+
+
+class Scheduler(object):
+    """Polls due repositories for changes, up to concurrency at once
+    and rate limited per host, and queues the changed ones."""
+    def __init__(self, concurrency=64, rate=1.0, burst=4, timeout=10, batch=100):
+        self.concurrency = concurrency
+        self.limiter = None
+        if rate:
+            self.limiter = ratelimit.RateLimiter(rate, burst)
+        self.timeout = timeout
+        self.batch = batch
+        self.considered = 0
+        self.checked = 0
+        self.changed = 0
+        self.errors = 0
+        self.queue = []
+        # The refs discovered for each queued repository, by id
+        self.refs = {}
+
+    def schedule(self, repos, now=None):
+        """The repositories in repos that should be indexed now, in
+        the order they should be indexed."""
+        if now is None:
+            now = datetime.datetime.now()
+        in_flight = {}
+        def targets():
+            for repo in repos:
+                self.considered += 1
+                if not due(repo, now):
+                    continue
+                if not repo.remote_heads:
+                    # Nothing to compare against, so it's changed
+                    self._record(repo, True, now)
+                    continue
+                in_flight[repo.id] = repo
+                yield repo.id, repo.host, repo.path
+        try:
+            for id, refs, error in discovery.discover_all(targets(),
+                                                          concurrency=self.concurrency,
+                                                          timeout=self.timeout,
+                                                          limiter=self.limiter):
+                repo = in_flight.pop(id)
+                if error is not None:
+                    # Try again later, without counting it as unchanged
+                    logger.debug('Could not poll %s: %s' % (repo, error))
+                    self.errors += 1
+                    repo.next_poll = now + datetime.timedelta(seconds=min_interval)
+                    repo.save()
+                    continue
+                changed = discovery.has_changed(repo, refs)
+                if changed:
+                    self.refs[repo.id] = refs
+                self._record(repo, changed, now)
+        finally:
+            models.flush()
+        self.queue.sort(key=lambda repo: priority(repo, now), reverse=True)
+        self.report()
+        return self.queue
+
+    def _record(self, repo, changed, now):
+        observe(repo, changed, now)
+        self.checked += 1
+        if changed:
+            self.changed += 1
+            self.queue.append(repo)
+        else:
+            # Already up to date, so any request is satisfied
+            repo.requested = False
+        repo.save()
+        if not self.checked % self.batch:
+            models.flush()
+
+    def metrics(self):
+        """How the last schedule went: how many repositories were
+        considered and polled, how many of the polls found changes
+        or failed, and how many repositories are queued."""
+        return {'considered' : self.considered,
+                'checked' : self.checked,
+                'changed' : self.changed,
+                'errors' : self.errors,
+                'change_rate' : self.changed / float(max(self.checked, 1)),
+                'queue_depth' : len(self.queue)}
+
+    def report(self):
+        metrics = self.metrics()
+        logger.info('Polled %(checked)d of %(considered)d repos (%(errors)d failed): '
+                    '%(changed)d changed (%(change_rate).2f), '
+                    'queue depth %(queue_depth)d' % metrics)
+        aggregate = models.Aggregate.get()
+        aggregate.queue_depth = metrics['queue_depth']
+        aggregate.change_rate = metrics['change_rate']
+        aggregate.save()
+        models.flush()
@@ -1,39 +1,44 @@
 import logging
 import os
-import pycurl
 import re
-import StringIO
 import subprocess
-import time
 import traceback
 import urllib2
 import yaml
 
 from anygit import models
+from anygit.client import crawler
+from anygit.client import extract
+from anygit.client import frontier
 
 logger = logging.getLogger(__name__)
-users = set()
-pending_users = set()
 servers = [None, 'BEES-KNEES.MIT.EDU', 'CATS-WHISKERS.MIT.EDU', 'PANCAKE-BUNNY.MIT.EDU',
            'REAL-MCCOY.MIT.EDU', 'BUSY-BEAVER.MIT.EDU']
 proxies = []
 start_port = 6000
-i = 0
+# libyaml's loader is far faster, when we have it
+yaml_loader = getattr(yaml, 'CLoader', yaml.Loader)
+# Where the GitHub spider keeps its frontier, and what this spider
+# is called in it (by default, its host and pid); see frontier
+state_file = 'frontier'
+worker = None
+# The GitHub spider's frontier
+users = None
+# How many requests about each user are still to be finished
+outstanding = {}
 
 def fetch(url, proxy=None):
-    time.sleep(1)
-    c = pycurl.Curl()
-    if proxy:
-        c.setopt(pycurl.PROXY, proxy)
-        c.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5)
-    c.setopt(pycurl.URL, url)
-    b = StringIO.StringIO()
-    c.setopt(pycurl.WRITEFUNCTION, b.write)
-    c.setopt(pycurl.FOLLOWLOCATION, 1)
-    c.setopt(pycurl.MAXREDIRS, 5)
-    c.perform()
-    c.close()
-    return b.getvalue()
+    return crawler.Crawler(proxies=[proxy]).get(url)
+
+def crawl(url, regex, convert):
+    """Register the repositories on the page at url: what convert
+    makes of each match of regex.  The page is matched as it
+    downloads, and registered a batch at a time."""
+    def stream(c, request):
+        return extract.StreamExtractor(regex, convert, register)
+    c = crawler.Crawler()
+    c.add(crawler.Request(url, stream=stream))
+    c.run()
 
 def setup_proxies():
     port = start_port
@@ -46,179 +51,162 @@ def setup_proxies():
         else:
             proxies.append((server, None))
 
-def get_next_proxy():
-    global i
-    proxy = proxies[i][1]
-    i = (i + 1) % len(proxies)
-    return proxy
-
 def run(args):
     stdout, _ = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
     return stdout
 
-def yaml_curl(url):
-    t = 10
-    result = None
-    while not result:
-        proxy = get_next_proxy()
-        value = fetch(url, proxy=proxy)
+def yaml_parser(parser):
+    """Wrap parser, a function of (crawler, request, result), to be
+    handed the response parsed as YAML.  Responses saying we are going
+    too fast are retried later; other errors are logged and dropped."""
+    def parse(c, request, body):
         try:
-            result = yaml.load(value)
+            result = yaml.load(body, Loader=yaml_loader)
         except Exception, e:
-            logger.error('Tripped over content:\n%s\n%s' % (value, traceback.format_exc()))
-            result = {'error' : '(Manual)'}
-
+            logger.error('Tripped over content:\n%s\n%s' % (body, traceback.format_exc()))
+            return
+        if not isinstance(result, dict):
+            logger.warning('Unexpected content from %s: %s' % (request.url, result))
+            return
         if result.get('error') == [{'error': 'too many requests'}]:
-            logger.error('Rate limited on proxy %s!  (%s)  Sleeping for %d seconds.' % (proxy,
-                                                                                        result,
-                                                                                        t))
-            time.sleep(t)
-            t *= 2
-            result = None
-    if 'error' in result:
-        logger.warning('Experienced an error: %s' % result)
-        result = None
-    return result
-
-def create(url):
-    canonical_url = models.Repository.canonicalize(url)
-    r = models.Repository.get_or_create(url=canonical_url)
-    r.approved = 'spidered'
-    r.save()
-    models.flush()
+            raise crawler.RateLimited(result)
+        if 'error' in result:
+            logger.warning('Experienced an error: %s' % result)
+            return
+        parser(c, request, result)
+    return parse
+
+def register(urls):
+    """Add the repositories at urls, unless we have them already"""
+    urls = list(urls)
+    added = models.Repository.register_all(urls, approved='spidered')
+    logger.info('Found %d repos, %d of them new' % (len(urls), added))
 
 ### Github methods
 
-def get_repos(user):
-    repos = []
-    result = yaml_curl('http://github.com/api/v2/yaml/repos/show/%s' % urllib2.quote(user))
-    if result:
-        repos.extend(result['repositories'])
-    result = yaml_curl('http://github.com/api/v2/yaml/repos/watched/%s' % urllib2.quote(user))
-    if result:
-        repos.extend(result['repositories'])
-    return repos
-
-def get_collaborators(user, repo):
-    users = set()
-    result = yaml_curl('http://github.com/api/v2/yaml/repos/show/%s/%s/collaborators'
-                       % (urllib2.quote(user), urllib2.quote(repo)))
-    print user, repo, result
-    if result:
-        users.update(result['collaborators'])
-
-    result = yaml_curl('http://github.com/api/v2/yaml/repos/show/%s/%s/contributors'
-                       % (urllib2.quote(user), urllib2.quote(repo)))
-
-    print user, repo, result
-    if result:
-        users.update([c[':login'] for c in result['contributors']])
-    return users
-
-def dump_state(name):
-    tmp = '%s~' % name
-    f = open(tmp, 'w')
-    f.write(yaml.dump({'users' : list(users), 'pending_users' : list(pending_users)}))
-    os.rename(tmp, name)
-
-def load_state(name):
-    global users, pending_users
-    users = set()
-    pending_users = set()
-
-    try:
-        loaded = yaml.load(open(name))
-        users = set(loaded['users'])
-        pending_users = set(loaded['pending_users'])
-    except IOError:
-        logger.warning('Could not load state, continuing.')
-
-def record_user(new_user):
-    if new_user not in users and new_user not in pending_users:
-        logger.info('Adding new user %s' % new_user)
-        pending_users.add(new_user)
+github_api = 'http://github.com/api/v2/yaml/repos/show/'
+
+def queue_user(c, user):
+    """Queue up the repositories user owns and watches"""
+    quoted = urllib2.quote(user)
+    outstanding[user] = 2
+    c.add(crawler.Request(github_api + quoted, parse_repos, data=user))
+    c.add(crawler.Request('http://github.com/api/v2/yaml/repos/watched/%s' % quoted,
+                          parse_repos, data=user))
+
+@yaml_parser
+def parse_repos(c, request, result):
+    user = request.data
+    repos = result['repositories']
+    logger.info('Found %d repos for %s' % (len(repos), user))
+    register('git://%s.git' % repo[':url'].strip('http://') for repo in repos)
+    for repo in repos:
+        path = '%s/%s' % (urllib2.quote(user), urllib2.quote(repo[':name']))
+        outstanding[user] += 2
+        c.add(crawler.Request(github_api + path + '/collaborators',
+                              parse_collaborators, data=user))
+        c.add(crawler.Request(github_api + path + '/contributors',
+                              parse_contributors, data=user))
+
+@yaml_parser
+def parse_collaborators(c, request, result):
+    record_users(result['collaborators'])
+
+@yaml_parser
+def parse_contributors(c, request, result):
+    record_users(contributor[':login'] for contributor in result['contributors'])
+
+def record_users(new_users):
+    added = users.add(new_users)
+    if added:
+        logger.info('Added %d new users' % added)
+
+def request_done(request):
+    """Mark a user done once all the requests about them are"""
+    user = request.data
+    outstanding[user] -= 1
+    if not outstanding[user]:
+        del outstanding[user]
+        users.finish(user)
+
+def import_state(name):
+    """Bring the users from an old state.yml into the frontier"""
+    loaded = yaml.load(open(name), Loader=yaml_loader)
+    users.add(loaded['users'], done=True)
+    users.add(loaded['pending_users'])
 
 def github_com_spider():
-    state_file ='state.yml'
-    load_state(state_file)
-    if not pending_users:
-        user = raw_input('Please enter in a GitHub user to bootstrap from: ').strip()
-        pending_users.add(user)
+    global users
+    users = frontier.Frontier(state_file, worker=worker)
+    if users.empty():
+        if os.path.exists('state.yml'):
+            import_state('state.yml')
+        else:
+            user = raw_input('Please enter in a GitHub user to bootstrap from: ').strip()
+            users.add([user])
     setup_proxies()
 
-    while True:
-        try:
-            user = pending_users.pop()
-        except KeyError:
-            break
-
-        users.add(user)
-        repos = get_repos(user)
-        logger.info('Beginning spider for %s with %d pending users (%s).  Found %d repos' %
-                    (user, len(pending_users), pending_users, len(repos)))
-        for repo in repos:
-            url = 'git://%s.git' % repo[':url'].strip('http://')
-            create(url=url)
-            for new_user in get_collaborators(user, repo[':name']):
-                # Don't repeat people
-                record_user(new_user)
-
-        dump_state(state_file)
-    logger.info('All done.')
+    c = crawler.Crawler(proxies=[address for server, address in proxies],
+                        on_done=request_done)
+    def feed(c):
+        user = users.take()
+        if user is None:
+            # Nothing to add until the requests in flight find more
+            return c.pending() > 0
+        logger.info('Beginning spider for %s with %d pending users' %
+                    (user, len(users.pending)))
+        queue_user(c, user)
+        return True
+    try:
+        c.run(feed=feed)
+    finally:
+        users.close()
+    logger.info('All done: %d requests, %d failed.' % (c.completed, c.failed))
 
 # git.kernel.org spider
 
+def git_kernel_org_url(match):
+    return match.group(0)
+
 def git_kernel_org_spider():
-    content = fetch('http://git.kernel.org/')
-    repo_extractor = re.compile('git://[^\s<>]+\.git')
-    for match in repo_extractor.finditer(content):
-        logger.info('Adding repo %s' % match.group(0))
-        create(url=match.group(0))
+    crawl('http://git.kernel.org/', re.compile('git://[^\s<>]+\.git'), git_kernel_org_url)
 
 # repo.or.cz spider
 
+href = re.compile('^href=')
+def repo_or_cz_url(match):
+    m = match.group(0)
+    if href.search(m):
+        return None
+    return 'git://repo.or.cz/%s' % m
+
 def repo_or_cz_spider():
     logger.info('About to fetch http://repo.or.cz/?a=project_list&s=git')
-    content = fetch('http://repo.or.cz/?a=project_list&s=git')
-    logger.info('About to extract data')
-    repo_extractor = re.compile('[^\s<>]+\.git')
-    href = re.compile('^href=')
-    for match in repo_extractor.finditer(content):
-        m = match.group(0)
-        if href.search(m):
-            continue
-        logger.info('Adding repo %s' % m)
-        create(url='git://repo.or.cz/%s' % m)
+    crawl('http://repo.or.cz/?a=project_list&s=git', re.compile('[^\s<>]+\.git'),
+          repo_or_cz_url)
 
 # git.gnome.org spider
 
+def git_gnome_org_url(match):
+    return 'git://git.gnome.org/%s' % match.group(1)
+
 def git_gnome_org_spider():
     logger.info('About to fetch http://git.gnome.org/browse/')
-    content = fetch('http://git.gnome.org/browse/')
-    logger.info('About to extract data')
-    repo_extractor = re.compile('/browse/(.*?)/')
-    for match in repo_extractor.finditer(content):
-        m = match.group(1)
-        logger.info('Adding repo %s' % m)
-        create(url='git://git.gnome.org/%s' % m)
+    crawl('http://git.gnome.org/browse/', re.compile('/browse/(.*?)/'), git_gnome_org_url)
 
 # cgit.freedesktop.org spider
 
+def cgit_freedesktop_org_url(match):
+    return 'git://anongit.freedesktop.org/%s' % match.group(1)
+
 def cgit_freedesktop_org_spider():
     logger.info('About to fetch http://cgit.freedesktop.org/')
-    content = fetch('http://git.gnome.org/browse/')
-    logger.info('About to extract data')
-    repo_extractor = re.compile("title='(.*?)'")
-    for match in repo_extractor.finditer(content):
-        m = match.group(1)
-        logger.info('Adding repo %s' % m)
-        create(url='git://anongit.freedesktop.org/%s' % m)
+    crawl('http://cgit.freedesktop.org/', re.compile("title='(.*?)'"),
+          cgit_freedesktop_org_url)
 
 # Spider for well-known repos
 
 def fixed():
     repos = ['git://perl5.git.perl.org/metaconfig.git',
              'git://perl5.git.perl.org/perl.git']
-    
-    for url in repos:
-        create(url=url)
+    register(repos)
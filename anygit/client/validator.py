@@ -0,0 +1,75 @@
+import datetime
+import logging
+import time
+
+from anygit import models
+from anygit.client import discovery
+from anygit.client import fetch
+from anygit.client import ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class Validator(object):
+    """Checks whether many repositories can be talked to, with up to
+    concurrency ref discoveries in flight at once (see discovery) and
+    requests to any one host rate limited.  Each connection has its
+    own deadline, so a hung remote is dropped after timeout seconds.
+    Results are saved and flushed in batches as they come back."""
+    def __init__(self, concurrency=64, rate=1.0, burst=4, timeout=fetch.timeout,
+                 batch=100, report_interval=30, on_result=None):
+        self.concurrency = concurrency
+        self.limiter = None
+        if rate:
+            self.limiter = ratelimit.RateLimiter(rate, burst)
+        self.timeout = timeout
+        self.batch = batch
+        self.report_interval = report_interval
+        self.on_result = on_result
+        self._unsaved = 0
+        self.checked = 0
+        self.valid = 0
+
+    def run(self, repos):
+        """Check each of repos, setting approved on each."""
+        self._start = self._last_report = time.time()
+        in_flight = {}
+        def targets():
+            for repo in repos:
+                in_flight[repo.id] = repo
+                yield repo.id, repo.host, repo.path
+        try:
+            for id, refs, error in discovery.discover_all(targets(),
+                                                          concurrency=self.concurrency,
+                                                          timeout=self.timeout,
+                                                          limiter=self.limiter):
+                if error is not None:
+                    logger.debug('Could not talk to %s: %s' % (in_flight[id], error))
+                self._record(in_flight.pop(id), error is None)
+        finally:
+            models.flush()
+        self.report()
+
+    def _record(self, repo, valid):
+        repo.approved = valid
+        if valid:
+            repo.last_validated = datetime.datetime.now()
+        repo.save()
+        self.checked += 1
+        if valid:
+            self.valid += 1
+        if self.on_result:
+            self.on_result(repo, valid)
+        self._unsaved += 1
+        if self._unsaved >= self.batch:
+            models.flush()
+            self._unsaved = 0
+        if time.time() - self._last_report >= self.report_interval:
+            self.report()
+
+    def report(self):
+        self._last_report = time.time()
+        elapsed = self._last_report - self._start
+        logger.info('Checked %d repos (%d valid, %d dead) in %ds: %.1f repos/s' %
+                    (self.checked, self.valid, self.checked - self.valid, elapsed,
+                     self.checked / max(elapsed, 1)))
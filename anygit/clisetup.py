@@ -6,6 +6,8 @@ import sys
 DIR = os.path.abspath(os.path.dirname(__file__))
 conf = os.path.join(DIR, '../conf/anygit.ini')
 logging.config.fileConfig(conf)
-application = loadapp('config:%s' % conf, relative_to='/')
-app = loadapp('config:%s' % conf,relative_to=os.getcwd())
+application = loadapp('config:%s' % conf, relative_to='/',
+                      global_conf={'anygit.indexer' : 'true'})
+app = loadapp('config:%s' % conf,relative_to=os.getcwd(),
+              global_conf={'anygit.indexer' : 'true'})
 
@@ -2,6 +2,7 @@
 import os
 
 from mako.lookup import TemplateLookup
+from paste.deploy.converters import asbool
 from pylons import config
 from pylons.error import handle_mako_error
 
@@ -9,6 +10,29 @@ import anygit.lib.app_globals as app_globals
 import anygit.lib.helpers
 from anygit.config.routing import make_map
 
+def make_lookup(paths, app_conf, fragment_cache=None):
+    """Create the Mako TemplateLookup, with the default auto-escaping.
+    Cached template fragments go in the beaker cache, which should be
+    shared and bounded (e.g. memcached) when turned on; the default
+    memory cache is per-process and only ever drops expired entries
+    when they are asked for again.  fragment_cache overrides the
+    anygit.fragment_cache setting."""
+    if fragment_cache is None:
+        fragment_cache = asbool(config.get('anygit.fragment_cache', False))
+    timeout = int(config.get('anygit.fragment_cache_timeout', 3600))
+    return TemplateLookup(
+        directories=paths['templates'],
+        error_handler=handle_mako_error,
+        module_directory=os.path.join(app_conf['cache_dir'], 'templates'),
+        input_encoding='utf-8', default_filters=['escape'],
+        imports=['from webhelpers.html import escape'],
+        cache_enabled=fragment_cache,
+        cache_args={'timeout' : timeout},
+        cache_type=config.get('beaker.cache.type', 'memory'),
+        cache_url=config.get('beaker.cache.url'),
+        cache_dir=config.get('beaker.cache.data_dir',
+                             os.path.join(app_conf['cache_dir'], 'cache')))
+
 def load_environment(global_conf, app_conf):
     """Configure the Pylons environment via the ``pylons.config``
     object
@@ -27,17 +51,13 @@ def load_environment(global_conf, app_conf):
     config['pylons.app_globals'] = app_globals.Globals()
     config['pylons.h'] = anygit.lib.helpers
 
-    # Create the Mako TemplateLookup, with the default auto-escaping
-    config['pylons.app_globals'].mako_lookup = TemplateLookup(
-        directories=paths['templates'],
-        error_handler=handle_mako_error,
-        module_directory=os.path.join(app_conf['cache_dir'], 'templates'),
-        input_encoding='utf-8', default_filters=['escape'],
-        imports=['from webhelpers.html import escape'])
+    config['pylons.app_globals'].mako_lookup = make_lookup(paths, app_conf)
 
-    # Setup the backend
+    # Setup the backend.  The web app may read from replicas; the
+    # command line tools (see clisetup) index, so they stay on the
+    # primary to read their own writes.
     from anygit import models
-    models.setup()
+    models.setup(replicas=not asbool(config.get('anygit.indexer', False)))
 
     # CONFIGURATION OPTIONS HERE (note: all config options will override
     # any Pylons config options)
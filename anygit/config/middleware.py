@@ -10,6 +10,7 @@ from pylons.wsgiapp import PylonsApp
 from routes.middleware import RoutesMiddleware
 
 from anygit.config.environment import load_environment
+from anygit.lib.fastpath import FastPath
 
 def make_app(global_conf, full_stack=True, static_files=True, **app_conf):
     """Create a Pylons WSGI application and return it
@@ -39,6 +40,7 @@ def make_app(global_conf, full_stack=True, static_files=True, **app_conf):
 
     # The Pylons WSGI app
     app = PylonsApp()
+    pylons_app = app
 
     # Routing/Session/Cache Middleware
     app = RoutesMiddleware(app, config['routes.map'])
@@ -66,4 +68,13 @@ def make_app(global_conf, full_stack=True, static_files=True, **app_conf):
         static_app = StaticURLParser(config['pylons.paths']['static_files'])
         app = Cascade([static_app, app])
 
+    if asbool(config.get('anygit.fast_path', True)):
+        # Lookups skip the session, cache, error documents and static
+        # files (see anygit.lib.fastpath)
+        lean_app = RoutesMiddleware(pylons_app, config['routes.map'])
+        if asbool(full_stack):
+            lean_app = ErrorHandler(lean_app, global_conf, **config['pylons.errorware'])
+        lean_app = RegistryManager(lean_app)
+        app = FastPath(app, lean_app)
+
     return app
@@ -28,6 +28,7 @@ def make_map():
     map.connect('/q/', controller='query', action='index')
     map.connect('/q/{id}', controller='query', action='query')
     map.connect('/q/{id}', controller='query', action='query')
+    map.connect('/complete/{id}', controller='query', action='complete')
     map.connect('/{controller}', action='index')
     map.connect('/{controller}/', action='index')
     map.connect('/{controller}/{action}')
@@ -7,6 +7,7 @@ from anygit.lib import helpers
 from anygit.lib.base import BaseController, render
 from anygit import models
 from anygit.client import fetch
+from anygit.data import exceptions
 
 log = logging.getLogger(__name__)
 
@@ -23,9 +24,19 @@ class IndexController(BaseController):
             helpers.error('You did not provide a URL')
             redirect_to('/')
 
-        if models.Repository.exists(url=url):
-            repo = models.Repository.get_by_attributes(url=url)
+        # From the primary, since it's written back, and may only just
+        # have been requested
+        with models.primary_reads():
+            try:
+                repo = models.Repository.get_by_attributes(url=url)
+            except exceptions.DoesNotExist:
+                repo = None
+        if repo is not None:
             if repo.approved:
+                # Asking again moves it to the front of the queue
+                repo.requested = True
+                repo.save()
+                models.flush()
                 helpers.flash('Someone has already requested indexing of %s, '
                               'so no worries' % url)
             else:
@@ -40,6 +51,7 @@ class IndexController(BaseController):
                                   "in there?  If not, please email anygit@mit.edu" % url)
                 else:
                     repo.approved = True
+                    repo.requested = True
                     repo.save()
                     models.flush()
                     helpers.flash("Someone had requested %s before but it was down then. "
@@ -58,6 +70,7 @@ class IndexController(BaseController):
             helpers.error("Could not talk to %s; are you sure it's a valid URL?" % url)
         else:
             repo.approved = True
+            repo.requested = True
             repo.save()
             helpers.flash('Successfully requested %s for indexing' % url)
         models.flush()
@@ -1,8 +1,12 @@
+import email.utils
+import hashlib
 import logging
 import re
+import time
 
-from pylons import request, response, session, tmpl_context as c
-from pylons.controllers.util import abort, redirect_to
+from pylons import config, request, response, session, tmpl_context as c
+from pylons.controllers.util import abort, etag_cache, redirect_to
+from pylons.decorators import jsonify
 
 from anygit.lib import helpers
 from anygit.lib.base import BaseController, render
@@ -20,6 +24,9 @@ class QueryController(BaseController):
             error_now = ('You should be querying for a SHA1.  These are written in '
                          'hexadecimal (so they consist of a-f and 0-9).  Your query, '
                          '%s, is hence not a possible prefix.' % id)
+        elif len(id) > 40:
+            error_now = ('SHA1s are only 40 characters long, so your query, %s, '
+                         'is too long to be a prefix of one.' % id)
         else:
             error_now = None
         id = id.lower()
@@ -27,10 +34,17 @@ class QueryController(BaseController):
         page = max(int(request.params.get('page', 0)), 1)
         limit = min(int(request.params.get('limit', 10)), 50)
         offset = (page - 1) * limit
-        matching, count = models.GitObject.lookup_by_sha1(sha1=id,
-                                                          partial=True,
-                                                          offset=offset,
-                                                          limit=limit)
+        if error_now:
+            # Nothing can match, and the backends can't even turn it
+            # into a range of sha1s
+            matching, count = [], 0
+        else:
+            matching, count = models.GitObject.lookup_by_sha1(sha1=id,
+                                                              partial=True,
+                                                              offset=offset,
+                                                              limit=limit)
+            matching = list(matching)
+        self._validate(id, page, limit, count, matching)
         c.page = page
         c.start = offset + 1
         c.end = min(page * limit, count)
@@ -45,6 +59,55 @@ class QueryController(BaseController):
             c.out_of_range = False
         return render('query.mako', controller='query', error_now=error_now)
 
+    def _validate(self, id, page, limit, count, objects):
+        """Set the caching headers for a page of objects, and answer
+        with a 304 if the client's copy is still good.  The page only
+        changes when its objects are indexed again, so the ETag comes
+        from their ids, their summaries and the repositories they have
+        been found in.  This runs before any of the association
+        queries the page needs, which a 304 saves."""
+        if session.get('flash') or session.get('error'):
+            # There are messages for just this user on the page
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return
+        if any(object.dirty for object in objects):
+            # Still being indexed, and gaining edges that aren't
+            # summarized yet, so there's nothing to validate against
+            response.headers['Cache-Control'] = 'public, no-cache'
+            return
+        max_age = int(config.get('anygit.query_max_age', 600))
+        response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+        ids = [object.id for object in objects]
+        last_index, links = models.GitObject.last_indexed(ids)
+        if last_index is not None:
+            # last_index is in local time.  Only the ETag is checked,
+            # though: a page can gain an object from a repository that
+            # is still being indexed, without anything getting newer.
+            modified = time.mktime(last_index.timetuple())
+            response.headers['Last-Modified'] = email.utils.formatdate(modified, usegmt=True)
+        versions = ['%s:%s' % (object.id, object.summary_version()) for object in objects]
+        key = '\0'.join([id, str(page), str(limit), str(count), str(links),
+                          str(last_index)] + versions)
+        etag_cache(hashlib.sha1(key).hexdigest())
+
+    @jsonify
+    def complete(self, id):
+        """For autocompleting a partial sha1: how many objects of each
+        type start with it, and the first few of them."""
+        id = id.lower()
+        if not sha1_re.search(id) or len(id) > 40:
+            abort(400)
+        limit = min(int(request.params.get('limit', 10)), 50)
+        counts = models.GitObject.prefix_counts(id)
+        max_age = int(config.get('anygit.query_max_age', 600))
+        response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+        count = sum(counts.itervalues())
+        return {'prefix' : id,
+                'count' : count,
+                'unique' : count == 1,
+                'types' : counts,
+                'ids' : models.GitObject.first_ids(id, limit)}
+
     def query_with_string(self):
         query = request.params.get('query', '')
         redirect_to(action='query', id=query)
@@ -0,0 +1,71 @@
+"""
+HyperLogLog sketches of sets of sha1s.
+
+A sketch estimates how many distinct sha1s have been added to it, to
+within about 1.6% at the default precision, in a fixed 4KB.  Sketches
+can be merged, which gives the size of a union, and from that an
+estimate of the overlap between two sets.
+
+sha1s are already uniformly distributed, so their leading bits are
+used directly rather than hashing them again.
+"""
+import array
+import math
+
+class HyperLogLog(object):
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = array.array('B', [0]) * self.size
+        assert len(registers) == self.size
+        self.registers = registers
+
+    def add(self, sha1):
+        # The first 64 bits of the sha1: precision bits pick a
+        # register, and the rest give the rank.
+        value = int(sha1[:16], 16)
+        rest_bits = 64 - self.precision
+        index = value >> rest_bits
+        rest = value & ((1 << rest_bits) - 1)
+        # Position of the leftmost 1 bit
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, sha1s):
+        for sha1 in sha1s:
+            self.add(sha1)
+
+    def merge(self, other):
+        """A new sketch of the union of this sketch's set and other's"""
+        assert self.precision == other.precision
+        registers = array.array('B', map(max, self.registers, other.registers))
+        return HyperLogLog(self.precision, registers)
+
+    def cardinality(self):
+        """Estimate how many distinct sha1s have been added"""
+        m = float(self.size)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: count empty registers instead
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def overlap(self, other):
+        """Estimate the size of the intersection of the two sets, by
+        inclusion-exclusion."""
+        union = self.merge(other).cardinality()
+        return max(0, self.cardinality() + other.cardinality() - union)
+
+    def to_string(self):
+        return self.registers.tostring()
+
+    @classmethod
+    def from_string(cls, string):
+        registers = array.array('B')
+        registers.fromstring(string)
+        precision = len(registers).bit_length() - 1
+        return cls(precision, registers)
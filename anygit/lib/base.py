@@ -2,8 +2,11 @@
 
 Provides the BaseController class for subclassing.
 """
+import logging
 import os
-from pylons import config
+import time
+
+from pylons import config, response
 from pylons.controllers import WSGIController
 from pylons.templating import render_mako
 
@@ -13,6 +16,8 @@ from anygit.lib import helpers
 import webhelpers.html.secure_form
 import webhelpers.html.tags
 
+logger = logging.getLogger(__name__)
+
 class BaseController(WSGIController):
 
     def __call__(self, environ, start_response):
@@ -26,9 +31,17 @@ class BaseController(WSGIController):
             models.destroy_session()
 
 def render(path, controller, **kwargs):
+    """Render the template at path, and report how long that took in
+    the X-Render-Time header (in milliseconds)."""
     kwargs.setdefault('flash_now', None)
     kwargs.setdefault('error_now', None)
-    return render_mako(os.path.join(controller, path), extra_vars={'webhelpers' : webhelpers,
-                                                                   'h' : helpers,
-                                                                   'config' : config,
-                                                                   'kwargs' : kwargs})
+    start = time.time()
+    try:
+        return render_mako(os.path.join(controller, path), extra_vars={'webhelpers' : webhelpers,
+                                                                       'h' : helpers,
+                                                                       'config' : config,
+                                                                       'kwargs' : kwargs})
+    finally:
+        elapsed = (time.time() - start) * 1000
+        response.headers['X-Render-Time'] = '%.1f' % elapsed
+        logger.debug('Rendered %s in %.1fms' % (path, elapsed))
@@ -0,0 +1,46 @@
+"""
+A lean stack for the read-only pages.
+
+Most requests are lookups, which need neither a session nor the
+static files, nor the error documents.  FastPath sends GETs for the
+paths in routes straight to a stack with only routing, the registry
+and (with full_stack) the error handler around the Pylons app, and
+everything else to the full stack.
+
+The lean stack has no beaker session, only an empty one that is never
+saved, so readers aren't handed session cookies.  Flash messages are
+only set on the way to the front page, so none go missing.
+"""
+import re
+
+# Paths served by the lean stack
+routes = [re.compile(r'^/q/[^/]+$'),
+          re.compile(r'^/complete/[^/]+$')]
+
+
+class NullSession(dict):
+    """Stands in for the beaker session: always empty, never saved."""
+    def save(self):
+        pass
+
+    def delete(self):
+        self.clear()
+
+    def invalidate(self):
+        self.clear()
+
+
+class FastPath(object):
+    def __init__(self, app, lean_app):
+        # The full stack
+        self.app = app
+        self.lean_app = lean_app
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            path = environ.get('PATH_INFO', '')
+            for regex in routes:
+                if regex.match(path):
+                    environ['beaker.session'] = NullSession()
+                    return self.lean_app(environ, start_response)
+        return self.app(environ, start_response)
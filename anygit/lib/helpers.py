@@ -109,18 +109,64 @@ def gitorious_org_handle(repo, obj, match):
     else:
         return None
 
-def get_view_url_for(repo, obj):
-    for regex, handler in [(github_com_re, github_com_handle),
-                           (git_kernel_org_re, git_kernel_org_handle),
-                           (repo_or_cz_re, repo_or_cz_handle),
-                           (perl5_git_perl_org_re, perl5_git_perl_org_handle),
-                           (git_gnome_org_re, git_gnome_org_handle),
-                           (cgit_freedesktop_org_re, cgit_freedesktop_org_handle),
-                           (gitorious_org_re, gitorious_org_handle)]:
-        match = regex.search(repo.url)
+# The sites we know how to show objects on, by host: a list of (regex,
+# handler) pairs for each, where handler takes the repository, the
+# object and the regex's match on the repository's URL.  Sites whose
+# host can't be known in advance go in fallback_view_handlers, tried
+# after.  See register_view_handler.
+view_handlers = {}
+fallback_view_handlers = []
+# Which handler and match each repository URL resolved to
+_resolved = {}
+max_resolved = 100000
+
+def register_view_handler(regex, handler, hosts=None):
+    if hosts:
+        for host in hosts:
+            view_handlers.setdefault(host, []).append((regex, handler))
+    else:
+        fallback_view_handlers.append((regex, handler))
+    _resolved.clear()
+
+register_view_handler(github_com_re, github_com_handle, ['github.com'])
+register_view_handler(git_kernel_org_re, git_kernel_org_handle, ['git.kernel.org'])
+register_view_handler(repo_or_cz_re, repo_or_cz_handle, ['repo.or.cz'])
+register_view_handler(perl5_git_perl_org_re, perl5_git_perl_org_handle, ['perl5.git.perl.org'])
+register_view_handler(git_gnome_org_re, git_gnome_org_handle, ['git.gnome.org'])
+register_view_handler(cgit_freedesktop_org_re, cgit_freedesktop_org_handle,
+                      ['anongit.freedesktop.org'])
+register_view_handler(gitorious_org_re, gitorious_org_handle,
+                      ['gitorious.org', 'git.gitorious.org'])
+
+def _url_host(url):
+    # All we need of urlparse, for much less
+    return url.split('://', 1)[-1].split('/', 1)[0]
+
+def resolve_view_handler(url):
+    """The (handler, match) for showing objects from the repository at
+    url, or None if we don't know the site."""
+    try:
+        return _resolved[url]
+    except KeyError:
+        pass
+    resolved = None
+    candidates = view_handlers.get(_url_host(url), [])
+    for regex, handler in candidates + fallback_view_handlers:
+        match = regex.search(url)
         if match:
-            return handler(repo, obj, match)
-    
+            resolved = (handler, match)
+            break
+    if len(_resolved) >= max_resolved:
+        _resolved.clear()
+    _resolved[url] = resolved
+    return resolved
+
+def get_view_url_for(repo, obj):
+    resolved = resolve_view_handler(repo.url)
+    if resolved:
+        handler, match = resolved
+        return handler(repo, obj, match)
+
 def pluralize(number, singular, plural=None, when='always'):
     assert when in ['always', 'plural', 'never']
 
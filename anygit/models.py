@@ -6,6 +6,7 @@ __MODEL_VARS = ['create_schema',
                 'setup',
                 'flush',
                 'destroy_session',
+                'primary_reads',
                 'GitObject',
                 'Blob',
                 'Tree',
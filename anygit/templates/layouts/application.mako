@@ -94,7 +94,7 @@ if not isinstance(obj, basestring):
 <a href="${repo.url}">${repo.url}</a>
 </%def>
 
-<%def name="link_to_view(repo, obj)">
+<%def name="link_to_view(repo, obj)" cached="True" cache_key="link_to_view:${repo.id}:${obj.id}">
 <% v = h.get_view_url_for(repo, obj) %>
 % if v:
 <a href="${v}">${repo.url}</a>
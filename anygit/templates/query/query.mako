@@ -13,6 +13,144 @@
 % endfor
 </%def>
 
+## The fragments below only change when the object gains edges, which
+## the indexer summarizes once it has finished with it, so they're
+## cached by the object's summary (see GitObject.summary_version).
+## Objects still being indexed are rendered afresh.
+
+<%def name="fragment(name, object)">
+% if object.dirty:
+${getattr(self, name)(object)}
+% else:
+${self.cached_fragment(name, object)}
+% endif
+</%def>
+
+<%def name="cached_fragment(name, object)" cached="True" cache_key="${name}:${object.id}:${object.summary_version()}">
+${getattr(self, name)(object)}
+</%def>
+
+<%def name="blob_parents(object)">
+<% parent_ids = object.limited_parent_ids(100) %>
+<p> Also, this blob comes from the following 
+${h.pluralize(parent_ids.count(), 'tree', when='plural')}. 
+
+<% names = object.limited_names(100) %>
+% if names.count() == 0:
+  <% assert object.dirty %>
+  We haven't gotten around to recording its file name just yet, but hopefully will
+  soon.  If you're feeling especially inquisitive, feel free to email
+  <a href="mailto:anygit@mit.edu">anygit@mit.edu</a> and ask what's up with
+  <tt>${object.id}</tt>.
+% elif names.count() == 1:
+   Its file name is <tt>${names.next()}</tt>
+% else:
+   It has had several file names over time, namely 
+      ${h.liststyled(names, ', ', '<tt>', '</tt>') | n}: </p>
+% endif
+</p>
+
+<ul class="results">
+% for tree_id in parent_ids:
+  <li><tt>${self.link_to_object(tree_id)}</tt></li>
+% endfor
+  % if parent_ids.count() > 100:
+  <li> And so on and so forth </li>
+  % endif
+</ul>
+</p>
+</%def>
+
+<%def name="tree_parents(object)">
+% if object.commit_ids.count():
+  <p> Additionally, this tree comes from the following  
+  ${h.pluralize(object.commit_ids.count(), 'commit', when='plural')}: </p>
+  <ul class="results">
+  <% commit_ids = object.limited_commit_ids(100) %>
+  % for commit_id in commit_ids:
+     <li> <tt>${self.link_to_object(commit_id)}</tt> </li>
+  % endfor
+  % if commit_ids.count() > 100:
+  <li> And so on and so forth </li>
+  % endif
+  </ul>
+  </p>
+% else:
+  <p> It is not the tree of any commit. </p>
+% endif
+
+<% parent_ids = object.limited_parent_ids(100) %>
+% if parent_ids.count():
+<p> Finally, it is a subtree of the following 
+${h.pluralize(parent_ids.count(), 'tree', when='plural')}.  
+
+<% names = object.limited_names(100) %>
+% if names.count() == 0:
+  <% assert object.dirty %>
+  We haven't gotten around to recording its directory name just yet, but hopefully will
+  soon.  If you're feeling especially inquisitive, feel free to email
+  <a href="mailto:anygit@mit.edu">anygit@mit.edu</a> and ask what's up with
+  <tt>${object.id}</tt>.
+% elif names.count() == 1:
+   Its name as a directory is <tt>${names.next()}</tt>
+% else:
+   It has been known by the following names:
+      ${h.liststyled(names, ', ', '<tt>', '</tt>') | n}: </p>
+% endif
+<ul class="results">
+% for tree_id in parent_ids:
+  <li> <tt>${self.link_to_object(tree_id)}</tt> </li>
+% endfor
+% if parent_ids.count() > 100:
+<li> And so on and so forth </li>
+% endif
+</ul>
+</p>
+% else:
+<p> It is not a subtree of any tree. </p>
+% endif
+</%def>
+
+## Not cached: it changes as other objects are indexed, and only takes
+## a lookup either side of the object to work out
+<%def name="abbreviation(object)">
+<p> Its shortest unique abbreviation is <tt>${object.abbreviation()}</tt>. </p>
+</%def>
+
+<%def name="result_item(object)">
+% if object.type == 'commit':
+<li> Commit <tt>${self.link_to_object(object)}</tt> comes from ${h.pluralize(object.repository_count(), 'repository', 'repositories')}. </li>
+% elif object.type == 'blob':
+<li>
+  Blob <tt>${self.link_to_object(object)}</tt> comes from
+  ${h.pluralize(object.parent_count(), 'tree')} and
+  ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+</li>
+% elif object.type == 'tree':
+<li>
+  Tree <tt>${self.link_to_object(object)}</tt> comes from 
+  % if object.commit_count() and object.parent_count():
+    ${h.pluralize(object.commit_count(), 'commit')},
+    ${h.pluralize(object.parent_count(), 'parent tree')}, and
+    ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+  % elif object.commit_count():
+    ${h.pluralize(object.commit_count(), 'commit')} and
+    ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+  % elif object.parent_count():
+    ${h.pluralize(object.parent_count(), 'parent tree')} and
+    ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+  % else:
+    ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+  % endif
+</li>
+% elif object.type == 'tag':
+<li>
+  Tag <tt>${self.link_to_object(object)}</tt> comes from 
+  ${h.pluralize(object.repository_count(), 'repository', 'repositories')}.
+</li>
+% endif
+</%def>
+
 <p>
 <form type="GET" action="${url_for(controller='query', action='query_with_string')}" />
 <input type="text" name="query" value="${c.queried_id}" />
@@ -20,11 +158,11 @@
 </form>
 </p>
 
-% if c.objects.count() == 0:
+% if c.count == 0:
 <p> Sorry, no objects were found with <tt>${c.queried_id}</tt> as a prefix. </p>
 
-% elif c.objects.count() == 1:
-<% object = c.objects.next() %>
+% elif c.count == 1 and not c.out_of_range:
+<% object = c.objects[0] %>
 % if object.dirty:
 <p><i>Note that this object is currently being indexed; its state might appear broken.</i></p>
 % endif
@@ -56,34 +194,7 @@
     </ul>
     </p>
 
-    <% parent_ids = object.limited_parent_ids(100) %>
-    <p> Also, this blob comes from the following 
-    ${h.pluralize(parent_ids.count(), 'tree', when='plural')}. 
-
-    <% names = object.limited_names(100) %>
-    % if names.count() == 0:
-      <% assert object.dirty %>
-      We haven't gotten around to recording its file name just yet, but hopefully will
-      soon.  If you're feeling especially inquisitive, feel free to email
-      <a href="mailto:anygit@mit.edu">anygit@mit.edu</a> and ask what's up with
-      <tt>${object.id}</tt>.
-    % elif names.count() == 1:
-       Its file name is <tt>${names.next()}</tt>
-    % else:
-       It has had several file names over time, namely 
-          ${h.liststyled(names, ', ', '<tt>', '</tt>') | n}: </p>
-    % endif
-    </p>
-
-    <ul class="results">
-    % for tree_id in parent_ids:
-      <li><tt>${self.link_to_object(tree_id)}</tt></li>
-    % endfor
-      % if parent_ids.count() > 100:
-      <li> And so on and so forth </li>
-      % endif
-    </ul>
-    </p>
+    ${self.fragment('blob_parents', object)}
 
   % elif object.type == 'tree':
     <% repos = object.limited_repositories(100) %>
@@ -100,53 +211,7 @@
     </p>
 
 
-    % if object.commit_ids.count():
-      <p> Additionally, this tree comes from the following  
-      ${h.pluralize(object.commit_ids.count(), 'commit', when='plural')}: </p>
-      <ul class="results">
-      <% commit_ids = object.limited_commit_ids(100) %>
-      % for commit_id in commit_ids:
-         <li> <tt>${self.link_to_object(commit_id)}</tt> </li>
-      % endfor
-      % if commit_ids.count() > 100:
-      <li> And so on and so forth </li>
-      % endif
-      </ul>
-      </p>
-    % else:
-      <p> It is not the tree of any commit. </p>
-    % endif
-
-    <% parent_ids = object.limited_parent_ids(100) %>
-    % if parent_ids.count():
-    <p> Finally, it is a subtree of the following 
-    ${h.pluralize(parent_ids.count(), 'tree', when='plural')}.  
-
-    <% names = object.limited_names(100) %>
-    % if names.count() == 0:
-      <% assert object.dirty %>
-      We haven't gotten around to recording its directory name just yet, but hopefully will
-      soon.  If you're feeling especially inquisitive, feel free to email
-      <a href="mailto:anygit@mit.edu">anygit@mit.edu</a> and ask what's up with
-      <tt>${object.id}</tt>.
-    % elif names.count() == 1:
-       Its name as a directory is <tt>${names.next()}</tt>
-    % else:
-       It has been known by the following names:
-          ${h.liststyled(names, ', ', '<tt>', '</tt>') | n}: </p>
-    % endif
-    <ul class="results">
-    % for tree_id in parent_ids:
-      <li> <tt>${self.link_to_object(tree_id)}</tt> </li>
-    % endfor
-    % if parent_ids.count() > 100:
-    <li> And so on and so forth </li>
-    % endif
-    </ul>
-    </p>
-    % else:
-    <p> It is not a subtree of any tree. </p>
-    % endif
+    ${self.fragment('tree_parents', object)}
 
   % elif object.type == 'tag':
     <% repos = object.limited_repositories(100) %>
@@ -166,43 +231,19 @@
     <% raise ValueError('Unrecognized type for %s' % object) %>
   % endif
 
+% if c.count == 1 and len(c.queried_id) < 40:
+<p> No other object we have indexed starts with <tt>${c.queried_id}</tt>. </p>
+% endif
+${self.abbreviation(object)}
+
 % else:
 
-<p> You queried for git objects with prefix <b>${c.queried_id}</b>. </p>
+<p> You queried for git objects with prefix <b>${c.queried_id}</b>, which is
+ambiguous: ${h.pluralize(c.count, 'object')} start with it. </p>
 
 <ul class="results">
 % for object in c.objects:
-% if object.type == 'commit':
-<li> Commit <tt>${self.link_to_object(object)}</tt> comes from ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}. </li>
-% elif object.type == 'blob':
-<li>
-  Blob <tt>${self.link_to_object(object)}</tt> comes from
-  ${h.pluralize(object.parent_ids.count(), 'tree')} and
-  ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-</li>
-% elif object.type == 'tree':
-<li>
-  Tree <tt>${self.link_to_object(object)}</tt> comes from 
-  % if object.commit_ids and object.parent_ids:
-    ${h.pluralize(object.commit_ids.count(), 'commit')},
-    ${h.pluralize(object.parent_ids.count(), 'parent tree')}, and
-    ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-  % elif object.commit_ids:
-    ${h.pluralize(object.commit_ids.count(), 'commit')} and
-    ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-  % elif object.parent_ids:
-    ${h.pluralize(object.parent_ids.count(), 'parent tree')} and
-    ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-  % else:
-    ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-  % endif
-</li>
-% elif object.type == 'tag':
-<li>
-  Tag <tt>${self.link_to_object(object)}</tt> comes from 
-  ${h.pluralize(object.repository_ids.count(), 'repository', 'repositories')}.
-</li>
-% endif
+${self.fragment('result_item', object)}
 % endfor
 </ul>
 
@@ -0,0 +1,61 @@
+"""Pylons application test package
+
+This package assumes the Pylons environment is already loaded, such as
+when this script is imported from the `nosetests --with-pylons=test.ini`
+command.
+
+test.ini keeps the index in an in-memory SQLite database, which
+reset_database empties before each test.
+"""
+from unittest import TestCase
+
+from paste.deploy import loadapp
+from pylons import config, url
+from routes.util import URLGenerator
+from webtest import TestApp
+
+import pylons.test
+
+from anygit import models
+
+__all__ = ['environ', 'url', 'reset_database', 'add_objects',
+           'TestModel', 'TestController']
+
+environ = {}
+
+def reset_database(backend=models):
+    """Start backend afresh on an empty database"""
+    backend.destroy_session()
+    backend.setup()
+    backend.create_schema()
+
+def add_objects(backend, pairs, repo=None):
+    """Store the (sha1, type) pairs as clean objects, in repo if
+    given, counting them as the indexer would"""
+    for id, type in pairs:
+        obj = getattr(backend, type.capitalize()).get_from_cache_or_new(id=id)
+        obj.mark_dirty(False)
+        if repo is not None:
+            obj.add_repository(repo)
+        obj.save()
+    backend.GitObject.count_new(pairs)
+    backend.flush()
+
+
+class TestModel(TestCase):
+    def setUp(self):
+        reset_database()
+
+    def tearDown(self):
+        models.destroy_session()
+
+
+class TestController(TestModel):
+    def __init__(self, *args, **kwargs):
+        if pylons.test.pylonsapp:
+            wsgiapp = pylons.test.pylonsapp
+        else:
+            wsgiapp = loadapp('config:%s' % config['__file__'])
+        self.app = TestApp(wsgiapp)
+        url._push_object(URLGenerator(config['routes.map'], environ))
+        TestCase.__init__(self, *args, **kwargs)
@@ -0,0 +1,15 @@
+from anygit import models
+from anygit.tests import *
+
+class TestIndexController(TestController):
+    def test_request_again(self):
+        repo = models.Repository.create(url='git://example.com/repo.git')
+        repo.approved = True
+        repo.save()
+        models.flush()
+        response = self.app.get(url(controller='index', action='do_request',
+                                    url='git://example.com/repo.git'))
+        self.assertEqual(response.status_int, 302)
+        models.destroy_session()
+        repo = models.Repository.get_by_attributes(url='git://example.com/repo.git')
+        self.assertTrue(repo.requested)
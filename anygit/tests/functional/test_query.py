@@ -0,0 +1,121 @@
+from pylons import config
+
+from anygit import models
+from anygit.config import environment
+from anygit.tests import *
+
+def blob_ids(prefix, n):
+    return [prefix + '%0*x' % (40 - len(prefix), i) for i in xrange(n)]
+
+class TestQueryController(TestController):
+    def test_no_match(self):
+        response = self.app.get(url(controller='query', action='query', id='abcdef'))
+        assert 'no objects were found' in response
+
+    def test_not_hex(self):
+        response = self.app.get(url(controller='query', action='query', id='zz'))
+        assert 'hexadecimal' in response
+        assert 'no objects were found' in response
+
+    def test_too_long(self):
+        response = self.app.get(url(controller='query', action='query', id='a' * 41))
+        assert 'too long' in response
+        assert 'no objects were found' in response
+
+    def test_one_match(self):
+        ids = blob_ids('abcdef', 1)
+        add_objects(models, [(id, 'blob') for id in ids])
+        # Without a name recorded, the blob has to be still indexing
+        blob = models.Blob.get(ids[0])
+        blob.mark_dirty(True)
+        blob.save()
+        models.flush()
+        response = self.app.get(url(controller='query', action='query', id='abcdef'))
+        assert 'has been found in the following' in response
+        assert 'No other object we have indexed starts with' in response
+
+    def test_last_page_of_many(self):
+        # The last page has just the one object, but the prefix is
+        # still ambiguous
+        ids = blob_ids('abcdef', 11)
+        add_objects(models, [(id, 'blob') for id in ids])
+        response = self.app.get(url(controller='query', action='query', id='abcdef', page=2))
+        assert 'which is\nambiguous: 11 objects start with it' in response
+        assert 'has been found in the following' not in response
+        assert '<b>11-11</b> of <b>11</b>' in response
+
+    def test_out_of_range(self):
+        ids = blob_ids('abcdef', 3)
+        add_objects(models, [(id, 'blob') for id in ids])
+        response = self.app.get(url(controller='query', action='query', id='abcdef', page=5))
+        assert 'out of range' in response
+        assert 'no objects were found' not in response
+
+    def test_etag(self):
+        blob, = blob_ids('abcdef', 1)
+        tree, = blob_ids('fedcba', 1)
+        add_objects(models, [(blob, 'blob'), (tree, 'tree')])
+        models.Blob.get(blob).add_parent(tree, name='README', mode=0100644)
+        models.flush()
+        query = url(controller='query', action='query', id='abcdef')
+        etag = self.app.get(query).headers['ETag']
+        self.app.get(query, headers={'If-None-Match' : etag}, status=304)
+        # While it's being indexed, the blob gains edges that aren't
+        # summarized yet, so it can't be validated
+        b = models.Blob.get(blob)
+        b.mark_dirty(True)
+        b.save()
+        models.flush()
+        response = self.app.get(query, headers={'If-None-Match' : etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers.get('ETag'), None)
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+        # ...and once it's summarized, it has a new ETag
+        b = models.Blob.get(blob)
+        b.mark_dirty(False)
+        b.set_summary(**models.GitObject.summarize([blob])[blob])
+        b.save()
+        models.flush()
+        response = self.app.get(query, headers={'If-None-Match' : etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class TestFragmentCache(TestController):
+    """The query page with fragment caching turned on"""
+    def setUp(self):
+        super(TestFragmentCache, self).setUp()
+        self.globals = config['pylons.app_globals']
+        self.lookup = self.globals.mako_lookup
+        self.globals.mako_lookup = environment.make_lookup(
+            config['pylons.paths'], config['app_conf'], fragment_cache=True)
+
+    def tearDown(self):
+        self.globals.mako_lookup = self.lookup
+        super(TestFragmentCache, self).tearDown()
+
+    def summarize(self, id):
+        blob = models.Blob.get(id)
+        blob.set_summary(**models.GitObject.summarize([id])[id])
+        blob.save()
+        models.flush()
+
+    def test_keyed_by_summary(self):
+        blob, = blob_ids('abcdef', 1)
+        first, second = blob_ids('fedcba', 2)
+        add_objects(models, [(blob, 'blob'), (first, 'tree'), (second, 'tree')])
+        models.Blob.get(blob).add_parent(first, name='README', mode=0100644)
+        models.flush()
+        self.summarize(blob)
+        response = self.app.get(url(controller='query', action='query', id=blob))
+        assert first in response
+        assert second not in response
+        # Until the blob is summarized again, its parents come from the cache
+        models.Blob.get(blob).add_parent(second, name='README', mode=0100644)
+        models.flush()
+        response = self.app.get(url(controller='query', action='query', id=blob))
+        assert second not in response
+        self.summarize(blob)
+        response = self.app.get(url(controller='query', action='query', id=blob))
+        assert first in response
+        assert second in response
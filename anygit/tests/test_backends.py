@@ -0,0 +1,339 @@
+"""
+The same tests against each backend, so they keep behaving alike.
+
+SQLite (which is the mysql backend's schema and models) always runs,
+in memory.  The mongodb backend needs a server: set
+ANYGIT_TEST_MONGODB to its host to include it.  The database there is
+emptied.  Likewise MySQL: set ANYGIT_TEST_MYSQL to an SQLAlchemy url
+for a scratch database, with local_infile=1 to also test LOAD DATA.
+"""
+import datetime
+import os
+import time
+from unittest import TestCase
+
+from nose.plugins.skip import SkipTest
+from pylons import config
+
+from anygit.backends import common
+from anygit.client import fetch
+from anygit.data import exceptions
+from anygit.tests import add_objects, reset_database
+from anygit.tests.test_fetch import FakeObject, FakePack
+
+
+def sha1s(*ints):
+    return ['%040x' % i for i in ints]
+
+
+class BackendTests(object):
+    """Mixed into a TestCase per backend, which sets self.backend"""
+    def setUp(self):
+        reset_database(self.backend)
+
+    def tearDown(self):
+        self.backend.destroy_session()
+
+    ## lookup_by_sha1
+
+    def _add_blobs(self, ids):
+        add_objects(self.backend, [(id, 'blob') for id in ids])
+
+    def test_lookup_exact(self):
+        ids = sha1s(0xabc1, 0xabc2)
+        self._add_blobs(ids)
+        matching, count = self.backend.GitObject.lookup_by_sha1(ids[0])
+        self.assertEqual(count, 1)
+        self.assertEqual([o.id for o in matching], ids[:1])
+        matching, count = self.backend.GitObject.lookup_by_sha1(sha1s(0xabc3)[0])
+        self.assertEqual(count, 0)
+        self.assertEqual(list(matching), [])
+
+    def test_lookup_partial(self):
+        ids = ['abc' + '%037x' % i for i in xrange(25)] + ['abd' + '0' * 37]
+        self._add_blobs(ids)
+        for prefix, expected in [('abc', ids[:25]), ('ABC', ids[:25]), ('ab', ids),
+                                 ('abc' + '0' * 35 + '1', ids[16:25]), ('abe', [])]:
+            matching, count = self.backend.GitObject.lookup_by_sha1(prefix, partial=True,
+                                                                    limit=100)
+            self.assertEqual(count, len(expected), prefix)
+            self.assertEqual(sorted(o.id for o in matching), expected, prefix)
+
+    def test_lookup_paged(self):
+        ids = ['abc' + '%037x' % i for i in xrange(25)]
+        self._add_blobs(ids)
+        found = []
+        for offset in (0, 10, 20):
+            matching, count = self.backend.GitObject.lookup_by_sha1('abc', partial=True,
+                                                                    offset=offset, limit=10)
+            self.assertEqual(count, 25)
+            found.extend(o.id for o in matching)
+        self.assertEqual(sorted(found), ids)
+
+    def test_prefix_counts(self):
+        pairs = [(sha1s(0x1000 + i)[0], type) for i, type in
+                 enumerate(['blob', 'blob', 'tree', 'commit', 'tag'])]
+        add_objects(self.backend, pairs)
+        GitObject = self.backend.GitObject
+        expected = {'blob' : 2, 'tree' : 1, 'commit' : 1, 'tag' : 1}
+        for prefix in ('', '0', '0000', '0' * 36 + '1', '0' * 36 + '10'):
+            self.assertEqual(GitObject.prefix_counts(prefix), expected, prefix)
+        self.assertEqual(GitObject.count_prefix('1'), 0)
+        self.assertEqual(GitObject.first_ids('0', 2), [id for id, type in pairs[:2]])
+
+    def test_first_ids(self):
+        # Stored out of order
+        ids = sha1s(0x5, 0x3, 0x9, 0x1)
+        self._add_blobs(ids)
+        self.assertEqual(self.backend.GitObject.first_ids('0', 2), sorted(ids)[:2])
+
+    def test_neighbours(self):
+        ids = sha1s(0x10, 0x2000, 0x2001, 0x300000)
+        self._add_blobs(ids)
+        GitObject = self.backend.GitObject
+        self.assertEqual(GitObject.neighbours(ids[0]), (None, ids[1]))
+        self.assertEqual(GitObject.neighbours(ids[1]), (ids[0], ids[2]))
+        self.assertEqual(GitObject.neighbours(ids[3]), (ids[2], None))
+        blob = GitObject.get(ids[1])
+        self.assertEqual(blob.unique_prefix_length(), 40)
+        self.assertEqual(GitObject.get(ids[3]).unique_prefix_length(), 35)
+        self.assertEqual(GitObject.get(ids[3]).abbreviation(), ids[3][:35])
+        self.assertTrue(GitObject.is_unique_prefix(ids[3][:35]))
+        self.assertFalse(GitObject.is_unique_prefix(ids[3][:34]))
+
+    def test_summarize(self):
+        blob, tree, other_tree, commit = sha1s(0x1, 0x2, 0x3, 0x4)
+        add_objects(self.backend, [(blob, 'blob'), (tree, 'tree'), (other_tree, 'tree'),
+                                   (commit, 'commit')])
+        b = self.backend
+        b.Blob.get(blob).add_parent(tree, name='README', mode=0100644)
+        b.Blob.get(blob).add_parent(other_tree, name='README', mode=0100644)
+        b.Tree.get(tree).add_parent(other_tree, name='doc', mode=040000)
+        b.Tree.get(tree).add_commit(commit)
+        b.flush()
+        summaries = b.GitObject.summarize([blob, tree, other_tree])
+        self.assertEqual(summaries[blob], {'parents' : 2, 'commits' : 0,
+                                           'repositories' : 0, 'names' : 1})
+        self.assertEqual(summaries[tree], {'parents' : 1, 'commits' : 1,
+                                           'repositories' : 0, 'names' : 1})
+        self.assertEqual(summaries[other_tree], {'parents' : 0, 'commits' : 0,
+                                                 'repositories' : 0, 'names' : 0})
+
+    def test_last_indexed(self):
+        GitObject = self.backend.GitObject
+        self.assertEqual(GitObject.last_indexed([]), (None, 0))
+        ids = sha1s(0x1, 0x2)
+        self.assertEqual(GitObject.last_indexed(ids), (None, 0))
+        repo = self.backend.Repository.create(url='git://example.com/indexed.git')
+        repo.last_index = datetime.datetime(2010, 1, 1)
+        repo.save()
+        add_objects(self.backend, [(id, 'blob') for id in ids], repo=repo)
+        self.assertEqual(GitObject.last_indexed(ids), (repo.last_index, 2))
+
+    ## Indexing
+
+    def test_index_pack(self):
+        """What the indexer stores for a whole pack, through the same
+        path fetch takes"""
+        blob, readme, subtree, tree, first, second = sha1s(0x1, 0x2, 0x3, 0x4, 0x5, 0x6)
+        b = self.backend
+        repo = b.Repository.create(url='git://example.com/indexed.git')
+        pack = FakePack([FakeObject(blob, 'blob'),
+                         FakeObject(readme, 'blob'),
+                         FakeObject(subtree, 'tree', [('main.c', 0100644, blob)]),
+                         FakeObject(tree, 'tree', [('README', 0100644, readme),
+                                                   ('src', 040000, subtree),
+                                                   ('main.c', 0100644, blob)]),
+                         FakeObject(first, 'commit', tree=tree),
+                         FakeObject(second, 'commit', tree=tree, parents=[first])])
+        models = fetch.models
+        fetch.models = b
+        try:
+            fetch._process_data(repo, pack, lambda obj: None)
+            b.flush()
+        finally:
+            fetch.models = models
+        ids = [blob, readme, subtree, tree, first, second]
+        self.assertEqual([b.GitObject.get(id).type for id in ids],
+                         ['blob', 'blob', 'tree', 'tree', 'commit', 'commit'])
+        for id in ids:
+            o = b.GitObject.get(id)
+            self.assertFalse(o.dirty, id)
+            self.assertEqual(list(o.repository_ids), [repo.id], id)
+        self.assertEqual(sorted(b.Blob.get(blob).parent_ids_with_names),
+                         sorted([(subtree, 'main.c'), (tree, 'main.c')]))
+        self.assertEqual(list(b.Blob.get(blob).names), ['main.c'])
+        self.assertEqual(list(b.Tree.get(subtree).parent_ids_with_names), [(tree, 'src')])
+        self.assertEqual(sorted(b.Tree.get(tree).commit_ids), [first, second])
+        self.assertEqual(list(b.Commit.get(second).parent_ids), [first])
+        self.assertEqual(list(b.Commit.get(first).parent_ids), [])
+        summaries = [(o.n_parents, o.n_commits, o.n_repositories, o.n_names)
+                     for o in [b.GitObject.get(id) for id in ids]]
+        self.assertEqual(summaries, [(2, 0, 1, 1), (1, 0, 1, 1), (1, 0, 1, 1),
+                                     (0, 2, 1, 0), (0, 0, 1, 0), (1, 0, 1, 0)])
+        aggregate = b.Aggregate.get()
+        self.assertEqual((aggregate.blob_count, aggregate.tree_count, aggregate.commit_count),
+                         (2, 2, 2))
+        self.assertEqual(b.GitObject.prefix_counts('0'),
+                         {'blob' : 2, 'tree' : 2, 'commit' : 2, 'tag' : 0})
+
+    ## register_all
+
+    def test_register_all(self):
+        Repository = self.backend.Repository
+        urls = ['git://example.com/a.git', 'git://example.com/b.git',
+                'git://example.com/a.git', '', 'git://example.com/a.git/']
+        self.assertEqual(Repository.register_all(urls, approved='spidered', batch=2), 2)
+        self.backend.flush()
+        a = Repository.get(common.sha1('git://example.com/a.git'))
+        self.assertEqual(a.url, 'git://example.com/a.git')
+        self.assertEqual(a.approved, 'spidered')
+
+        a.approved = True
+        a.save()
+        self.backend.flush()
+        urls.append('git://example.com/c.git')
+        self.assertEqual(Repository.register_all(urls), 1)
+        self.backend.flush()
+        # Repositories we had are left alone
+        self.assertEqual(Repository.get(a.id).approved, True)
+        self.assertFalse(Repository.get(common.sha1('git://example.com/c.git')).approved)
+
+    def test_register_overlapping(self):
+        Repository = self.backend.Repository
+        Repository.register_all(['git://example.com/b.git'])
+        self.backend.flush()
+        # Someone else registers b between our looking and writing
+        existing_ids = Repository.__dict__['_existing_ids']
+        Repository._existing_ids = classmethod(lambda cls, ids: set())
+        try:
+            urls = ['git://example.com/a.git', 'git://example.com/b.git',
+                    'git://example.com/c.git']
+            self.assertEqual(Repository.register_all(urls, approved=True), 2)
+        finally:
+            Repository._existing_ids = existing_ids
+        self.backend.flush()
+        # Those after the overlap are all there, and due for indexing
+        scheduled = Repository.get_indexed_before(datetime.datetime.now())
+        self.assertEqual(sorted(repo.url for repo in scheduled),
+                         ['git://example.com/a.git', 'git://example.com/c.git'])
+        for url in urls:
+            repo = Repository.get(common.sha1(url))
+            self.assertFalse(repo.been_indexed)
+            self.assertEqual(repo.count, 0)
+
+    ## Leases
+
+    def _repo(self):
+        repo = self.backend.Repository.create(url='git://example.com/leased.git')
+        self.backend.flush()
+        return repo
+
+    def test_leases(self):
+        repo = self._repo()
+        self.assertTrue(repo.claim_lease('one', 60))
+        self.assertFalse(repo.claim_lease('two', 60))
+        self.assertTrue(repo.renew_lease('one', 60))
+        self.assertFalse(repo.renew_lease('two', 60))
+        self.assertTrue(repo.release_lease('one'))
+        self.assertTrue(repo.claim_lease('two', 60))
+
+    def test_expired_leases(self):
+        repo = self._repo()
+        self.assertTrue(repo.claim_lease('one', -1))
+        # Someone else can take it over once it has run out
+        self.assertTrue(repo.claim_lease('two', -1))
+        self.assertFalse(repo.renew_lease('one', 60))
+        self.assertEqual(self.backend.Repository.reap_leases(), 1)
+        self.assertEqual(self.backend.Repository.reap_leases(), 0)
+        self.assertTrue(repo.claim_lease('three', 60))
+        self.assertEqual(self.backend.Repository.reap_leases(), 0)
+        self.assertEqual(self.backend.Repository.reap_leases(all=True), 1)
+
+    ## Increments
+
+    def test_increment(self):
+        Aggregate = self.backend.Aggregate
+        aggregate = Aggregate.get()
+        aggregate.increment('blob_count', 2)
+        aggregate.increment('blob_count', 3)
+        aggregate.increment('tree_count', 0)
+        aggregate.save()
+        self.backend.flush()
+        # Another indexer's increment counts too
+        Aggregate.get().increment('blob_count', 4)
+        self.backend.flush()
+        aggregate = Aggregate.get()
+        self.assertEqual(aggregate.blob_count, 9)
+        self.assertEqual(aggregate.tree_count, 0)
+
+
+class TestSQLiteBackend(BackendTests, TestCase):
+    def setUp(self):
+        from anygit.backends import sqlite
+        self.backend = sqlite
+        self.path = config.get('sqlite.path')
+        config['sqlite.path'] = ':memory:'
+        super(TestSQLiteBackend, self).setUp()
+
+    def tearDown(self):
+        super(TestSQLiteBackend, self).tearDown()
+        config['sqlite.path'] = self.path
+
+
+class TestMongoDBBackend(BackendTests, TestCase):
+    def setUp(self):
+        host = os.environ.get('ANYGIT_TEST_MONGODB')
+        if not host:
+            raise SkipTest('Set ANYGIT_TEST_MONGODB to test against mongodb')
+        from anygit.backends import mongodb
+        self.backend = mongodb
+        config['mongodb.url'] = host
+        config['mongodb.db'] = 'anygit_test'
+        super(TestMongoDBBackend, self).setUp()
+
+    def test_migrate_prefix_counts(self):
+        pairs = [(sha1s(0x1000 + i)[0], type) for i, type in
+                 enumerate(['blob', 'blob', 'tree'])]
+        # Counted in the old format, a document per prefix
+        store = self.backend.PrefixCount._raw_object_store
+        for prefix, by_type in common.count_prefixes(pairs).iteritems():
+            doc = dict(('%s_count' % type, count) for type, count in by_type.iteritems())
+            doc['_id'] = prefix
+            store.insert(doc)
+        GitObject = self.backend.GitObject
+        self.assertEqual(GitObject.migrate_prefix_counts(), common.max_counted_prefix)
+        expected = {'blob' : 2, 'tree' : 1, 'commit' : 0, 'tag' : 0}
+        for prefix in ('', '0', '0000'):
+            self.assertEqual(GitObject.prefix_counts(prefix), expected, prefix)
+        self.assertEqual(GitObject.migrate_prefix_counts(), 0)
+        self.assertEqual([doc['_id'] for doc in store.find()], ['0'])
+
+
+class TestMySQLBackend(BackendTests, TestCase):
+    bulk_load = 'executemany'
+
+    def setUp(self):
+        url = os.environ.get('ANYGIT_TEST_MYSQL')
+        if not url:
+            raise SkipTest('Set ANYGIT_TEST_MYSQL to test against MySQL')
+        from anygit.backends import mysql
+        self.backend = mysql
+        self.saved = dict((key, config.get(key)) for key in ('sqlalchemy.url', 'mysql.bulk_load'))
+        config['sqlalchemy.url'] = url
+        config['mysql.bulk_load'] = self.bulk_load
+        super(TestMySQLBackend, self).setUp()
+        mysql.Metadata.drop_all(bind=mysql.Engine)
+        mysql.create_schema()
+
+    def tearDown(self):
+        super(TestMySQLBackend, self).tearDown()
+        for key, value in self.saved.iteritems():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+
+
+class TestMySQLLoadDataBackend(TestMySQLBackend):
+    bulk_load = 'load_data'
@@ -0,0 +1,152 @@
+"""
+Tests for ref discovery, against a fake git daemon that answers every
+connection with the same advertisement.
+"""
+import socket
+import threading
+from unittest import TestCase
+
+from anygit.client import discovery
+from anygit.client.discovery import pkt_line
+
+
+def advertisement(refs):
+    """The pkt-lines a git daemon sends for refs, a list of (name, sha1)"""
+    lines = []
+    for i, (name, sha1) in enumerate(refs):
+        if i == 0:
+            lines.append(pkt_line('%s %s\0multi_ack side-band-64k ofs-delta\n' % (sha1, name)))
+        else:
+            lines.append(pkt_line('%s %s\n' % (sha1, name)))
+    return ''.join(lines) + '0000'
+
+
+class FakeDaemon(object):
+    """Listens on localhost, and answers each connection with response
+    (and then hangs up, unless hang).  requests records what each
+    connection asked for."""
+    def __init__(self, response, hang=False):
+        self.response = response
+        self.hang = hang
+        self.requests = []
+        self.stopped = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.sock.settimeout(0.1)
+        self.host = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _serve(self):
+        while not self.stopped.isSet():
+            try:
+                conn, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(5)
+            try:
+                self.requests.append(conn.recv(4096))
+                if self.hang:
+                    self.stopped.wait()
+                else:
+                    conn.sendall(self.response)
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sock.close()
+
+
+refs = [('HEAD', 'a' * 40), ('refs/heads/master', 'a' * 40),
+        ('refs/tags/v1', 'b' * 40), ('refs/tags/v1^{}', 'c' * 40)]
+
+
+class TestDiscovery(TestCase):
+    def tearDown(self):
+        self.daemon.stop()
+
+    def test_refs(self):
+        self.daemon = FakeDaemon(advertisement(refs))
+        self.assertEqual(discovery.discover(self.daemon.host, '/repo.git', timeout=5),
+                         dict(refs))
+        self.assertEqual(self.daemon.requests,
+                         [pkt_line('git-upload-pack /repo.git\0host=127.0.0.1\0')])
+
+    def test_empty_repository(self):
+        self.daemon = FakeDaemon(advertisement([('capabilities^{}', '0' * 40)]))
+        self.assertEqual(discovery.discover(self.daemon.host, '/repo.git', timeout=5), {})
+
+    def test_error(self):
+        self.daemon = FakeDaemon(pkt_line('ERR access denied or repository not exported\n'))
+        try:
+            discovery.discover(self.daemon.host, '/repo.git', timeout=5)
+        except discovery.Error, e:
+            self.assertEqual(str(e), 'access denied or repository not exported')
+        else:
+            self.fail('No error raised')
+
+    def test_cut_short(self):
+        # Hangs up before the flush
+        self.daemon = FakeDaemon(advertisement(refs)[:-4])
+        self.assertRaises(discovery.Error, discovery.discover, self.daemon.host,
+                          '/repo.git', timeout=5)
+
+    def test_bad_line(self):
+        self.daemon = FakeDaemon('zzzz')
+        self.assertRaises(discovery.Error, discovery.discover, self.daemon.host,
+                          '/repo.git', timeout=5)
+
+    def test_timeout(self):
+        self.daemon = FakeDaemon('', hang=True)
+        self.assertRaises(discovery.Timeout, discovery.discover, self.daemon.host,
+                          '/repo.git', timeout=0.5)
+
+    def test_discover_all(self):
+        self.daemon = FakeDaemon(advertisement(refs))
+        targets = [(i, self.daemon.host, '/repo%d.git' % i) for i in xrange(10)]
+        results = list(discovery.discover_all(targets, concurrency=3, timeout=5))
+        self.assertEqual(sorted(key for key, found, error in results), range(10))
+        for key, found, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(found, dict(refs))
+        self.assertEqual(len(self.daemon.requests), 10)
+
+    def test_garbage_in_batch(self):
+        self.daemon = FakeDaemon(advertisement(refs))
+        garbage = FakeDaemon('')
+        try:
+            for response in [pkt_line('\xff\xfe not a ref\n'), '0x1f\0\0garbage',
+                             pkt_line('%s refs/heads/master\n' % ('z' * 40)) + '0000']:
+                garbage.response = response
+                targets = [(i, i % 2 and garbage.host or self.daemon.host, '/repo%d.git' % i)
+                           for i in xrange(6)]
+                results = sorted(discovery.discover_all(targets, concurrency=3, timeout=5))
+                self.assertEqual([key for key, found, error in results], range(6))
+                for key, found, error in results:
+                    if key % 2:
+                        self.assertEqual(found, None)
+                        self.assertTrue(isinstance(error, discovery.Error), repr(response))
+                    else:
+                        self.assertEqual(error, None)
+                        self.assertEqual(found, dict(refs))
+        finally:
+            garbage.stop()
+
+
+class FakeRepository(object):
+    def __init__(self, remote_heads):
+        self.remote_heads = remote_heads
+
+
+class TestHasChanged(TestCase):
+    def test_has_changed(self):
+        self.assertEqual(discovery.advertised_heads(dict(refs)), set(['a' * 40, 'b' * 40]))
+        self.assertTrue(discovery.has_changed(FakeRepository(None), dict(refs)))
+        self.assertTrue(discovery.has_changed(FakeRepository(['a' * 40]), dict(refs)))
+        self.assertFalse(discovery.has_changed(FakeRepository(['a' * 40, 'b' * 40]),
+                                               dict(refs)))
@@ -0,0 +1,397 @@
+"""
+Tests for fetching and indexing, with dulwich's TCPGitClient swapped
+for FakeClient.  Indexing a pack is replaced by noting which packs
+would have been indexed, so the packs are just bytes.
+"""
+import os
+import shutil
+import tempfile
+
+from pylons import config
+
+from anygit import models
+from anygit.client import fetch
+from anygit.client import lease
+from anygit.client import packstore
+from anygit.client import scheduler
+from anygit.tests import TestModel, add_objects
+
+
+class FakeClient(object):
+    """Advertises refs, and answers each fetch with sizes[want] bytes
+    of pack per want (100 by default).  fetches records the wants of
+    each fetch, and open the clients not yet closed."""
+    refs = {}
+    sizes = {}
+    fetches = []
+    open = []
+
+    def __init__(self, host):
+        self.host = host
+        FakeClient.open.append(self)
+
+    def close(self):
+        FakeClient.open.remove(self)
+
+    def fetch_pack(self, path, determine_wants, graph_walker, pack_data, progress):
+        wants = determine_wants(self.refs)
+        FakeClient.fetches.append(list(wants))
+        for want in wants:
+            pack_data('x' * self.sizes.get(want, 100))
+
+
+def heads(n):
+    """n refs, HEAD first"""
+    refs = {'HEAD' : '%040x' % 1}
+    for i in xrange(2, n + 1):
+        refs['refs/heads/b%d' % i] = '%040x' % i
+    return refs
+
+
+class FetchTest(TestModel):
+    def setUp(self):
+        super(FetchTest, self).setUp()
+        FakeClient.refs = heads(4)
+        FakeClient.sizes = {}
+        FakeClient.fetches = []
+        FakeClient.open = []
+        self.indexed = []
+        self.patched = [(fetch.client, 'TCPGitClient', fetch.client.TCPGitClient),
+                        (fetch, 'index_data', fetch.index_data)]
+        fetch.client.TCPGitClient = FakeClient
+        fetch.index_data = self.index_data
+        self.tmp = tempfile.mkdtemp()
+        self.pack_store = config.get('anygit.pack_store')
+        config['anygit.pack_store'] = ''
+        self.repo = models.Repository.create(url='git://example.com/repo.git')
+        self.repo.approved = True
+        self.repo.save()
+        models.flush()
+
+    def tearDown(self):
+        for module, name, value in self.patched:
+            setattr(module, name, value)
+        config['anygit.pack_store'] = self.pack_store
+        shutil.rmtree(self.tmp)
+        super(FetchTest, self).tearDown()
+
+    def index_data(self, data, repo, is_path=False):
+        self.indexed.append(open(data).read())
+
+    def pack(self, contents, fetched=True):
+        """A pack file holding contents, named like the ones fetch makes
+        if fetched"""
+        if fetched:
+            fd, path = tempfile.mkstemp(prefix=fetch.pack_prefix, suffix=fetch.pack_suffix,
+                                        dir=self.tmp)
+        else:
+            fd, path = tempfile.mkstemp(dir=self.tmp)
+        f = os.fdopen(fd, 'w')
+        # Padded, as the last 20 bytes are the checksum
+        f.write(contents.ljust(20))
+        f.close()
+        return path
+
+    def use_pack_store(self):
+        root = os.path.join(self.tmp, 'store')
+        os.mkdir(root)
+        config['anygit.pack_store'] = root
+        return packstore.from_config()
+
+
+class TestPackStoreResume(FetchTest):
+    def test_replay_discards_unstored_checkpoint(self):
+        # We died indexing a fetched pack that never made it into the
+        # store, and are now asked to recover
+        store = self.use_pack_store()
+        store.add(self.repo, self.pack('stored'), complete=True)
+        checkpointed = self.pack('checkpointed')
+        self.repo.set_checkpoint(checkpointed, packstore.pack_checksum(checkpointed),
+                                 'process', 10)
+        self.repo.set_remote_heads(['%040x' % 1])
+        self.repo.save()
+        models.flush()
+
+        fetch.fetch_and_index(self.repo, recover_mode=True, budget=0)
+        # The store is replayed, then only what's newer is fetched
+        self.assertEqual([data.strip() for data in self.indexed], ['stored', 'x' * 400])
+        self.assertEqual(len(FakeClient.fetches), 1)
+        self.assertFalse(os.path.exists(checkpointed))
+        self.assertTrue(self.repo.been_indexed)
+        self.assertEqual(len(store.packs(self.repo)), 2)
+
+
+class TestPackStoreAdd(FetchTest):
+    def stored(self, store):
+        return [open(path).read().strip() for path in store.packs(self.repo)]
+
+    def test_complete_supersedes(self):
+        store = self.use_pack_store()
+        store.add(self.repo, self.pack('first'), complete=True)
+        store.add(self.repo, self.pack('second'))
+        store.add(self.repo, self.pack('everything'), complete=True)
+        self.assertEqual(self.stored(store), ['everything'])
+
+    def test_failed_add_keeps_packs(self):
+        store = self.use_pack_store()
+        store.add(self.repo, self.pack('first'), complete=True)
+        missing = os.path.join(self.tmp, 'missing.pack')
+        self.assertRaises(IOError, store.add, self.repo, missing, complete=True)
+        self.assertEqual(self.stored(store), ['first'])
+
+
+class TestBudget(FetchTest):
+    def setUp(self):
+        super(TestBudget, self).setUp()
+        self.patched.append((fetch, 'initial_bytes_per_want', fetch.initial_bytes_per_want))
+        fetch.initial_bytes_per_want = 250
+
+    def fetched_sizes(self):
+        return [len(data) for data in self.indexed]
+
+    def test_first_round_from_guess(self):
+        state = {}
+        path = fetch.fetch(self.repo, state, budget=500)
+        os.unlink(path)
+        self.assertEqual(FakeClient.fetches, [[heads(4)['HEAD'], heads(4)['refs/heads/b2']]])
+        self.assertTrue(state['has_extra'])
+        self.assertEqual(state['bytes_per_want'], 100)
+        self.assertEqual(FakeClient.open, [])
+
+    def test_rounds_fill_budget(self):
+        fetch.fetch_and_index(self.repo, budget=250)
+        self.assertEqual([len(wants) for wants in FakeClient.fetches], [1, 2, 1])
+        self.assertEqual(self.fetched_sizes(), [100, 200, 100])
+        self.assertEqual(sorted(sum(FakeClient.fetches, [])), sorted(heads(4).values()))
+        self.assertTrue(self.repo.been_indexed)
+
+    def test_overshoot_retries_smaller(self):
+        FakeClient.sizes = {heads(4)['refs/heads/b2'] : 1000}
+        fetch.fetch_and_index(self.repo, budget=250)
+        # Two wants came to more than twice the budget, so that round
+        # was abandoned and tried again with one
+        self.assertEqual([len(wants) for wants in FakeClient.fetches], [1, 2, 1, 1, 1])
+        self.assertEqual(self.fetched_sizes(), [100, 1000, 100, 100])
+        # Including the client whose round was abandoned
+        self.assertEqual(FakeClient.open, [])
+
+    def test_no_budget(self):
+        fetch.fetch_and_index(self.repo, budget=0)
+        self.assertEqual([len(wants) for wants in FakeClient.fetches], [4])
+
+
+class TestCheckpointResume(FetchTest):
+    def checkpoint(self, contents, checksum=None):
+        path = self.pack(contents)
+        self.repo.set_checkpoint(path, checksum or packstore.pack_checksum(path),
+                                 'process', 10)
+        # As the fetch that died left them
+        self.repo.set_new_remote_heads(heads(4).values())
+        self.repo.save()
+        models.flush()
+        return path
+
+    def test_resume(self):
+        path = self.checkpoint('checkpointed')
+        fetch.fetch_and_index(self.repo, budget=0)
+        # Everything came in the one pack
+        self.assertEqual([data.strip() for data in self.indexed], ['checkpointed'])
+        self.assertEqual(FakeClient.fetches, [])
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(self.repo.been_indexed)
+        self.assertEqual(sorted(self.repo.remote_heads), sorted(heads(4).values()))
+
+    def test_resume_rounds(self):
+        self.checkpoint('checkpointed')
+        fetch.fetch_and_index(self.repo, budget=250)
+        # The rest of the rounds are fetched afterwards
+        self.assertEqual(self.indexed[0].strip(), 'checkpointed')
+        self.assertEqual(sorted(sum(FakeClient.fetches, [])), sorted(heads(4).values()))
+        self.assertTrue(self.repo.been_indexed)
+
+    def test_corrupt_checkpoint(self):
+        path = self.checkpoint('checkpointed', checksum='0' * 40)
+        fetch.fetch_and_index(self.repo, budget=0)
+        self.assertEqual(self.indexed, ['x' * 400])
+        self.assertEqual(self.repo.checkpoint_pack, None)
+
+    def test_no_resume(self):
+        path = self.checkpoint('checkpointed')
+        fetch.fetch_and_index(self.repo, budget=0, resume=False)
+        self.assertEqual(self.indexed, ['x' * 400])
+        self.assertFalse(os.path.exists(path))
+
+
+class FakeObject(object):
+    def __init__(self, id, type, entries=(), tree=None, parents=()):
+        self.id = id
+        self._type = type
+        # (name, mode, sha1) for a tree
+        self.entries = entries
+        self.tree = tree
+        self.parents = parents
+
+    def iteritems(self):
+        return iter(self.entries)
+
+
+class FakePack(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def iterobjects(self):
+        return iter(self.objects)
+
+
+class TestProcessData(TestModel):
+    def setUp(self):
+        super(TestProcessData, self).setUp()
+        self.repo = models.Repository.create(url='git://example.com/repo.git')
+        self.ids = ['%040x' % i for i in xrange(4)]
+        self.pack = FakePack([FakeObject(id, 'blob') for id in self.ids])
+        self.seen = []
+
+    def progress(self, obj):
+        self.seen.append(obj.id)
+
+    def process(self, phase, offset):
+        self.repo.set_checkpoint('checkpointed.pack', '0' * 40, phase, offset)
+        fetch._process_data(self.repo, self.pack, self.progress)
+        models.flush()
+
+    def test_from_start(self):
+        self.process('dirty', 0)
+        self.assertEqual(self.seen, self.ids)
+        self.assertEqual(models.Aggregate.get().blob_count, 4)
+        self.assertEqual(self.repo.checkpoint_phase, 'clean')
+        for id in self.ids:
+            self.assertFalse(models.Blob.get(id).dirty)
+
+    def test_resume_dirtying(self):
+        # The first two were dirtied and counted before the checkpoint
+        self.process('dirty', 2)
+        self.assertEqual(self.seen, self.ids)
+        self.assertEqual(models.Aggregate.get().blob_count, 2)
+
+    def test_resume_processing(self):
+        self.process('process', 3)
+        self.assertEqual(self.seen, self.ids[3:])
+        for id in self.ids[3:]:
+            self.assertFalse(models.Blob.get(id).dirty)
+
+    def test_resume_cleaning(self):
+        add_objects(models, [(id, 'blob') for id in self.ids])
+        for id in self.ids:
+            blob = models.Blob.get(id)
+            blob.mark_dirty(True)
+            blob.save()
+        self.process('clean', 2)
+        self.assertEqual(self.seen, [])
+        self.assertEqual([models.Blob.get(id).dirty for id in self.ids],
+                         [True, True, False, False])
+
+
+class TestIncrementalSummaries(TestModel):
+    def setUp(self):
+        super(TestIncrementalSummaries, self).setUp()
+        self.repo = models.Repository.create(url='git://example.com/repo.git')
+        self.blob, self.tree, self.new_tree, self.commit = ['%040x' % i for i in xrange(1, 5)]
+
+    def index(self, objects):
+        fetch._process_data(self.repo, FakePack(objects), lambda obj: None)
+        models.flush()
+
+    def test_parents_from_later_pack(self):
+        self.index([FakeObject(self.blob, 'blob'),
+                    FakeObject(self.tree, 'tree', [('a', 0100644, self.blob)])])
+        blob = models.Blob.get(self.blob)
+        self.assertEqual((blob.parent_count(), blob.name_count()), (1, 1))
+        # Only what's new: the blob and tree are from the first pack
+        self.index([FakeObject(self.new_tree, 'tree', [('b', 0100644, self.blob)]),
+                    FakeObject(self.commit, 'commit', tree=self.tree)])
+        blob = models.Blob.get(self.blob)
+        self.assertEqual(blob.type, 'blob')
+        self.assertEqual((blob.parent_count(), blob.name_count()), (2, 2))
+        tree = models.Tree.get(self.tree)
+        self.assertEqual(tree.commit_count(), 1)
+
+
+class TestChangeDetection(FetchTest):
+    def setUp(self):
+        super(TestChangeDetection, self).setUp()
+        self.discovered = []
+        self.patched.append((fetch.discovery, 'discover', fetch.discovery.discover))
+        fetch.discovery.discover = self.discover
+        self.repo.set_remote_heads(heads(4).values())
+        self.repo.save()
+        models.flush()
+        self.last_index = self.repo.last_index
+
+    def discover(self, host, path, timeout=10):
+        self.discovered.append((host, path))
+        return FakeClient.refs
+
+    def test_unchanged(self):
+        fetch.fetch_and_index(self.repo)
+        self.assertEqual(self.discovered, [('example.com', '/repo.git')])
+        self.assertEqual(FakeClient.fetches, [])
+        # Skipped, so not indexed
+        self.assertEqual(self.repo.last_index, self.last_index)
+        self.assertNotEqual(self.repo.last_validated, None)
+
+    def test_changed(self):
+        FakeClient.refs = heads(5)
+        fetch.fetch_and_index(self.repo, budget=0)
+        self.assertEqual(len(FakeClient.fetches), 1)
+        self.assertNotEqual(self.repo.last_index, self.last_index)
+
+    def test_refs_given(self):
+        fetch.fetch_and_index(self.repo, refs=heads(5), budget=0)
+        # Taken as they are
+        self.assertEqual(self.discovered, [])
+        self.assertEqual(len(FakeClient.fetches), 1)
+
+    def test_scheduler_refs(self):
+        def discover_all(targets, **kwargs):
+            for key, host, path in targets:
+                yield key, heads(5), None
+        self.patched.append((fetch.discovery, 'discover_all', fetch.discovery.discover_all))
+        fetch.discovery.discover_all = discover_all
+        polls = scheduler.Scheduler(rate=0)
+        self.assertEqual(polls.schedule([self.repo]), [self.repo])
+        self.assertEqual(polls.refs, {self.repo.id : heads(5)})
+
+
+class TestLeaseLost(FetchTest):
+    def setUp(self):
+        super(TestLeaseLost, self).setUp()
+        test = self
+        class Lease(lease.Lease):
+            # Lost once lose_after packs are indexed
+            @property
+            def lost(self):
+                return len(test.indexed) >= test.lose_after
+            @lost.setter
+            def lost(self, value):
+                pass
+        self.patched.append((fetch.lease, 'Lease', fetch.lease.Lease))
+        fetch.lease.Lease = Lease
+
+    def test_between_rounds(self):
+        self.lose_after = 1
+        fetch.fetch_and_index(self.repo, budget=250)
+        # Stopped after the first round, without recording it indexed
+        self.assertEqual(len(FakeClient.fetches), 1)
+        self.assertFalse(self.repo.been_indexed)
+        self.assertEqual(self.repo.remote_heads, None)
+
+    def test_after_last_round(self):
+        self.lose_after = 3
+        fetch.fetch_and_index(self.repo, budget=250)
+        self.assertEqual(len(FakeClient.fetches), 3)
+        self.assertFalse(self.repo.been_indexed)
+
+    def test_kept(self):
+        self.lose_after = 4
+        fetch.fetch_and_index(self.repo, budget=250)
+        self.assertTrue(self.repo.been_indexed)
@@ -0,0 +1,102 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from unittest import TestCase
+
+from anygit.client import frontier
+
+
+class TestFrontier(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'frontier')
+        self.opened = []
+        self.min_compact = frontier.min_compact
+
+    def tearDown(self):
+        for f in self.opened:
+            f.close()
+        shutil.rmtree(self.tmp)
+        frontier.min_compact = self.min_compact
+
+    def open(self, worker=None):
+        f = frontier.Frontier(self.path, worker=worker)
+        self.opened.append(f)
+        return f
+
+    def dead_worker(self):
+        """The default name of a spider on this host that has exited"""
+        child = subprocess.Popen(['true'])
+        child.wait()
+        return '%s:%d' % (socket.gethostname(), child.pid)
+
+    def test_default_worker(self):
+        self.assertEqual(self.open().worker, '%s:%d' % (socket.gethostname(), os.getpid()))
+
+    def test_take_and_finish(self):
+        f = self.open('a')
+        self.assertEqual(f.add(['alice', 'bob', 'alice']), 2)
+        taken = set([f.take(), f.take()])
+        self.assertEqual(taken, set(['alice', 'bob']))
+        self.assertEqual(f.take(), None)
+        f.finish('alice')
+        g = self.open('b')
+        self.assertEqual(g.done, set(['alice']))
+        self.assertEqual(g.taken, {'bob' : 'a'})
+
+    def test_others_keep_their_users(self):
+        a = self.open('a')
+        a.add(['alice'])
+        a.take()
+        # Another spider, named or not, leaves a's user alone
+        self.assertEqual(self.open('b').pending, set())
+        self.assertEqual(self.open().taken, {'alice' : 'a'})
+
+    def test_restart_takes_back(self):
+        a = self.open('a')
+        a.add(['alice'])
+        a.take()
+        self.assertEqual(self.open('a').pending, set(['alice']))
+
+    def test_dead_workers_requeued(self):
+        dead = self.dead_worker()
+        elsewhere = 'elsewhere.example.com:%d' % os.getpid()
+        f = self.open(dead)
+        f.add(['alice', 'bob'])
+        f.take()
+        f.worker = elsewhere
+        f.take()
+        g = self.open()
+        self.assertEqual(g.pending, set([user for user, owner in f.taken.iteritems()
+                                         if owner == dead]))
+        self.assertEqual(g.taken.values(), [elsewhere])
+
+    def log_records(self):
+        # Less the generation line
+        return len(open(self.path + '.log').readlines()) - 1
+
+    def test_compact_on_take(self):
+        frontier.min_compact = 4
+        f = self.open('a')
+        f.add(['alice', 'bob'])
+        f.take()
+        f.take()
+        self.assertEqual(self.log_records(), 0)
+        self.assertEqual(f.generation, 1)
+        self.assertEqual(set(self.open('b').taken), set(['alice', 'bob']))
+
+    def test_compact_on_open(self):
+        f = self.open('a')
+        f.add(['alice', 'bob', 'carol'])
+        f.take()
+        f.close()
+        self.opened.remove(f)
+        self.assertEqual(self.log_records(), 4)
+        frontier.min_compact = 4
+        g = self.open('a')
+        self.assertEqual(self.log_records(), 0)
+        # The user a had taken was requeued before compacting
+        self.assertEqual(g.pending, set(['alice', 'bob', 'carol']))
+        self.assertEqual(self.open('b').pending, set(['alice', 'bob', 'carol']))
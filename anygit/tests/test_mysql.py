@@ -0,0 +1,171 @@
+"""
+The parts of the SQL backend that differ by database, and its bulk
+loader.  Without a MySQL server (see test_backends), the MySQL
+versions are checked by compiling them for its dialect.
+"""
+import re
+from unittest import TestCase
+
+from sqlalchemy.dialects import mysql as mysql_dialect
+from sqlalchemy.dialects import sqlite as sqlite_dialect
+from sqlalchemy.schema import CreateTable
+
+from anygit import models
+from anygit.backends import mysql
+from anygit.tests import TestModel
+
+
+class FakeBind(object):
+    def __init__(self, dialect):
+        self.dialect = dialect
+
+
+class TestDialects(TestCase):
+    def compile(self, statement, dialect):
+        return statement.compile(dialect=dialect)
+
+    def test_insert_ignore(self):
+        table = mysql.GitObject.__table__
+        for dialect, prefix in [(mysql_dialect.dialect(), 'INSERT IGNORE INTO'),
+                                (sqlite_dialect.dialect(), 'INSERT OR IGNORE INTO')]:
+            statement = mysql.insert_ignore(table, FakeBind(dialect))
+            self.assertTrue(str(self.compile(statement, dialect)).startswith(prefix),
+                            dialect.name)
+
+    def test_sha1_binding(self):
+        dialect = mysql_dialect.dialect()
+        column = mysql.GitObject.__table__.c.id
+        compiled = self.compile(mysql.prefix_filter(column, 'abc'), dialect)
+        process = column.type.bind_processor(dialect)
+        bound = sorted(process(value) for value in compiled.construct_params().itervalues())
+        self.assertEqual(bound, ['\xab\xc0' + '\0' * 18, '\xab\xd0' + '\0' * 18])
+        self.assertEqual(column.type.result_processor(dialect, None)('\xab' * 20), 'ab' * 20)
+        self.assertTrue('id BINARY(20) NOT NULL' in
+                        str(CreateTable(mysql.GitObject.__table__).compile(dialect=dialect)))
+
+
+class FakeConnection(object):
+    """Records the statements a LOAD DATA runs, and the file it loads"""
+    def __init__(self):
+        self.statements = []
+        self.loaded = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        path = re.search("INFILE '([^']*)'", statement).group(1)
+        self.loaded.append(open(path).read())
+
+
+class TestBulkLoader(TestModel):
+    def setUp(self):
+        super(TestBulkLoader, self).setUp()
+        self.table = mysql.GitObject.__table__
+        self.window = mysql.max_transaction_window
+
+    def tearDown(self):
+        mysql.max_transaction_window = self.window
+        mysql.curr_transaction_window = 0
+        super(TestBulkLoader, self).tearDown()
+
+    def row(self, id, **values):
+        row = {'id' : id, 'type' : 'blob', 'dirty' : None, 'complete' : None,
+               'object_id' : None, 'n_parents' : None, 'n_commits' : None,
+               'n_repositories' : None, 'n_names' : None}
+        row.update(values)
+        return row
+
+    def stored(self, id):
+        return mysql.Engine.execute(self.table.select().where(self.table.c.id == id)).fetchone()
+
+    def test_staged_replace(self):
+        loader = mysql.BulkLoader(mysql.Engine)
+        a, b = '1' * 40, '2' * 40
+        loader.add(self.table, **self.row(a, n_names=1))
+        loader.add(self.table, **self.row(a, n_names=2))
+        loader.add(self.table, **self.row(b, n_names=1))
+        loader.add(self.table, replace=False, **self.row(b, n_names=2))
+        loader.flush()
+        self.assertEqual(self.stored(a).n_names, 2)
+        self.assertEqual(self.stored(b).n_names, 1)
+
+    def test_existing_rows_ignored(self):
+        loader = mysql.BulkLoader(mysql.Engine)
+        a, b = '1' * 40, '2' * 40
+        loader.add(self.table, **self.row(a, n_names=1))
+        loader.flush()
+        # Only an update changes a stored row
+        loader.add(self.table, **self.row(a, n_names=2))
+        loader.add(self.table, **self.row(b, n_names=2))
+        loader.flush()
+        self.assertEqual(self.stored(a).n_names, 1)
+        self.assertEqual(self.stored(b).n_names, 2)
+        loader.add(self.table, **self.row(a, n_names=3))
+        loader.update(self.table, a, n_names=3)
+        loader.flush()
+        self.assertEqual(self.stored(a).n_names, 3)
+
+    def test_updates_after_inserts(self):
+        loader = mysql.BulkLoader(mysql.Engine)
+        a = '1' * 40
+        loader.update(self.table, a, dirty=True)
+        loader.add(self.table, **self.row(a))
+        loader.flush()
+        self.assertEqual(self.stored(a).dirty, True)
+
+    def test_flush_at_window(self):
+        mysql.max_transaction_window = 2
+        mysql.curr_transaction_window = 0
+        ids = ['%040x' % i for i in xrange(5)]
+        for id in ids[:3]:
+            models.Blob.get_from_cache_or_new(id=id).save()
+        # The third save goes over the window, so everything so far
+        # has been written
+        self.assertEqual([self.stored(id) is not None for id in ids[:3]], [True] * 3)
+        for id in ids[3:]:
+            models.Blob.get_from_cache_or_new(id=id).save()
+        self.assertEqual(self.stored(ids[4]), None)
+        models.flush()
+        self.assertEqual([self.stored(id) is not None for id in ids], [True] * 5)
+
+    def test_flush_after_commit(self):
+        # The repository goes through the session, and the blob's
+        # membership of it through the loader, which writes after
+        # the session commits
+        repo = models.Repository.create(url='git://example.com/repo.git')
+        repo_id = repo.id
+        blob = models.Blob.get_from_cache_or_new(id='1' * 40)
+        blob.add_repository(repo)
+        blob.save()
+        models.flush()
+        mysql.Session.remove()
+        self.assertEqual(models.Repository.get(repo_id).url, 'git://example.com/repo.git')
+        self.assertEqual(list(models.Blob.get('1' * 40).repository_ids), [repo_id])
+
+    def test_methods(self):
+        self.assertRaises(ValueError, mysql.BulkLoader, mysql.Engine, method='copy')
+        # SQLite has no LOAD DATA
+        self.assertEqual(mysql.BulkLoader(mysql.Engine, method='load_data').method,
+                         'executemany')
+
+    def test_load_data(self):
+        loader = mysql.BulkLoader(mysql.Engine)
+        conn = FakeConnection()
+        loader._load_data(conn, self.table, [self.row('ab' * 20, dirty=True, n_names=2),
+                                             self.row('cd' * 20, object_id='ef' * 20)])
+        self.assertEqual(len(conn.statements), 1)
+        statement = conn.statements[0]
+        self.assertTrue(statement.startswith("LOAD DATA LOCAL INFILE '"))
+        self.assertTrue('IGNORE INTO TABLE git_objects' in statement)
+        # The sha1 columns are loaded as hex and unhexed
+        self.assertTrue('(@id, type, dirty, complete, n_parents, n_commits, n_repositories, '
+                        'n_names, @object_id) SET id = UNHEX(@id), '
+                        'object_id = UNHEX(@object_id)' in statement)
+        self.assertEqual(conn.loaded[0].splitlines(),
+                         ['"%s","blob",1,NULL,NULL,NULL,NULL,2,NULL' % ('ab' * 20),
+                          '"%s","blob",NULL,NULL,NULL,NULL,NULL,NULL,"%s"'
+                          % ('cd' * 20, 'ef' * 20)])
+
+    def test_load_data_fields(self):
+        self.assertEqual(mysql._load_data_field(u'caf\xe9 "x"'), '"caf\xc3\xa9 ""x"""')
+        self.assertEqual(mysql._load_data_field(False), '0')
+        self.assertEqual(mysql._load_data_field(None), 'NULL')
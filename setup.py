@@ -7,7 +7,7 @@ setup(
     url='http://anyg.it',
     install_requires=[
         "Pylons>=0.9.7",
-        "SQLAlchemy>=0.5",
+        "SQLAlchemy>=0.7",
     ],
     setup_requires=["PasteScript>=1.6.3"],
     packages=find_packages(),
@@ -27,5 +27,6 @@ setup(
     [anygit.backend]
     mysql = anygit.backends.mysql
     mongodb = anygit.backends.mongodb
+    sqlite = anygit.backends.sqlite
     """,
 )